@@ -0,0 +1,307 @@
+"""
+Benchmarks the Flux queries of the provisioned Grafana dashboards.
+
+Extracts every panel query from grafana/dashboards/*.json, substitutes
+v.timeRangeStart / v.timeRangeStop / v.windowPeriod the way Grafana does
+for the chosen time range, and runs each one against a local InfluxDB
+loaded with synthetic fleet data at several scales. Every query runs with
+the Flux query profiler, which reports server-side execution time, memory
+and the values and bytes read from storage.
+
+Per scale the report lists each panel with its median latency, rows
+returned, values scanned and peak memory, most expensive first, and flags
+the panels that account for most of the total time. --report writes the
+results as JSON; --compare prints the change against an earlier report,
+so an optimization can be checked before and after.
+
+Without --compare a run compares against the baseline report,
+dashboard_baseline.json next to this script (--baseline). Latencies depend
+on the InfluxDB instance, so the baseline is not committed: record one on
+the machine that runs the comparison with --save-baseline first.
+
+Usage:
+  python dashboard_bench.py --url http://localhost:8086 --token ... \\
+      --scales 100,1000,5000 --hours 48 --save-baseline
+  python dashboard_bench.py ... --skip-load     # compare with the baseline
+  python dashboard_bench.py ... --skip-load --report after.json --compare before.json
+
+Each scale writes into its own bucket (<bucket-prefix>_<devices>), created
+if missing; --skip-load reuses buckets loaded by an earlier run.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import statistics
+import time
+
+import influxdb_client
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from fleet_simulator import Device, parse_mix
+from rgbww_ingest.core import parse_message
+from rgbww_ingest.flatten import flatten_json
+from rgbww_ingest.influx import build_point
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUCKET_REF = re.compile(r'from\(\s*bucket\s*:\s*["\'][^"\']*["\']\s*\)')
+IMPORT = re.compile(r'^\s*import\s+"[^"]+"\s*$')
+PROFILE_FIELDS = {
+    'execute_ms': 'ExecuteDuration',
+    'total_ms': 'TotalDuration',
+    'max_allocated': 'MaxAllocated',
+    'scanned_values': 'influxdb/scanned-values',
+    'scanned_bytes': 'influxdb/scanned-bytes',
+}
+
+
+def walk_panels(panels):
+    for panel in panels:
+        yield panel
+        yield from walk_panels(panel.get('panels', []))
+
+
+def extract_queries(paths):
+    """Returns [{'dashboard', 'panel', 'ref', 'query'}] for every Flux panel target."""
+    queries = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                document = json.load(f)
+        except ValueError as e:
+            print(f"Skipping {path}: not valid JSON ({e})")
+            continue
+        dashboard = document.get('dashboard', document)
+        title = dashboard.get('title') or os.path.basename(path)
+        for panel in walk_panels(dashboard.get('panels', [])):
+            for target in panel.get('targets', []):
+                query = target.get('query')
+                # Skip Prometheus expressions and comment-only placeholders
+                if not query or 'from(' not in query:
+                    continue
+                queries.append({
+                    'dashboard': title,
+                    'panel': panel.get('title') or f"panel {panel.get('id')}",
+                    'ref': target.get('refId', 'A'),
+                    'query': query,
+                })
+    return queries
+
+
+def prepare(query, bucket, start, stop, window):
+    """
+    Points the query at the benchmark bucket, fills in the dashboard
+    variables and enables the query profiler (after any imports).
+    """
+    query = BUCKET_REF.sub(f'from(bucket: "{bucket}")', query)
+    query = (query.replace('v.timeRangeStart', start)
+                  .replace('v.timeRangeStop', stop)
+                  .replace('v.windowPeriod', window))
+    lines = query.split('\n')
+    imports = 0
+    # Imports may be preceded or separated by blank lines and comments
+    while imports < len(lines) and (IMPORT.match(lines[imports]) or not lines[imports].strip()
+                                    or lines[imports].lstrip().startswith('//')):
+        imports += 1
+    header = lines[:imports] + ['import "profiler"', 'option profiler.enabledProfilers = ["query"]']
+    return '\n'.join(header + lines[imports:])
+
+
+# --- Synthetic data ---
+
+def fleet_lines(devices, hours, interval, seed, soc_mix, firmware_mix, telegraf):
+    """
+    Yields batches of line protocol for devices reporting every interval
+    seconds over the last hours, built by the importer's own build_point
+    (rgbww_debug_data) and, with telegraf, as Telegraf's mqtt_consumer
+    measurement.
+    """
+    rng = random.Random(seed)
+    socs, soc_weights = parse_mix(soc_mix)
+    firmwares, firmware_weights = parse_mix(firmware_mix)
+    end = int(time.time())
+    start = end - int(hours * 3600)
+    fleet = [Device(0x100000 + i, rng.choices(firmwares, firmware_weights)[0],
+                    rng.choices(socs, soc_weights)[0], start, rng) for i in range(devices)]
+    offsets = [rng.uniform(0, interval) for _ in fleet]
+    t = start
+    while t < end:
+        batch = []
+        for device, offset in zip(fleet, offsets):
+            now = t + offset
+            if rng.random() < 0.0005:
+                device.reboot(now, rng)
+            payload = device.monitor(now, rng)
+            message = parse_message(f'rgbww/{device.id}/monitor', json.dumps(payload), received=now)
+            point = build_point(message)
+            if point is not None:
+                batch.append(point.to_line_protocol())
+            if telegraf:
+                numbers = {k: v for k, v in flatten_json(payload).items()
+                           if isinstance(v, (int, float)) and not isinstance(v, bool)}
+                fields = ','.join(f'{k}={float(v)}' for k, v in numbers.items())
+                batch.append(f'mqtt_consumer,host=bench,id={device.id},topic=rgbww/{device.id}/monitor '
+                             f'{fields} {int(now)}')
+        yield batch
+        t += interval
+
+
+def ensure_bucket(client, name, org):
+    buckets = client.buckets_api()
+    if buckets.find_bucket_by_name(name) is None:
+        org_id = next(o.id for o in client.organizations_api().find_organizations() if o.name == org)
+        buckets.create_bucket(bucket_name=name, org_id=org_id)
+        print(f"Created bucket {name}")
+
+
+def load(client, args, bucket, devices):
+    ensure_bucket(client, bucket, args.org)
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    written, started = 0, time.time()
+    pending = []
+    for batch in fleet_lines(devices, args.hours, args.interval, args.seed,
+                             args.soc, args.firmware, args.telegraf):
+        pending.extend(batch)
+        if len(pending) >= 5000:
+            write_api.write(bucket=bucket, org=args.org, record=pending, write_precision='s')
+            written += len(pending)
+            pending = []
+    if pending:
+        write_api.write(bucket=bucket, org=args.org, record=pending, write_precision='s')
+        written += len(pending)
+    print(f"Loaded {written} points for {devices} devices into {bucket} in {time.time() - started:.1f}s")
+
+
+# --- Running ---
+
+def run_query(query_api, flux, org):
+    """Returns (client-side seconds, rows, {profile field: value})."""
+    started = time.perf_counter()
+    tables = query_api.query(flux, org=org)
+    elapsed = time.perf_counter() - started
+    rows, profile = 0, {}
+    for table in tables:
+        for record in table.records:
+            if record.values.get('_measurement') == 'profiler/query':
+                for name, key in PROFILE_FIELDS.items():
+                    value = record.values.get(key)
+                    if value is not None:
+                        # Durations are reported in nanoseconds
+                        profile[name] = value / 1e6 if name.endswith('_ms') else value
+            else:
+                rows += 1
+    return elapsed, rows, profile
+
+
+def bench_scale(client, args, queries, bucket):
+    query_api = client.query_api()
+    start, stop = f'-{args.range}', 'now()'
+    results = []
+    for q in queries:
+        flux = prepare(q['query'], bucket, start, stop, args.window)
+        entry = {'dashboard': q['dashboard'], 'panel': q['panel'], 'ref': q['ref']}
+        latencies = []
+        try:
+            for _ in range(args.repeat):
+                elapsed, rows, profile = run_query(query_api, flux, args.org)
+                latencies.append(elapsed)
+        except Exception as e:
+            entry['error'] = str(e).splitlines()[0][:200]
+            results.append(entry)
+            continue
+        entry['latency_ms'] = round(1000 * statistics.median(latencies), 1)
+        entry['rows'] = rows
+        entry.update({k: round(v, 1) if isinstance(v, float) else v for k, v in profile.items()})
+        results.append(entry)
+    return results
+
+
+def key(entry):
+    return f"{entry['dashboard']} / {entry['panel']} [{entry['ref']}]"
+
+
+def print_scale(devices, results, previous=None, expensive_share=0.5):
+    """
+    Prints one scale's panels by latency. The slowest panels that together
+    take expensive_share of the total time are flagged.
+    """
+    ok = sorted((r for r in results if 'error' not in r), key=lambda r: r['latency_ms'], reverse=True)
+    total = sum(r['latency_ms'] for r in ok) or 1
+    before = {key(r): r for r in (previous or []) if 'error' not in r}
+    print(f"\n=== {devices} devices: {len(results)} queries, {total:.0f} ms per dashboard refresh ===")
+    print(f"{'latency ms':>10} {'change':>8} {'rows':>8} {'scanned values':>15} {'max alloc':>11}  panel")
+    running = 0.0
+    for r in ok:
+        flag = '  <-- expensive' if running < expensive_share * total else ''
+        running += r['latency_ms']
+        change = ''
+        if key(r) in before and before[key(r)]['latency_ms']:
+            change = f"{100 * (r['latency_ms'] / before[key(r)]['latency_ms'] - 1):+.0f}%"
+        print(f"{r['latency_ms']:>10.1f} {change:>8} {r['rows']:>8} {r.get('scanned_values', '?'):>15} "
+              f"{r.get('max_allocated', '?'):>11}  {key(r)}{flag}")
+    for r in results:
+        if 'error' in r:
+            print(f"{'failed':>10} {'':>8} {'':>8} {'':>15} {'':>11}  {key(r)}: {r['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Flux queries of the Grafana dashboards.")
+    parser.add_argument('--url', default=os.environ.get('INFLUX_URL', 'http://localhost:8086'))
+    parser.add_argument('--token', default=os.environ.get('INFLUX_TOKEN', ''))
+    parser.add_argument('--org', default=os.environ.get('INFLUX_ORG', 'default'))
+    parser.add_argument('--bucket-prefix', default='rgbww_bench')
+    parser.add_argument('--dashboards', default=os.path.join(HERE, 'grafana', 'dashboards', '*.json'))
+    parser.add_argument('--scales', default='100,1000', help='comma separated fleet sizes')
+    parser.add_argument('--hours', type=float, default=48, help='hours of history to load')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between payloads per device')
+    parser.add_argument('--telegraf', action='store_true', help='also load the mqtt_consumer measurement')
+    parser.add_argument('--soc', default='esp8266:0.8,esp32:0.1,esp32c3:0.1')
+    parser.add_argument('--firmware', default='V5.0-476-develop:0.8,V5.0-470-develop:0.15,V4.9-300-stable:0.05')
+    parser.add_argument('--skip-load', action='store_true', help='query buckets loaded by an earlier run')
+    parser.add_argument('--range', default='6h', help='dashboard time range (v.timeRangeStart = -range)')
+    parser.add_argument('--window', default='1m', help='value of v.windowPeriod')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per query, the median is reported')
+    parser.add_argument('--only', help='regular expression on "dashboard / panel"')
+    parser.add_argument('--report', help='write the results as JSON')
+    parser.add_argument('--compare', help='earlier --report to compare against (default: the baseline)')
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'dashboard_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    queries = extract_queries(sorted(glob.glob(args.dashboards)))
+    if args.only:
+        queries = [q for q in queries if re.search(args.only, f"{q['dashboard']} / {q['panel']}")]
+    print(f"{len(queries)} Flux queries in {args.dashboards}")
+    previous = {}
+    compare = args.compare or (None if args.save_baseline else args.baseline)
+    if compare and (args.compare or os.path.exists(compare)):
+        with open(compare) as f:
+            previous = json.load(f)
+        print(f"Comparing with {compare}")
+
+    client = influxdb_client.InfluxDBClient(url=args.url, token=args.token, org=args.org, timeout=120000)
+    report = {}
+    for devices in [int(s) for s in args.scales.split(',') if s.strip()]:
+        bucket = f"{args.bucket_prefix}_{devices}"
+        if not args.skip_load:
+            load(client, args, bucket, devices)
+        report[str(devices)] = bench_scale(client, args, queries, bucket)
+        print_scale(devices, report[str(devices)], previous.get(str(devices)))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.report}")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif not previous:
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to record one")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""
+Synthetic rgbww fleet for scale testing the importer and the bridge.
+
+Simulates thousands of controllers that publish rgbww/<id>/monitor payloads
+in the shape seen in log.txt and rgbww/<id>/log lines to a broker. For each
+step of --steps the fleet runs --step-duration seconds while the /status
+endpoints of the importer and/or bridge are polled, then a scaling report
+shows the offered and ingested rates, drops, sink lag and memory per step.
+
+Usage:
+  python fleet_simulator.py --broker localhost --steps 1000,2000,5000,10000 \\
+      --interval 10 --status http://localhost:8001/status --report report.json
+
+Without --status the simulator only publishes.
+"""
+import argparse
+import heapq
+import json
+import random
+import threading
+import time
+import urllib.request
+
+import paho.mqtt.client as mqtt
+
+LOG_TEMPLATES = [
+    ('I', 'wifi', 'connected to {ssid} rssi={rssi}'),
+    ('I', 'mdns', 'query from {ip} answered in {ms} ms'),
+    ('I', 'mqtt', 'published monitor ({bytes} bytes)'),
+    ('W', 'heap', 'free heap low: {heap}'),
+    ('W', 'wifi', 'beacon timeout, reason={code}'),
+    ('E', 'mqtt', 'publish failed, error={code}'),
+    ('E', 'http', 'request /{path} failed with status {status}'),
+]
+
+
+def parse_mix(spec):
+    """'a:0.8,b:0.2' -> ([a, b], [0.8, 0.2])"""
+    names, weights = [], []
+    for part in spec.split(','):
+        name, _, weight = part.strip().partition(':')
+        if name:
+            names.append(name)
+            weights.append(float(weight or 1))
+    return names, weights
+
+
+class Device:
+    """State of one simulated controller."""
+
+    __slots__ = ('id', 'firmware', 'soc', 'booted', 'clock', 'heap', 'received', 'replies', 'reboots')
+
+    def __init__(self, device_id, firmware, soc, now, rng):
+        self.id = device_id
+        self.firmware = firmware
+        self.soc = soc
+        # Devices start with a random uptime of up to a day
+        self.booted = now - rng.randint(60, 86400)
+        # 'time' in the payloads is a free running millisecond counter
+        self.clock = rng.randint(0, 2**31)
+        self.heap = rng.randint(21000, 29000)
+        self.received = rng.randint(0, 1000000)
+        self.replies = int(self.received * rng.uniform(0.4, 0.9))
+        self.reboots = 0
+
+    def reboot(self, now, rng):
+        self.booted = now
+        self.heap = rng.randint(27000, 30000)
+        self.received = self.replies = 0
+        self.reboots += 1
+
+    def monitor(self, now, rng):
+        """Advances the device and returns its next monitor payload."""
+        self.heap = max(4000, min(32000, self.heap + rng.randint(-200, 180)))
+        queries = rng.randint(0, 40)
+        self.received += queries
+        self.replies += rng.randint(0, queries)
+        return {
+            'id': self.id,
+            'time': (self.clock + int(now * 1000)) % 2**32,
+            'uptime': int(now - self.booted),
+            'freeHeap': self.heap,
+            'firmware': self.firmware,
+            'soc': self.soc,
+            'mDNS': {'received': self.received, 'replies': self.replies},
+        }
+
+    def log_line(self, now, rng):
+        level, component, text = rng.choice(LOG_TEMPLATES)
+        text = text.format(ssid='rgbww-net', rssi=rng.randint(-90, -40), ip=f'192.168.1.{rng.randint(2, 254)}',
+                           ms=rng.randint(1, 50), bytes=rng.randint(150, 190), heap=self.heap,
+                           code=rng.randint(1, 16), path=rng.choice(['info', 'config', 'color']),
+                           status=rng.choice([400, 404, 500]))
+        return f"{int((now - self.booted) * 1000)} {level} [{component}] {text}"
+
+
+class Fleet:
+    """
+    Publishes for a set of devices over a small pool of MQTT connections.
+    Each device publishes every interval seconds (+/- jitter) and emits log
+    lines as a Poisson process with log_rate lines per minute.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.firmwares = parse_mix(args.firmware)
+        self.socs = parse_mix(args.soc)
+        self.devices = []
+        self.schedule = []
+        self.clients = []
+        self.published = 0
+        self.publish_errors = 0
+        self.reboots = 0
+        # Worst delay of a publish behind its schedule, i.e. the simulator itself lagging
+        self.behind = 0.0
+
+    def connect(self):
+        args = self.args
+        for i in range(args.clients):
+            client = mqtt.Client(client_id=f'rgbww_fleet_sim_{i}_{random.randrange(1 << 16)}')
+            if args.user:
+                client.username_pw_set(args.user, args.password)
+            client.max_queued_messages_set(0)
+            client.max_inflight_messages_set(1000)
+            client.connect(args.broker, args.port)
+            client.loop_start()
+            self.clients.append(client)
+        print(f"Connected {args.clients} MQTT clients to {args.broker}:{args.port}")
+
+    def resize(self, count, now):
+        """Grows the fleet to count devices; new devices start at random phases."""
+        while len(self.devices) < count:
+            index = len(self.devices)
+            device = Device(
+                1000000 + index,
+                self.rng.choices(*self.firmwares)[0],
+                self.rng.choices(*self.socs)[0],
+                now, self.rng,
+            )
+            self.devices.append(device)
+            heapq.heappush(self.schedule, (now + self.rng.uniform(0, self.args.interval), index, 'monitor'))
+            if self.args.log_rate > 0:
+                heapq.heappush(self.schedule, (now + self.next_log(), index, 'log'))
+
+    def next_log(self):
+        return self.rng.expovariate(self.args.log_rate / 60.0)
+
+    def publish(self, index, topic, payload):
+        client = self.clients[index % len(self.clients)]
+        result = client.publish(topic, payload, qos=self.args.qos)
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.published += 1
+        else:
+            self.publish_errors += 1
+
+    def run_until(self, deadline):
+        args, rng = self.args, self.rng
+        while True:
+            now = time.time()
+            if now >= deadline:
+                return
+            if not self.schedule or self.schedule[0][0] > now:
+                time.sleep(min(0.005, deadline - now))
+                continue
+            due, index, kind = heapq.heappop(self.schedule)
+            self.behind = max(self.behind, now - due)
+            device = self.devices[index]
+            if kind == 'log':
+                self.publish(index, f'rgbww/{device.id}/log', device.log_line(now, rng))
+                heapq.heappush(self.schedule, (due + self.next_log(), index, 'log'))
+                continue
+            if rng.random() < args.reboot_prob:
+                device.reboot(now, rng)
+                self.reboots += 1
+            self.publish(index, f'rgbww/{device.id}/monitor', json.dumps(device.monitor(now, rng), separators=(',', ':')))
+            jitter = rng.uniform(-args.jitter, args.jitter) * args.interval
+            heapq.heappush(self.schedule, (due + args.interval + jitter, index, 'monitor'))
+
+    def stop(self):
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+
+
+# --- Target monitoring ---
+def fetch_status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return json.load(response)
+    except (OSError, ValueError) as e:
+        print(f"Could not fetch {url}: {e}")
+        return None
+
+
+class StatusPoller:
+    """Polls /status endpoints in the background and keeps per-step extremes."""
+
+    def __init__(self, urls, interval=2):
+        self.urls = urls
+        self.interval = interval
+        self.samples = {url: [] for url in urls}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            for url in self.urls:
+                status = fetch_status(url)
+                if status is not None:
+                    self.samples[url].append((time.time(), status))
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.stop_event.clear()
+        self.samples = {url: [] for url in self.urls}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def summary(self):
+        """Ingest rate, drops, worst sink lag and memory per target over the step."""
+        result = {}
+        for url, samples in self.samples.items():
+            if len(samples) < 2:
+                result[url] = None
+                continue
+            (t0, first), (t1, last) = samples[0], samples[-1]
+            sinks0, sinks1 = first.get('sinks', {}), last.get('sinks', {})
+            dropped = sum(s.get('dropped', 0) for s in sinks1.values()) - sum(s.get('dropped', 0) for s in sinks0.values())
+            result[url] = {
+                'ingest_rate': round((last['messages_received'] - first['messages_received']) / (t1 - t0), 1),
+                'dropped': dropped,
+                'errors': last.get('errors', 0) - first.get('errors', 0),
+                'max_lag': round(max((s.get('lag', 0) for _, st in samples for s in st.get('sinks', {}).values()), default=0), 3),
+                'max_queued': max((sum(st.get('messages_queued', {}).values()) for _, st in samples), default=0),
+                'rss_mb': round(max(st.get('rss_bytes', 0) for _, st in samples) / 2**20, 1),
+            }
+        return result
+
+
+def print_report(steps, lag_limit):
+    print()
+    print(f"{'devices':>8} {'offered/s':>10} {'sent/s':>8} {'behind':>7}  target")
+    for step in steps:
+        print(f"{step['devices']:>8} {step['offered_rate']:>10} {step['sent_rate']:>8} {step['sim_behind']:>7}")
+        for url, summary in step['targets'].items():
+            if summary is None:
+                print(f"{'':>37}  {url}: no data")
+                continue
+            print(f"{'':>37}  {url}: ingest {summary['ingest_rate']}/s, dropped {summary['dropped']}, "
+                  f"lag {summary['max_lag']}s, queued {summary['max_queued']}, rss {summary['rss_mb']} MB")
+
+    # Where does each target stop keeping up?
+    for url in steps[0]['targets'] if steps else []:
+        best, flattened, lagging = 0, None, None
+        for step in steps:
+            summary = step['targets'].get(url)
+            if not summary:
+                continue
+            best = max(best, summary['ingest_rate'])
+            # Ingest falling more than 10% short of what was actually sent
+            if flattened is None and summary['ingest_rate'] < 0.9 * step['sent_rate']:
+                flattened = step['devices']
+            if lagging is None and (summary['max_lag'] > lag_limit or summary['dropped']):
+                lagging = step['devices']
+        print(f"{url}: peak ingest {best}/s"
+              + (f", throughput flattens at {flattened} devices" if flattened else ", kept up at every step")
+              + (f", lag/drops from {lagging} devices" if lagging else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic rgbww fleet for scale testing.")
+    parser.add_argument('--broker', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--user', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--clients', type=int, default=4, help='MQTT connections shared by the devices')
+    parser.add_argument('--qos', type=int, default=0, choices=(0, 1))
+    parser.add_argument('--steps', default='1000,2000,5000', help='comma separated fleet sizes')
+    parser.add_argument('--step-duration', type=float, default=60, help='seconds per step')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between monitor payloads per device')
+    parser.add_argument('--jitter', type=float, default=0.1, help='+/- fraction of the interval')
+    parser.add_argument('--log-rate', type=float, default=1, help='log lines per device per minute')
+    parser.add_argument('--reboot-prob', type=float, default=0.001, help='reboot chance per monitor payload')
+    parser.add_argument('--firmware', default='V5.0-476-develop:0.8,V5.0-470-develop:0.15,V4.9-300-stable:0.05')
+    parser.add_argument('--soc', default='esp8266:0.9,esp32:0.1')
+    parser.add_argument('--status', action='append', default=[], help='/status URL of an importer or bridge (repeatable)')
+    parser.add_argument('--lag-limit', type=float, default=10, help='sink lag in seconds that counts as falling behind')
+    parser.add_argument('--report', help='write the per-step results as JSON')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fleet = Fleet(args)
+    fleet.connect()
+    poller = StatusPoller(args.status)
+    steps = []
+    try:
+        for count in [int(s) for s in args.steps.split(',') if s.strip()]:
+            fleet.resize(count, time.time())
+            offered = count / args.interval + count * args.log_rate / 60
+            print(f"--- {count} devices, offering {offered:.1f} msg/s for {args.step_duration:g}s ---")
+            published, fleet.behind = fleet.published, 0.0
+            if args.status:
+                poller.start()
+            started = time.time()
+            fleet.run_until(started + args.step_duration)
+            elapsed = time.time() - started
+            if args.status:
+                poller.stop()
+            steps.append({
+                'devices': count,
+                'offered_rate': round(offered, 1),
+                'sent_rate': round((fleet.published - published) / elapsed, 1),
+                'sim_behind': round(fleet.behind, 2),
+                'publish_errors': fleet.publish_errors,
+                'reboots': fleet.reboots,
+                'targets': poller.summary() if args.status else {},
+            })
+    except KeyboardInterrupt:
+        print("Interrupted, reporting completed steps")
+    finally:
+        fleet.stop()
+
+    print_report(steps, args.lag_limit)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(steps, f, indent=2)
+        print(f"Wrote {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,778 +1,237 @@
-import json
 import os
-import threading
-import time
-from collections import deque
-from flask import Flask, jsonify
-import paho.mqtt.client as mqtt
-import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
-from influxdb_client import Point, WritePrecision
-from datetime import datetime, timezone 
+import signal
+import sys
+
+from rgbww_ingest import DeviceStateSink, IngestCore, JsonlArchiveSink
+from rgbww_ingest.acks import AckWindow
+from rgbww_ingest.anomaly import AnomalyProcessor
+from rgbww_ingest.cardinality import CardinalityGuard, parse_patterns
+from rgbww_ingest.deadletter import DeadLetterFile
+from rgbww_ingest.influx import InfluxSink
+from rgbww_ingest.logs import LogCompactor
+from rgbww_ingest.rates import CounterRateProcessor
+from rgbww_ingest.reboot import RebootProcessor
+from rgbww_ingest.remote_write import RemoteWriteSink
+from rgbww_ingest.rollup import RollupProcessor, parse_windows
+from rgbww_ingest.routing import load_routes
+from rgbww_ingest.schema import FieldTypeRegistry
+from rgbww_ingest.web import create_app
 
 # --- Configuration ---
-# MQTT_BROKER = 'lightinator.de'
-# MQTT_PORT = 1883
-# MQTT_USER = 'rgbww'
-# MQTT_PASS = 'rgbwwdebug'
-# Multi-level wildcard topic pattern
-# MQTT_TOPIC = 'rgbww/+/monitor' 
-# BUFFER_SIZE = 10
-# HTTP_PORT = 8001
-
 MQTT_BROKER=os.environ.get('MQTT_BROKER', 'lightinator.de')
 MQTT_PORT=int(os.environ.get('MQTT_PORT', 1883))
 MQTT_USER=os.environ.get('MQTT_USER', 'rgbww')
 MQTT_PASS=os.environ.get('MQTT_PASS', 'rgbwwdebug')
 MQTT_TOPIC=os.environ.get('MQTT_TOPIC', 'rgbww/+/monitor')
+MQTT_LOG_TOPIC=os.environ.get('MQTT_LOG_TOPIC', 'rgbww/+/log')
+MQTT_CLIENT_ID=os.environ.get('MQTT_CLIENT_ID', 'rgbww_influxdb_importer')
 
 BUFFER_SIZE=int(os.environ.get('BUFFER_SIZE', 10))
 
 HTTP_PORT = int(os.environ.get('HTTP_PORT', 8001))
+# Devices seen within this many seconds count as online in the Grafana API
+ONLINE_TTL = int(os.environ.get('ONLINE_TTL', 3600))
+
+# Comma separated list of sinks fed from the one MQTT subscription:
+# influx, state (/metrics.json), archive (JSONL files), remote_write (Prometheus)
+INGEST_SINKS = [s.strip() for s in os.environ.get('INGEST_SINKS', 'influx,state').split(',') if s.strip()]
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'mqtt_flattened_output')
+# Archive the payload bytes as received instead of the flattened JSON
+ARCHIVE_RAW = os.environ.get('ARCHIVE_RAW', 'false').lower() in ('1', 'true', 'yes')
 
 # --- InfluxDB Configuration ---
-# ----------------------------------------------------------------------
-# INFLUX_URL = 'http://127.0.0.1:8086' # <-- SET YOUR INFLUXDB URL
-# INFLUX_ORG = 'default'         # <-- SET YOUR INFLUXDB ORG ID
-# INFLUX_BUCKET = 'rgbww'
-# INFLUX_TOKEN = '0O3MlXDBJC_92vr50FjIgnCYpKKsf8woe1_WOf8iGY5BZWTiDWVIKCRDGx9JRTucZ-2JWLJfjgK0HeTHQDdXNA==' # <-- SET YOUR INFLUXDB ACCESS TOKEN
-# WRITE_INTERVAL = 5                 # Seconds between write attempts
-# ----------------------------------------------------------------------
 INFLUX_URL = os.environ.get('INFLUX_URL', 'http://influxdb:8086')
 INFLUX_ORG = os.environ.get('INFLUX_ORG', 'default')
 INFLUX_BUCKET = os.environ.get('INFLUX_BUCKET', 'rgbww')
 INFLUX_TOKEN = os.environ.get('INFLUX_TOKEN', '0O3MlXDBJC_92vr50FjIgnCYpKKsf8woe1_WOf8iGY5BZWTiDWVIKCRDGx9JRTucZ-2JWLJfjgK0HeTHQDdXNA==')
 WRITE_INTERVAL= int(os.environ.get('WRITE_INTERVAL', 5))
-
-# Buffer: single global queue of messages
-buffer = deque(maxlen=BUFFER_SIZE * 100)
-
-app = Flask(__name__)
-
-# --- InfluxDB Client Setup ---
-INFLUX_WRITE_API = None
-try:
-    INFLUX_CLIENT = influxdb_client.InfluxDBClient(
-        url=INFLUX_URL, 
-        token=INFLUX_TOKEN, 
-        org=INFLUX_ORG
-    )
-    # Use SYNCHRONOUS mode for simpler error handling
-    INFLUX_WRITE_API = INFLUX_CLIENT.write_api(write_options=SYNCHRONOUS)
-    print("InfluxDB client initialized successfully.")
-except Exception as e:
-    print(f"Error initializing InfluxDB client: {e}. Please check your URL, Token, and Org. Write functionality disabled.")
-
-
-# --- JSON FLATTENING FUNCTION ---
-def flatten_json(y):
-    """
-    Recursively flattens a nested dictionary.
-    Keys are joined by an underscore (e.g., 'parent_child').
-    """
-    out = {}
-
-    def flatten(x, name=''):
-        if isinstance(x, dict):
-            for a in x:
-                flatten(x[a], name + a + '_')
-        elif isinstance(x, list):
-            # Skip lists as they are not easily mapped to InfluxDB fields
-            print(f"Warning: Skipping list field at key: {name.strip('_')}")
-            pass 
-        else:
-            out[name[:-1]] = x
-
-    flatten(y)
-    return out
-
-
-@app.route('/metrics.json')
-def metrics():
-    """Flask endpoint to view buffered messages."""
-    filtered = [msg for msg in list(buffer) if isinstance(msg, dict) and 'id' in msg]
-    return jsonify({"devices": filtered})
-
-# --- MQTT Functions ---
-def on_connect(client, userdata, flags, rc):
-    """Callback for when the client connects to the MQTT broker."""
-    print('Connected to MQTT broker')
-    print(f'Subscribing to topic pattern: {MQTT_TOPIC}')
-    result1, mid1 = client.subscribe(MQTT_TOPIC)
-    print(f'Subscribe result: {result1}, message id: {mid1}')
-    # Subscribe to log topic
-    log_topic = 'rgbww/+/log'
-    result2, mid2 = client.subscribe(log_topic)
-    print(f'Subscribing to topic pattern: {log_topic}')
-    print(f'Subscribe result: {result2}, message id: {mid2}')
-
-def on_message(client, userdata, msg):
-    """Callback for when a message is received from the MQTT broker."""
-    topic = msg.topic
-    payload_str = msg.payload.decode()
-    # Handle log messages
-    if topic.endswith('/log'):
-        # Extract <id> from topic
-        parts = topic.split('/')
-        if len(parts) >= 3:
-            device_id = parts[1]
-            # Write to InfluxDB measurement rgbww_log
-            try:
-                point = Point("rgbww_log").tag("id", device_id).field("message", str(payload_str)).time(time=datetime.now(timezone.utc), write_precision=WritePrecision.NS)
-                INFLUX_WRITE_API.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=point)
-                print(f"[LOG] Wrote log message for device {device_id}: {payload_str}")
-            except Exception as e:
-                print(f"[ERROR] Failed to write log message: {e}")
-        else:
-            print(f"[ERROR] Could not parse device id from topic: {topic}")
-        return
-    # Handle monitor messages (existing logic)
-    try:
-        payload = json.loads(payload_str)
-        buffer.append(payload)
-    except Exception as e:
-        print(f'Error processing message: {e}')
-
-def mqtt_thread():
-    """Runs the MQTT client loop and periodically publishes bridge status."""
-    client = mqtt.Client(client_id="mqtt_json_bridge")
-    client.username_pw_set(MQTT_USER, MQTT_PASS)
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(MQTT_BROKER, MQTT_PORT)
-
-    def publish_status():
-        while True:
-            status = {
-                'messages_received': len(buffer),
-                'devices': len(set(msg.get('deviceid', msg.get('id')) for msg in buffer)),
-                'messages_queued': {}
-            }
-            # Publish to a neutral topic to avoid loops
-            client.publish('bridge/status', json.dumps(status), qos=0, retain=False)
-            time.sleep(10)
-
-    threading.Thread(target=publish_status, daemon=True).start()
-    client.loop_forever()
-
-
-# --- INFLUXDB WRITER THREAD (WITH STRICT INTEGER ENFORCEMENT) ---
-def influxdb_writer_thread():
-    """Pulls messages from the buffer, FLATTENS, converts to InfluxDB Points, and writes them."""
-    if not INFLUX_WRITE_API:
-        print("InfluxDB Write API is not available. Writer thread exiting.")
-        return
-
-    # --- THIS IS THE CRITICAL FIX FOR YOUR SCHEMA ---
-    # List of field keys that MUST be stored as integers in InfluxDB
-    INTEGER_ONLY_FIELDS = ['uptime', 'freeHeap', 'id', 'time', 'mdns_received', 'mdns_replies']
-    
-    print(f"Starting InfluxDB writer thread. Target bucket: {INFLUX_BUCKET}")
-    while True:
-        messages_to_process = [] 
-        
-        try:
-            if not buffer:
-                time.sleep(WRITE_INTERVAL)
-                continue
-
-            # Safely extract all messages currently in the buffer
-            while buffer:
-                 messages_to_process.append(buffer.popleft()) 
-
-            # 1. Flatten and Convert to InfluxDB Point objects
-            points = []
-            for message in messages_to_process:
-                # Flatten the JSON message to handle nested objects
-                flattened_message = flatten_json(message)
-                
-                device_id_raw = flattened_message.get('id', flattened_message.get('deviceid'))
-                try:
-                    device_id = int(device_id_raw)
-                except (ValueError, TypeError):
-                    continue
-
-                # The MEASUREMENT IS DEFINED HERE: rgbww_light_state
-                point = Point("rgbww_debug_data").tag("device", device_id)
-                
-                # Iterate over the FLATTENED message
-                for key, value in flattened_message.items():
-                    # Skip common base metadata keys
-                    if key in ['id', 'deviceid', 'time', 'mac', 'timestamp_ms']: 
-                        continue
-
-                    # --- Robust Type Casting Logic ---
-                    converted_value = None
-                    
-                    try:
-                        # Check if the value is numerical or can be converted to numerical
-                        if isinstance(value, (int, float)):
-                            float_val = float(value)
-                        elif isinstance(value, str) and (value.replace('.', '', 1).isdigit() and value.count('.') < 2):
-                            # This handles "123" and "123.45" but not "1.2.3"
-                            float_val = float(value)
-                        else:
-                            # Not numerical, use original value (e.g., string, boolean)
-                            converted_value = value
-                            
-                        # If we successfully got a float_val, apply conversion rules
-                        if converted_value is None:
-                            if key in INTEGER_ONLY_FIELDS:
-                                # Cast to int for fields like uptime
-                                converted_value = int(float_val)
-                            else:
-                                # Otherwise, use the float value
-                                converted_value = float_val
-                                
-                    except ValueError:
-                        # If any part of the conversion failed, skip the field
-                        continue 
-                        
-                    point.field(key, converted_value)
-                
-                if point._fields: 
-                    # Use nanosecond precision
-                    point.time(time=datetime.now(timezone.utc), write_precision=WritePrecision.NS)
-                    points.append(point)
-
-            if not points:
-                # No valid data to write
-                messages_to_process.clear() 
-                time.sleep(WRITE_INTERVAL)
-                continue
-            
-            # 2. Write the points
-            print(f"Attempting to write {len(points)} points to InfluxDB...")
-            INFLUX_WRITE_API.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=points)
-            
-            print(f"Successfully wrote {len(points)} points to InfluxDB.")
-            messages_to_process.clear()
-
-        except influxdb_client.rest.ApiException as api_e:
-            print(f"InfluxDB API Error: Status {api_e.status}. Reason: {api_e.reason}. Body: {api_e.body}")
-            if api_e.status == 401:
-                 print("!!! AUTHENTICATION ERROR (401). Check INFLUX_TOKEN, ORG, and URL in configuration. !!!")
-            
-        except Exception as e:
-            print(f"Unexpected error in InfluxDB writer thread: {e}")
-            
-        finally:
-            # Re-add any messages that failed the write attempt back to the buffer
-            for msg in messages_to_process:
-                buffer.appendleft(msg) 
-                
-            time.sleep(WRITE_INTERVAL)
-
-if __name__ == '__main__':
-    # Install dependencies check
-    try:
-        import paho.mqtt
-        import flask
-        import influxdb_client 
-    except ImportError:
-        import pip
-        print("Installing dependencies: paho-mqtt, flask, influxdb-client")
-        pip.main(['install', 'paho-mqtt', 'flask', 'influxdb-client'])
-        
-    buffer.clear()
-    
-    # Start the MQTT thread
-    threading.Thread(target=mqtt_thread, daemon=True).start()
-    
-    # Start the InfluxDB writer thread
-    threading.Thread(target=influxdb_writer_thread, daemon=True).start() 
-    
-    # Start the Flask app
-    app.run(host='0.0.0.0', port=HTTP_PORT)
-import json
-import threading
-import time
-from collections import deque
-from flask import Flask, jsonify
-import paho.mqtt.client as mqtt
-import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
-from influxdb_client import Point, WritePrecision
-from datetime import datetime, timezone 
-
-# --- Configuration ---
-MQTT_BROKER = 'lightinator.de'
-MQTT_PORT = 1883
-MQTT_USER = 'rgbww'
-MQTT_PASS = 'rgbwwdebug'
-# Multi-level wildcard topic pattern
-MQTT_TOPIC = 'rgbww/+/monitor' 
-BUFFER_SIZE = 10
-HTTP_PORT = 8001
-
-# --- InfluxDB Configuration ---
-# ----------------------------------------------------------------------
-INFLUX_URL = 'http://127.0.0.1:8086' # <-- SET YOUR INFLUXDB URL
-INFLUX_ORG = 'default'         # <-- SET YOUR INFLUXDB ORG ID
-INFLUX_BUCKET = 'rgbww'
-INFLUX_TOKEN = '0O3MlXDBJC_92vr50FjIgnCYpKKsf8woe1_WOf8iGY5BZWTiDWVIKCRDGx9JRTucZ-2JWLJfjgK0HeTHQDdXNA==' # <-- SET YOUR INFLUXDB ACCESS TOKEN
-WRITE_INTERVAL = 5                 # Seconds between write attempts
-# ----------------------------------------------------------------------
-
-# Buffer: single global queue of messages
-buffer = deque(maxlen=BUFFER_SIZE * 100)
-
-app = Flask(__name__)
-
-# --- InfluxDB Client Setup ---
-INFLUX_WRITE_API = None
-try:
-    INFLUX_CLIENT = influxdb_client.InfluxDBClient(
-        url=INFLUX_URL, 
-        token=INFLUX_TOKEN, 
-        org=INFLUX_ORG
-    )
-    # Use SYNCHRONOUS mode for simpler error handling
-    INFLUX_WRITE_API = INFLUX_CLIENT.write_api(write_options=SYNCHRONOUS)
-    print("InfluxDB client initialized successfully.")
-except Exception as e:
-    print(f"Error initializing InfluxDB client: {e}. Please check your URL, Token, and Org. Write functionality disabled.")
-
-
-# --- JSON FLATTENING FUNCTION ---
-def flatten_json(y):
-    """
-    Recursively flattens a nested dictionary.
-    Keys are joined by an underscore (e.g., 'parent_child').
-    """
-    out = {}
-
-    def flatten(x, name=''):
-        if isinstance(x, dict):
-            for a in x:
-                flatten(x[a], name + a + '_')
-        elif isinstance(x, list):
-            # Skip lists as they are not easily mapped to InfluxDB fields
-            print(f"Warning: Skipping list field at key: {name.strip('_')}")
-            pass 
-        else:
-            out[name[:-1]] = x
-
-    flatten(y)
-    return out
-
-
-@app.route('/metrics.json')
-def metrics():
-    """Flask endpoint to view buffered messages."""
-    filtered = [msg for msg in list(buffer) if isinstance(msg, dict) and 'id' in msg]
-    return jsonify({"devices": filtered})
-
-# --- MQTT Functions ---
-def on_connect(client, userdata, flags, rc):
-    """Callback for when the client connects to the MQTT broker."""
-    print('Connected to MQTT broker')
-    print(f'Subscribing to topic pattern: {MQTT_TOPIC}')
-    result, mid = client.subscribe(MQTT_TOPIC)
-    print(f'Subscribe result: {result}, message id: {mid}')
-
-def on_message(client, userdata, msg):
-    """Callback for when a message is received from the MQTT broker."""
-    try:
-        payload = json.loads(msg.payload.decode())
-        buffer.append(payload)
-    except Exception as e:
-        print(f'Error processing message: {e}')
-
-def mqtt_thread():
-    """Runs the MQTT client loop and periodically publishes bridge status."""
-    client = mqtt.Client(client_id="mqtt_json_bridge")
-    client.username_pw_set(MQTT_USER, MQTT_PASS)
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(MQTT_BROKER, MQTT_PORT)
-
-    def publish_status():
-        while True:
-            status = {
-                'messages_received': len(buffer),
-                'devices': len(set(msg.get('deviceid', msg.get('id')) for msg in buffer)),
-                'messages_queued': {}
-            }
-            # Publish to a neutral topic to avoid loops
-            client.publish('bridge/status', json.dumps(status), qos=0, retain=False)
-            time.sleep(10)
-
-    threading.Thread(target=publish_status, daemon=True).start()
-    client.loop_forever()
-
-
-# --- INFLUXDB WRITER THREAD (WITH STRICT INTEGER ENFORCEMENT) ---
-def influxdb_writer_thread():
-    """Pulls messages from the buffer, FLATTENS, converts to InfluxDB Points, and writes them."""
-    if not INFLUX_WRITE_API:
-        print("InfluxDB Write API is not available. Writer thread exiting.")
-        return
-
-    # --- THIS IS THE CRITICAL FIX FOR YOUR SCHEMA ---
-    # List of field keys that MUST be stored as integers in InfluxDB
-    INTEGER_ONLY_FIELDS = ['uptime', 'freeHeap', 'id', 'time', 'mdns_received', 'mdns_replies']
-    
-    print(f"Starting InfluxDB writer thread. Target bucket: {INFLUX_BUCKET}")
-    while True:
-        messages_to_process = [] 
-        
-        try:
-            if not buffer:
-                time.sleep(WRITE_INTERVAL)
-                continue
-
-            # Safely extract all messages currently in the buffer
-            while buffer:
-                 messages_to_process.append(buffer.popleft()) 
-
-            # 1. Flatten and Convert to InfluxDB Point objects
-            points = []
-            for message in messages_to_process:
-                # Flatten the JSON message to handle nested objects
-                flattened_message = flatten_json(message)
-                
-                device_id_raw = flattened_message.get('id', flattened_message.get('deviceid'))
-                try:
-                    device_id = int(device_id_raw)
-                except (ValueError, TypeError):
-                    continue
-
-                # The MEASUREMENT IS DEFINED HERE: rgbww_light_state
-                point = Point("rgbww_debug_data").tag("device", device_id)
-                
-                # Iterate over the FLATTENED message
-                for key, value in flattened_message.items():
-                    # Skip common base metadata keys
-                    if key in ['id', 'deviceid', 'time', 'mac', 'timestamp_ms']: 
-                        continue
-
-                    # --- Robust Type Casting Logic ---
-                    converted_value = None
-                    
-                    try:
-                        # Check if the value is numerical or can be converted to numerical
-                        if isinstance(value, (int, float)):
-                            float_val = float(value)
-                        elif isinstance(value, str) and (value.replace('.', '', 1).isdigit() and value.count('.') < 2):
-                            # This handles "123" and "123.45" but not "1.2.3"
-                            float_val = float(value)
-                        else:
-                            # Not numerical, use original value (e.g., string, boolean)
-                            converted_value = value
-                            
-                        # If we successfully got a float_val, apply conversion rules
-                        if converted_value is None:
-                            if key in INTEGER_ONLY_FIELDS:
-                                # Cast to int for fields like uptime
-                                converted_value = int(float_val)
-                            else:
-                                # Otherwise, use the float value
-                                converted_value = float_val
-                                
-                    except ValueError:
-                        # If any part of the conversion failed, skip the field
-                        continue 
-                        
-                    point.field(key, converted_value)
-                
-                if point._fields: 
-                    # Use nanosecond precision
-                    point.time(time=datetime.now(timezone.utc), write_precision=WritePrecision.NS)
-                    points.append(point)
-
-            if not points:
-                # No valid data to write
-                messages_to_process.clear() 
-                time.sleep(WRITE_INTERVAL)
-                continue
-            
-            # 2. Write the points
-            print(f"Attempting to write {len(points)} points to InfluxDB...")
-            INFLUX_WRITE_API.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=points)
-            
-            print(f"Successfully wrote {len(points)} points to InfluxDB.")
-            messages_to_process.clear()
-
-        except influxdb_client.rest.ApiException as api_e:
-            print(f"InfluxDB API Error: Status {api_e.status}. Reason: {api_e.reason}. Body: {api_e.body}")
-            if api_e.status == 401:
-                 print("!!! AUTHENTICATION ERROR (401). Check INFLUX_TOKEN, ORG, and URL in configuration. !!!")
-            
-        except Exception as e:
-            print(f"Unexpected error in InfluxDB writer thread: {e}")
-            
-        finally:
-            # Re-add any messages that failed the write attempt back to the buffer
-            for msg in messages_to_process:
-                buffer.appendleft(msg) 
-                
-            time.sleep(WRITE_INTERVAL)
+# Timestamp precision for written points (s, ms, us or ns). Devices report at
+# most once per second, so anything finer than seconds only costs bytes.
+INFLUX_PRECISION = os.environ.get('INFLUX_PRECISION', 's').lower()
+# Log lines keep a fine precision: several lines of a device within one
+# second would otherwise share a timestamp and overwrite each other
+INFLUX_LOG_PRECISION = os.environ.get('INFLUX_LOG_PRECISION', 'ns').lower()
+# Measurement schema of monitor messages: 'debug_data' (rgbww_debug_data,
+# 'device' tag, every flattened field) or 'legacy' (the root importer's
+# rgbww_metrics with a 'deviceid' tag and id/time/uptime/freeHeap/mdns_* fields)
+INFLUX_SCHEMA = os.environ.get('INFLUX_SCHEMA', 'debug_data').lower()
+# Send write bodies with 'Content-Encoding: gzip'
+INFLUX_GZIP = os.environ.get('INFLUX_GZIP', 'true').lower() in ('1', 'true', 'yes')
+
+# Streaming rollups written to rgbww_rollup_<window> (empty ROLLUP_WINDOWS disables them)
+ROLLUP_WINDOWS = parse_windows(os.environ.get('ROLLUP_WINDOWS', '1m,1h'))
+ROLLUP_FIELDS = [f.strip() for f in os.environ.get('ROLLUP_FIELDS', 'freeHeap,uptime,mDNS_received,mDNS_replies').split(',') if f.strip()]
+# Write an rgbww_reboot event whenever a device's uptime resets
+REBOOT_EVENTS = os.environ.get('REBOOT_EVENTS', 'true').lower() in ('1', 'true', 'yes')
+# Monotonic counters written as per-second rates to rgbww_rates (empty disables)
+RATE_COUNTERS = [c.strip() for c in os.environ.get('RATE_COUNTERS', 'mDNS_received,mDNS_replies').split(',') if c.strip()]
+# Streaming anomaly detection: EWMA z-scores of ANOMALY_FIELDS and of the
+# per-second rates of ANOMALY_COUNTERS, and a leak suspect when the freeHeap
+# slope over the last ANOMALY_WINDOW samples is below -LEAK_PER_HOUR bytes/h.
+# Events go to rgbww_anomaly and /anomalies.
+ANOMALY_DETECTION = os.environ.get('ANOMALY_DETECTION', 'true').lower() in ('1', 'true', 'yes')
+ANOMALY_FIELDS = [f.strip() for f in os.environ.get('ANOMALY_FIELDS', 'freeHeap').split(',') if f.strip()]
+ANOMALY_COUNTERS = [c.strip() for c in os.environ.get('ANOMALY_COUNTERS', 'mDNS_received,mDNS_replies').split(',') if c.strip()]
+ANOMALY_Z = float(os.environ.get('ANOMALY_Z', 4))
+ANOMALY_WINDOW = int(os.environ.get('ANOMALY_WINDOW', 120))
+LEAK_PER_HOUR = float(os.environ.get('LEAK_PER_HOUR', 300))
+# Persistent field types; every field is coerced to the type it was first stored with
+FIELD_TYPES_FILE = os.environ.get('FIELD_TYPES_FILE', 'field_types.json')
+# Points InfluxDB refuses (400/413/422) are isolated and appended here
+DEAD_LETTER_FILE = os.environ.get('DEAD_LETTER_FILE', 'dead_letter.jsonl')
+DEAD_LETTER_MAX_BYTES = int(os.environ.get('DEAD_LETTER_MAX_BYTES', 10 * 1024 * 1024))
+# Upper bound in seconds for the backoff after retryable write errors
+MAX_BACKOFF = int(os.environ.get('MAX_BACKOFF', 300))
+# Cardinality guard: caps on distinct field keys / device tags per measurement and
+# comma separated glob allow/deny lists for field keys (empty allow = all)
+MAX_FIELD_KEYS = int(os.environ.get('MAX_FIELD_KEYS', 500))
+MAX_DEVICES = int(os.environ.get('MAX_DEVICES', 10000))
+FIELD_ALLOW = parse_patterns(os.environ.get('FIELD_ALLOW', ''))
+FIELD_DENY = parse_patterns(os.environ.get('FIELD_DENY', ''))
+# Log lines are parsed into level/component tags and code fields, and identical
+# consecutive lines of a device within LOG_COLLAPSE_WINDOW seconds are written
+# as one rgbww_log point with a repeat count (false: one point per line)
+LOG_COMPACTION = os.environ.get('LOG_COMPACTION', 'true').lower() in ('1', 'true', 'yes')
+LOG_COLLAPSE_WINDOW = int(os.environ.get('LOG_COLLAPSE_WINDOW', 60))
+# Overload policy of the influx and state queues: fifo (global drop-oldest),
+# device (drop-oldest per device), coalesce (latest snapshot per device per
+# flush) or sample (adaptive per-device 1-in-k). BUFFER_SIZE is the per-device bound.
+QUEUE_POLICY = os.environ.get('QUEUE_POLICY', 'device')
+
+# Multi-destination routing: a JSON file with brokers, destinations and
+# topic/measurement rules (see rgbww_ingest/routing.py). Empty = one
+# destination (INFLUX_*) and one broker (MQTT_*).
+INFLUX_ROUTES_FILE = os.environ.get('INFLUX_ROUTES_FILE', '')
+# Connections kept per destination (empty = influxdb-client default)
+INFLUX_POOL_SIZE = int(os.environ.get('INFLUX_POOL_SIZE', 0)) or None
+
+# At-least-once mode: QoS 1 subscription in a persistent session (keyed by
+# MQTT_CLIENT_ID); messages are acked only after InfluxDB stored them, at most
+# ACK_WINDOW unacked at a time. Needs paho-mqtt >= 2.0 and a broker allowing
+# that many in-flight messages (mosquitto: max_inflight_messages).
+AT_LEAST_ONCE = os.environ.get('AT_LEAST_ONCE', 'false').lower() in ('1', 'true', 'yes')
+ACK_WINDOW = int(os.environ.get('ACK_WINDOW', 1000))
+
+# --- Prometheus remote write (sink 'remote_write') ---
+# Prometheus must run with --web.enable-remote-write-receiver
+REMOTE_WRITE_URL = os.environ.get('REMOTE_WRITE_URL', 'http://prometheus:9090/api/v1/write')
+REMOTE_WRITE_JOB = os.environ.get('REMOTE_WRITE_JOB', 'iot-mqtt-bridge')
+REMOTE_WRITE_INTERVAL = int(os.environ.get('REMOTE_WRITE_INTERVAL', 15))
+REMOTE_WRITE_BATCH = int(os.environ.get('REMOTE_WRITE_BATCH', 500))
+REMOTE_WRITE_RETRIES = int(os.environ.get('REMOTE_WRITE_RETRIES', 3))
+
+# /debug/profile (CPU samples of all threads) and /debug/heap/* (tracemalloc)
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', 'false').lower() in ('1', 'true', 'yes')
+
+QUEUE_SIZE = BUFFER_SIZE * 100
+
+DEFAULT_BROKER = {
+    'host': MQTT_BROKER, 'port': MQTT_PORT, 'user': MQTT_USER, 'password': MQTT_PASS,
+    'topics': [MQTT_TOPIC, MQTT_LOG_TOPIC],
+}
+DEFAULT_DESTINATION = {
+    'url': INFLUX_URL, 'org': INFLUX_ORG, 'bucket': INFLUX_BUCKET, 'token': INFLUX_TOKEN,
+    'precision': INFLUX_PRECISION, 'log_precision': INFLUX_LOG_PRECISION,
+}
+
+brokers, destinations, routes = [], {'default': DEFAULT_DESTINATION}, {'default': None}
+if INFLUX_ROUTES_FILE:
+    brokers, destinations, routes = load_routes(INFLUX_ROUTES_FILE)
+    print(f"Routing {len(routes)} destinations from {INFLUX_ROUTES_FILE}")
+# Broker entries only need the keys that differ from the MQTT_* settings
+brokers = [dict(DEFAULT_BROKER, **broker) for broker in brokers] or [DEFAULT_BROKER]
+
+core = IngestCore(
+    brokers[0]['host'], brokers[0]['port'], brokers[0]['user'], brokers[0]['password'],
+    topics=brokers[0]['topics'],
+    client_id=brokers[0].get('client_id', MQTT_CLIENT_ID),
+)
+for extra in brokers[1:]:
+    core.add_broker(extra['host'], extra['port'], extra['user'], extra['password'],
+                    topics=extra['topics'], client_id=extra.get('client_id'))
+    print(f"Also subscribing to {extra['host']}:{extra['port']}")
+
+
+def destination_file(path, name):
+    """Per-destination variant of a state file: field_types.json -> field_types.short.json"""
+    if name == 'default':
+        return path
+    base, dot, ext = path.rpartition('.')
+    return f"{base}.{name}.{ext}" if dot else f"{path}.{name}"
+
+
+def add_influx_sink(name, settings, table):
+    """One InfluxSink (client pool, queue, batches, retry state) per destination."""
+    config = dict(DEFAULT_DESTINATION, **settings)
+    sink = core.add_sink(InfluxSink(
+        config['url'], config['org'], config['bucket'], config['token'],
+        precision=config['precision'].lower(), gzip=INFLUX_GZIP,
+        write_interval=WRITE_INTERVAL,
+        # Unacked messages must never be dropped: a plain queue larger than the window
+        queue_size=max(QUEUE_SIZE, ACK_WINDOW) if AT_LEAST_ONCE else QUEUE_SIZE,
+        registry=FieldTypeRegistry(destination_file(FIELD_TYPES_FILE, name)),
+        dead_letters=DeadLetterFile(destination_file(DEAD_LETTER_FILE, name), max_bytes=DEAD_LETTER_MAX_BYTES),
+        max_backoff=MAX_BACKOFF,
+        guard=CardinalityGuard(MAX_FIELD_KEYS, MAX_DEVICES, allow=FIELD_ALLOW, deny=FIELD_DENY),
+        policy='fifo' if AT_LEAST_ONCE else QUEUE_POLICY, per_device=BUFFER_SIZE,
+        # Runs held across flushes would be acked before they are stored,
+        # so at-least-once mode only collapses within one write batch
+        log_compactor=LogCompactor(0 if AT_LEAST_ONCE else LOG_COLLAPSE_WINDOW) if LOG_COMPACTION else None,
+        routes=table, pool_size=INFLUX_POOL_SIZE, log_precision=config['log_precision'].lower(),
+        legacy=INFLUX_SCHEMA == 'legacy',
+        name='influx' if name == 'default' else f'influx-{name}',
+    ))
+    if ROLLUP_WINDOWS and ROLLUP_FIELDS:
+        sink.add_processor(RollupProcessor(ROLLUP_FIELDS, ROLLUP_WINDOWS, grace=WRITE_INTERVAL))
+    if REBOOT_EVENTS:
+        sink.add_processor(RebootProcessor())
+    if RATE_COUNTERS:
+        sink.add_processor(CounterRateProcessor(RATE_COUNTERS))
+    if ANOMALY_DETECTION:
+        sink.add_processor(AnomalyProcessor(ANOMALY_FIELDS, ANOMALY_COUNTERS, z=ANOMALY_Z,
+                                            window=ANOMALY_WINDOW, leak_per_hour=LEAK_PER_HOUR))
+    print(f"InfluxDB sink '{sink.name}' enabled. Target bucket: {config['bucket']}")
+    return sink
+
+
+state = None
+if 'influx' in INGEST_SINKS:
+    for name, settings in destinations.items():
+        if name not in routes:
+            print(f"Destination '{name}' has no routes, skipping it.")
+            continue
+        influx = add_influx_sink(name, settings, routes[name])
+        if AT_LEAST_ONCE and core.acks is None:
+            if influx.write_api is None:
+                # It would take no messages, so every message would be acked unstored
+                print(f"At-least-once mode needs a working InfluxDB client on '{influx.name}', exiting.")
+                sys.exit(1)
+            # Acks follow the first destination; messages it does not take are acked at once
+            core.acks = AckWindow(ACK_WINDOW, influx)
+            print(f"At-least-once mode: QoS 1, persistent session, ack window {ACK_WINDOW} on '{influx.name}'")
+if 'state' in INGEST_SINKS:
+    state = core.add_sink(DeviceStateSink(queue_size=QUEUE_SIZE, policy=QUEUE_POLICY, per_device=BUFFER_SIZE))
+if 'archive' in INGEST_SINKS:
+    core.add_sink(JsonlArchiveSink(ARCHIVE_DIR, queue_size=QUEUE_SIZE, raw=ARCHIVE_RAW))
+if 'remote_write' in INGEST_SINKS:
+    core.add_sink(RemoteWriteSink(
+        REMOTE_WRITE_URL, job=REMOTE_WRITE_JOB,
+        batch_size=REMOTE_WRITE_BATCH, flush_interval=REMOTE_WRITE_INTERVAL,
+        max_retries=REMOTE_WRITE_RETRIES, queue_size=QUEUE_SIZE,
+        policy=QUEUE_POLICY, per_device=BUFFER_SIZE,
+    ))
+    print(f"Prometheus remote-write sink enabled. Target: {REMOTE_WRITE_URL}")
+
+# /anomalies shows the detector of the first destination
+anomalies = next((p for sink in core.sinks for p in getattr(sink, 'processors', [])
+                  if isinstance(p, AnomalyProcessor)), None)
+app = create_app(core, state, online_ttl=ONLINE_TTL, debug=DEBUG_ENDPOINTS, anomalies=anomalies)
 
 if __name__ == '__main__':
-    # Install dependencies check
-    try:
-        import paho.mqtt
-        import flask
-        import influxdb_client 
-    except ImportError:
-        import pip
-        print("Installing dependencies: paho-mqtt, flask, influxdb-client")
-        pip.main(['install', 'paho-mqtt', 'flask', 'influxdb-client'])
-        
-    buffer.clear()
-    
-    # Start the MQTT thread
-    threading.Thread(target=mqtt_thread, daemon=True).start()
-    
-    # Start the InfluxDB writer thread
-    threading.Thread(target=influxdb_writer_thread, daemon=True).start() 
-    
-    # Start the Flask app
-    app.run(host='0.0.0.0', port=HTTP_PORT)
-import json
-import threading
-import time
-from collections import deque
-from flask import Flask, jsonify
-import paho.mqtt.client as mqtt
-import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
-from influxdb_client import Point, WritePrecision
-from datetime import datetime, timezone 
-
-# --- Configuration ---
-MQTT_BROKER = 'lightinator.de'
-MQTT_PORT = 1883
-MQTT_USER = 'rgbww'
-MQTT_PASS = 'rgbwwdebug'
-# Multi-level wildcard topic pattern
-MQTT_TOPIC = 'rgbww/+/monitor' 
-BUFFER_SIZE = 10
-HTTP_PORT = 8001
-
-# --- InfluxDB Configuration ---
-# ----------------------------------------------------------------------
-INFLUX_URL = 'http://127.0.0.1:8086' # <-- SET YOUR INFLUXDB URL
-INFLUX_ORG = 'default'         # <-- SET YOUR INFLUXDB ORG ID
-INFLUX_BUCKET = 'rgbww'
-INFLUX_TOKEN = '0O3MlXDBJC_92vr50FjIgnCYpKKsf8woe1_WOf8iGY5BZWTiDWVIKCRDGx9JRTucZ-2JWLJfjgK0HeTHQDdXNA==' # <-- SET YOUR INFLUXDB ACCESS TOKEN
-WRITE_INTERVAL = 5                 # Seconds between write attempts
-# ----------------------------------------------------------------------
-
-# Buffer: single global queue of messages
-buffer = deque(maxlen=BUFFER_SIZE * 100)
-
-app = Flask(__name__)
-
-# --- InfluxDB Client Setup ---
-INFLUX_WRITE_API = None
-try:
-    INFLUX_CLIENT = influxdb_client.InfluxDBClient(
-        url=INFLUX_URL, 
-        token=INFLUX_TOKEN, 
-        org=INFLUX_ORG
-    )
-    # Use SYNCHRONOUS mode for simpler error handling
-    INFLUX_WRITE_API = INFLUX_CLIENT.write_api(write_options=SYNCHRONOUS)
-    print("InfluxDB client initialized successfully.")
-except Exception as e:
-    print(f"Error initializing InfluxDB client: {e}. Please check your URL, Token, and Org. Write functionality disabled.")
+    # Starts the sink workers and the MQTT thread
+    core.start()
+    # docker stop sends SIGTERM, which skips the sinks' exit flush unless turned into an exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-
-# --- JSON FLATTENING FUNCTION ---
-def flatten_json(y):
-    """
-    Recursively flattens a nested dictionary.
-    Keys are joined by an underscore (e.g., 'parent_child').
-    """
-    out = {}
-
-    def flatten(x, name=''):
-        if isinstance(x, dict):
-            for a in x:
-                flatten(x[a], name + a + '_')
-        elif isinstance(x, list):
-            # Skip lists as they are not easily mapped to InfluxDB fields
-            print(f"Warning: Skipping list field at key: {name.strip('_')}")
-            pass 
-        else:
-            out[name[:-1]] = x
-
-    flatten(y)
-    return out
-
-
-@app.route('/metrics.json')
-def metrics():
-    """Flask endpoint to view buffered messages."""
-    filtered = [msg for msg in list(buffer) if isinstance(msg, dict) and 'id' in msg]
-    return jsonify({"devices": filtered})
-
-# --- MQTT Functions ---
-def on_connect(client, userdata, flags, rc):
-    """Callback for when the client connects to the MQTT broker."""
-    print('Connected to MQTT broker')
-    print(f'Subscribing to topic pattern: {MQTT_TOPIC}')
-    result, mid = client.subscribe(MQTT_TOPIC)
-    print(f'Subscribe result: {result}, message id: {mid}')
-
-def on_message(client, userdata, msg):
-    """Callback for when a message is received from the MQTT broker."""
-    try:
-        payload = json.loads(msg.payload.decode())
-        buffer.append(payload)
-    except Exception as e:
-        print(f'Error processing message: {e}')
-
-def mqtt_thread():
-    """Runs the MQTT client loop and periodically publishes bridge status."""
-    client = mqtt.Client(client_id="mqtt_json_bridge")
-    client.username_pw_set(MQTT_USER, MQTT_PASS)
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(MQTT_BROKER, MQTT_PORT)
-
-    def publish_status():
-        while True:
-            status = {
-                'messages_received': len(buffer),
-                'devices': len(set(msg.get('deviceid', msg.get('id')) for msg in buffer)),
-                'messages_queued': {}
-            }
-            # Publish to a neutral topic to avoid loops
-            client.publish('bridge/status', json.dumps(status), qos=0, retain=False)
-            time.sleep(10)
-
-    threading.Thread(target=publish_status, daemon=True).start()
-    client.loop_forever()
-
-
-# --- INFLUXDB WRITER THREAD (WITH STRICT INTEGER ENFORCEMENT) ---
-def influxdb_writer_thread():
-    """Pulls messages from the buffer, FLATTENS, converts to InfluxDB Points, and writes them."""
-    if not INFLUX_WRITE_API:
-        print("InfluxDB Write API is not available. Writer thread exiting.")
-        return
-
-    # --- THIS IS THE CRITICAL FIX FOR YOUR SCHEMA ---
-    # List of field keys that MUST be stored as integers in InfluxDB
-    INTEGER_ONLY_FIELDS = ['uptime', 'freeHeap', 'id', 'time', 'mdns_received', 'mdns_replies']
-    
-    print(f"Starting InfluxDB writer thread. Target bucket: {INFLUX_BUCKET}")
-    while True:
-        messages_to_process = [] 
-        
-        try:
-            if not buffer:
-                time.sleep(WRITE_INTERVAL)
-                continue
-
-            # Safely extract all messages currently in the buffer
-            while buffer:
-                 messages_to_process.append(buffer.popleft()) 
-
-            # 1. Flatten and Convert to InfluxDB Point objects
-            points = []
-            for message in messages_to_process:
-                # Flatten the JSON message to handle nested objects
-                flattened_message = flatten_json(message)
-                
-                device_id_raw = flattened_message.get('id', flattened_message.get('deviceid'))
-                try:
-                    device_id = int(device_id_raw)
-                except (ValueError, TypeError):
-                    continue
-
-                # The MEASUREMENT IS DEFINED HERE: rgbww_light_state
-                point = Point("rgbww_debug_data").tag("device", device_id)
-                
-                # Iterate over the FLATTENED message
-                for key, value in flattened_message.items():
-                    # Skip common base metadata keys
-                    if key in ['id', 'deviceid', 'time', 'mac', 'timestamp_ms']: 
-                        continue
-
-                    # --- Robust Type Casting Logic ---
-                    converted_value = None
-                    
-                    try:
-                        # Check if the value is numerical or can be converted to numerical
-                        if isinstance(value, (int, float)):
-                            float_val = float(value)
-                        elif isinstance(value, str) and (value.replace('.', '', 1).isdigit() and value.count('.') < 2):
-                            # This handles "123" and "123.45" but not "1.2.3"
-                            float_val = float(value)
-                        else:
-                            # Not numerical, use original value (e.g., string, boolean)
-                            converted_value = value
-                            
-                        # If we successfully got a float_val, apply conversion rules
-                        if converted_value is None:
-                            if key in INTEGER_ONLY_FIELDS:
-                                # Cast to int for fields like uptime
-                                converted_value = int(float_val)
-                            else:
-                                # Otherwise, use the float value
-                                converted_value = float_val
-                                
-                    except ValueError:
-                        # If any part of the conversion failed, skip the field
-                        continue 
-                        
-                    point.field(key, converted_value)
-                
-                if point._fields: 
-                    # Use nanosecond precision
-                    point.time(time=datetime.now(timezone.utc), write_precision=WritePrecision.NS)
-                    points.append(point)
-
-            if not points:
-                # No valid data to write
-                messages_to_process.clear() 
-                time.sleep(WRITE_INTERVAL)
-                continue
-            
-            # 2. Write the points
-            print(f"Attempting to write {len(points)} points to InfluxDB...")
-            INFLUX_WRITE_API.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=points)
-            
-            print(f"Successfully wrote {len(points)} points to InfluxDB.")
-            messages_to_process.clear()
-
-        except influxdb_client.rest.ApiException as api_e:
-            print(f"InfluxDB API Error: Status {api_e.status}. Reason: {api_e.reason}. Body: {api_e.body}")
-            if api_e.status == 401:
-                 print("!!! AUTHENTICATION ERROR (401). Check INFLUX_TOKEN, ORG, and URL in configuration. !!!")
-            
-        except Exception as e:
-            print(f"Unexpected error in InfluxDB writer thread: {e}")
-            
-        finally:
-            # Re-add any messages that failed the write attempt back to the buffer
-            for msg in messages_to_process:
-                buffer.appendleft(msg) 
-                
-            time.sleep(WRITE_INTERVAL)
-
-if __name__ == '__main__':
-    # Install dependencies check
-    try:
-        import paho.mqtt
-        import flask
-        import influxdb_client 
-    except ImportError:
-        import pip
-        print("Installing dependencies: paho-mqtt, flask, influxdb-client")
-        pip.main(['install', 'paho-mqtt', 'flask', 'influxdb-client'])
-        
-    buffer.clear()
-    
-    # Start the MQTT thread
-    threading.Thread(target=mqtt_thread, daemon=True).start()
-    
-    # Start the InfluxDB writer thread
-    threading.Thread(target=influxdb_writer_thread, daemon=True).start() 
-    
     # Start the Flask app
     app.run(host='0.0.0.0', port=HTTP_PORT)
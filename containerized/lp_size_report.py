@@ -0,0 +1,72 @@
+"""
+Measures how many bytes a batch of line protocol costs on the wire with the
+importer's write options: timestamp precision, gzip and series ordering.
+
+Usage: python lp_size_report.py [test.lp] [log.txt] ...
+
+.lp files are read line by line; any other file is scanned for the
+'Writing point: <line>' debug output the importers print.
+"""
+import gzip
+import sys
+
+PRECISION_DIVISORS = {'ns': 1, 'us': 10**3, 'ms': 10**6, 's': 10**9}
+LOG_MARKER = 'Writing point: '
+
+
+def load_lines(path):
+    """Returns the line-protocol records contained in a sample file."""
+    lines = []
+    with open(path) as f:
+        for raw in f:
+            if path.endswith('.lp'):
+                line = raw.strip()
+            elif LOG_MARKER in raw:
+                line = raw.split(LOG_MARKER, 1)[1].strip()
+            else:
+                continue
+            if line and not line.startswith('#'):
+                lines.append(line)
+    return lines
+
+
+def with_precision(line, precision):
+    """Rewrites the trailing nanosecond timestamp of a line to the given precision."""
+    head, _, ts = line.rpartition(' ')
+    if not ts.isdigit():
+        return line
+    return f"{head} {int(ts) // PRECISION_DIVISORS[precision]}"
+
+
+def series_order(lines):
+    """Stable sort by series key (measurement + tags), keeping time order within a series."""
+    return sorted(lines, key=lambda line: line.split(' ', 1)[0])
+
+
+def body(lines):
+    return ('\n'.join(lines)).encode()
+
+
+def report(path):
+    lines = load_lines(path)
+    if not lines:
+        print(f"{path}: no line protocol found")
+        return
+    baseline = len(body(lines))
+    variants = [
+        ('ns, plain (current)', body(lines)),
+        ('ms, plain', body([with_precision(l, 'ms') for l in lines])),
+        ('s, plain', body([with_precision(l, 's') for l in lines])),
+        ('ns, gzip', gzip.compress(body(lines))),
+        ('s, gzip', gzip.compress(body([with_precision(l, 's') for l in lines]))),
+        ('s, gzip, series order', gzip.compress(body(series_order([with_precision(l, 's') for l in lines])))),
+    ]
+    print(f"{path}: {len(lines)} points")
+    for name, data in variants:
+        saved = 100.0 * (baseline - len(data)) / baseline
+        print(f"  {name:<24} {len(data):>9} bytes  {len(data) / len(lines):7.1f} B/point  {saved:5.1f}% saved")
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or ['test.lp', 'log.txt']:
+        report(path)
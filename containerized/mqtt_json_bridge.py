@@ -1,82 +1,73 @@
-import json
-import threading
-import time
-from collections import defaultdict, deque
-from flask import Flask, jsonify
-import paho.mqtt.client as mqtt
+import os
 
-# Configuration
-MQTT_BROKER = 'lightinator.de'
-MQTT_PORT = 1883
-MQTT_USER = 'rgbww'  # <-- set your username
-MQTT_PASS = 'rgbwwdebug'  # <-- set your password
-MQTT_TOPIC = 'rgbww/#'
-BUFFER_SIZE = 10  # Number of messages to buffer per device
-HTTP_PORT = 8001
-
-
-# Buffer: single global queue of messages
-buffer = deque(maxlen=BUFFER_SIZE * 100)  # 100 devices * 10 messages each
-
-app = Flask(__name__)
+from rgbww_ingest import DeviceStateSink, IngestCore
+from rgbww_ingest.discovery import DiscoverySink
+from rgbww_ingest.history import HistorySink
+from rgbww_ingest.snapshot import StateSnapshot
+from rgbww_ingest.web import create_app
 
-@app.route('/metrics.json')
-def metrics():
-    # Only return elements that have an 'id' field (valid device messages)
-    filtered = [msg for msg in list(buffer) if isinstance(msg, dict) and 'id' in msg]
-    return jsonify({"devices": filtered})
-
-# MQTT callbacks
-def on_connect(client, userdata, flags, rc):
-    print('Connected to MQTT broker')
-    print(f'Subscribing to topic pattern: {MQTT_TOPIC}')
-    result, mid = client.subscribe(MQTT_TOPIC)
-    print(f'Subscribe result: {result}, message id: {mid}')
-
-def on_message(client, userdata, msg):
-    try:
-        print(f'Received MQTT message on topic: {msg.topic}')
-        print(f'Raw payload: {msg.payload}')
-        # Discard messages from rgbww/bridge/* topics
-        if msg.topic.startswith('rgbww/bridge'):
-            print('Discarding bridge status/config message')
-            return
-        payload = json.loads(msg.payload.decode())
-        print(f'Parsed JSON: {payload}')
-        buffer.append(payload)
-    except Exception as e:
-        print(f'Error processing message: {e}')
+# Configuration
+MQTT_BROKER = os.environ.get('MQTT_BROKER', 'lightinator.de')
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
+MQTT_USER = os.environ.get('MQTT_USER', 'rgbww')  # <-- set your username
+MQTT_PASS = os.environ.get('MQTT_PASS', 'rgbwwdebug')  # <-- set your password
+MQTT_TOPIC = os.environ.get('MQTT_BRIDGE_TOPIC', 'rgbww/#')
+MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', 'mqtt_json_bridge')
+BUFFER_SIZE = int(os.environ.get('BUFFER_SIZE', 10))  # Number of messages to buffer per device
+HTTP_PORT = int(os.environ.get('HTTP_PORT', 8001))
+QUEUE_POLICY = os.environ.get('QUEUE_POLICY', 'coalesce')  # fifo, device, coalesce or sample
+ONLINE_TTL = int(os.environ.get('ONLINE_TTL', 3600))  # Seconds a device counts as online
+SD_TTL = int(os.environ.get('SD_TTL', 600))  # Seconds a device stays in /sd after its last message
+SD_PORT = os.environ.get('SD_PORT', '')  # Port appended to device ips in /sd (empty = none)
+# In-memory history per device for /history: samples kept per device and numeric fields
+HISTORY_SIZE = int(os.environ.get('HISTORY_SIZE', 360))
+HISTORY_FIELDS = [f.strip() for f in os.environ.get('HISTORY_FIELDS', 'uptime,freeHeap,mDNS_received,mDNS_replies').split(',') if f.strip()]
+HISTORY_MAX_DEVICES = int(os.environ.get('HISTORY_MAX_DEVICES', 10000))
+# Pass-through: messages are decoded in the sink threads instead of the MQTT
+# thread, and /metrics.json splices the payload bytes as received (device ids
+# come from the topic)
+PASS_THROUGH = os.environ.get('PASS_THROUGH', 'false').lower() in ('1', 'true', 'yes')
+# Warm start: device state saved every SNAPSHOT_INTERVAL seconds and on
+# shutdown, restored at startup (empty SNAPSHOT_FILE = disabled). /app/data
+# is the bridge_data volume in docker-compose, so the file survives redeploys
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', '/app/data/bridge_state.json')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 60))
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', ONLINE_TTL))  # Older entries are not restored
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', 'false').lower() in ('1', 'true', 'yes')  # /debug/profile and /debug/heap/*
 
-def mqtt_thread():
-    client = mqtt.Client(client_id="mqtt_json_bridge")
-    client.username_pw_set(MQTT_USER, MQTT_PASS)
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(MQTT_BROKER, MQTT_PORT)
+core = IngestCore(
+    MQTT_BROKER, MQTT_PORT, MQTT_USER, MQTT_PASS,
+    topics=[MQTT_TOPIC],
+    client_id=MQTT_CLIENT_ID,
+    # Discard messages from rgbww/bridge/* topics
+    ignore_prefixes=('rgbww/bridge',),
+    lazy=PASS_THROUGH,
+)
+state = core.add_sink(DeviceStateSink(queue_size=BUFFER_SIZE * 100, policy=QUEUE_POLICY, per_device=BUFFER_SIZE,
+                                     keep_raw=PASS_THROUGH))
+discovery = core.add_sink(DiscoverySink(
+    ttl=SD_TTL, port=SD_PORT or None,
+    queue_size=BUFFER_SIZE * 100, policy=QUEUE_POLICY, per_device=BUFFER_SIZE,
+))
+history = None
+if HISTORY_SIZE and HISTORY_FIELDS:
+    history = core.add_sink(HistorySink(
+        HISTORY_FIELDS, size=HISTORY_SIZE, max_devices=HISTORY_MAX_DEVICES,
+        queue_size=BUFFER_SIZE * 100, policy=QUEUE_POLICY, per_device=BUFFER_SIZE,
+    ))
 
-    def publish_status():
-        while True:
-            status = {
-                'messages_received': len(buffer),
-                'devices': len(set(msg.get('deviceid', msg.get('id')) for msg in buffer)),
-                'messages_queued': {}
-            }
-            # Only publish to 'bridge/status', never to 'rgbww/bridge/status'
-            client.publish('bridge/status', json.dumps(status), qos=0, retain=False)
-            time.sleep(10)
+app = create_app(core, state, online_ttl=ONLINE_TTL, discovery=discovery, debug=DEBUG_ENDPOINTS, history=history,
+                 passthrough=PASS_THROUGH)
 
-    threading.Thread(target=publish_status, daemon=True).start()
-    client.loop_forever()
+snapshot = None
+if SNAPSHOT_FILE:
+    snapshot = StateSnapshot(SNAPSHOT_FILE, state, discovery=discovery,
+                             interval=SNAPSHOT_INTERVAL, max_age=SNAPSHOT_MAX_AGE)
 
 if __name__ == '__main__':
-    buffer.clear()  # Clear buffer to remove any old status/config messages
-    threading.Thread(target=mqtt_thread, daemon=True).start()
+    if snapshot is not None:
+        # Before the MQTT client starts, so live messages win over restored ones
+        snapshot.restore()
+        snapshot.start()
+    core.start()
     app.run(host='0.0.0.0', port=HTTP_PORT)
-
-# Install dependencies
-try:
-    import paho.mqtt
-    import flask
-except ImportError:
-    import pip
-    pip.main(['install', 'paho-mqtt', 'flask'])
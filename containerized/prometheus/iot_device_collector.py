@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Concurrent metadata collector for manage-iot-devices.sh.
+
+Fetches /info, /config and /hosts from many controllers at once instead of
+one curl at a time, so a few offline devices no longer stall a refresh for
+minutes. Results are cached in iot-device-metadata.json: devices fetched
+within the refresh TTL are not asked again. The metadata, the device list,
+prometheus.yml and the device_name_info textfile are each written once per
+run through a temp file and rename.
+
+Usage:
+  iot_device_collector.py refresh [--force]      # devices in iot-devices.txt
+  iot_device_collector.py discover [seed ...]    # crawl /hosts from the seeds
+                                                 # and all known devices
+
+Discovery also asks cached devices for /hosts and queries newly listed
+devices during the same crawl.
+
+Devices may be given as ip or ip:port, which makes it possible to run the
+collector against local stub servers (see iot_device_stub.py).
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PROMETHEUS_DIR = os.environ.get('PROMETHEUS_DIR', '/etc/prometheus')
+PROMETHEUS_CONFIG = os.path.join(PROMETHEUS_DIR, 'prometheus.yml')
+PROMETHEUS_TEMPLATE = os.path.join(PROMETHEUS_DIR, 'prometheus.yml.template')
+DEVICES_FILE = os.path.join(PROMETHEUS_DIR, 'iot-devices.txt')
+DEVICE_METADATA = os.path.join(PROMETHEUS_DIR, 'iot-device-metadata.json')
+
+# Parallel devices; the controllers themselves only serve one request at a time
+CONCURRENCY = int(os.environ.get('IOT_CONCURRENCY', 32))
+# Seconds for connecting to and reading one endpoint of one device
+TIMEOUT = float(os.environ.get('IOT_TIMEOUT', 5))
+# Metadata younger than this many seconds is taken from the cache
+REFRESH_TTL = int(os.environ.get('IOT_REFRESH_TTL', 1500))
+# Same safety limit as the shell crawler
+MAX_ROUNDS = 10
+MAX_BODY = 256 * 1024
+
+
+def first(data, *paths):
+    """Like jq's 'a // b // c': the first path that is neither missing, null nor false."""
+    for path in paths:
+        value = data
+        for key in path.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None and value is not False:
+            return str(value)
+    return None
+
+
+async def fetch_json(host, path, timeout):
+    """GETs http://<host><path> and returns the decoded JSON, or None."""
+    name, _, port = host.partition(':')
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(name, int(port or 80)), timeout)
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        response = b''
+        while len(response) < MAX_BODY:
+            chunk = await asyncio.wait_for(reader.read(MAX_BODY), timeout)
+            if not chunk:
+                break
+            response += chunk
+    except (OSError, asyncio.TimeoutError, ValueError):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = head.split(b' ', 2)
+    if len(status) < 2 or status[1] != b'200':
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+async def collect_device(host, semaphore, timeout):
+    """Fetches the three endpoints of one device one after the other."""
+    async with semaphore:
+        info = await fetch_json(host, '/info', timeout)
+        if info is None:
+            # Offline or not a controller; don't wait for two more timeouts
+            return host, None, None, None
+        config = await fetch_json(host, '/config', timeout)
+        hosts = await fetch_json(host, '/hosts', timeout)
+        return host, info, config, hosts
+
+
+def to_entry(info, config, previous):
+    """Builds the metadata entry of a device in the format of the shell script."""
+    info = info if isinstance(info, dict) else {}
+    config = config if isinstance(config, dict) else {}
+    now = time.time()
+    entry = dict(previous or {})
+    entry.update({
+        'device_name': (first(config, 'general.device_name', 'network.mdns.name', 'device_name', 'name', 'hostname')
+                        or first(info, 'device_name', 'name', 'hostname') or 'unknown'),
+        'deviceid': first(info, 'deviceid') or 'unknown',
+        'ip_address': first(config, 'network.connection.ip', 'connection.ip') or 'unknown',
+        'refreshed_date': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now)),
+        'fetched_at': int(now),
+        'online': True,
+    })
+    entry['hostname'] = entry['device_name']
+    entry.pop('last_error', None)
+    return entry
+
+
+def visible_hosts(hosts):
+    """The ip addresses a device lists as visible in /hosts."""
+    if not isinstance(hosts, dict):
+        return []
+    return sorted({
+        str(h['ip_address']) for h in hosts.get('hosts') or []
+        if isinstance(h, dict) and h.get('visible') is True and h.get('ip_address')
+    })
+
+
+def is_fresh(entry, ttl):
+    return bool(entry) and entry.get('online') and time.time() - entry.get('fetched_at', 0) < ttl
+
+
+class Collector:
+
+    def __init__(self, metadata, concurrency=CONCURRENCY, timeout=TIMEOUT, ttl=REFRESH_TTL):
+        self.metadata = metadata
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.ttl = ttl
+        # host -> hosts listed in its /hosts during this run (not cached, it grows
+        # with the square of the fleet)
+        self.neighbours = {}
+        self.fetched = 0
+        self.cached = 0
+        self.failed = 0
+
+    def record(self, host, info, config, neighbours):
+        """Stores the result of collect_device in self.metadata."""
+        previous = self.metadata.get(host)
+        if info is None:
+            self.failed += 1
+            entry = dict(previous or {'device_name': 'unknown', 'deviceid': 'unknown'})
+            entry['online'] = False
+            entry['last_error'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+            self.metadata[host] = entry
+            print(f"  {host}: no response")
+            return
+        self.fetched += 1
+        self.neighbours[host] = visible_hosts(neighbours)
+        self.metadata[host] = to_entry(info, config, previous)
+        entry = self.metadata[host]
+        print(f"  {host} -> {entry['device_name']} (ID: {entry['deviceid']}, IP: {entry['ip_address']})")
+
+    async def refresh(self, hosts):
+        """Refreshes every stale host concurrently and updates self.metadata."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stale = []
+        for host in hosts:
+            if is_fresh(self.metadata.get(host), self.ttl):
+                self.cached += 1
+            else:
+                stale.append(host)
+        for result in await asyncio.gather(*(collect_device(h, semaphore, self.timeout) for h in stale)):
+            self.record(*result)
+
+    async def visit(self, host, semaphore):
+        """Refreshes one host if stale and returns the hosts it lists as visible."""
+        if is_fresh(self.metadata.get(host), self.ttl):
+            # Only /hosts, so neighbours of cached devices are found in this crawl
+            self.cached += 1
+            async with semaphore:
+                self.neighbours[host] = visible_hosts(await fetch_json(host, '/hosts', self.timeout))
+        else:
+            self.record(*await collect_device(host, semaphore, self.timeout))
+        return self.neighbours.get(host, [])
+
+    async def discover(self, seeds):
+        """
+        Crawls /hosts from the seeds; returns every host that was queried.
+        Neighbours are queued as soon as the device listing them answers, so
+        one slow device does not hold back the rest of its round. The round
+        of a device is its distance from the seeds, at most MAX_ROUNDS.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        queue = asyncio.Queue()
+        # host -> discovery round, in the order the hosts were found
+        rounds = {}
+        truncated = []
+
+        def enqueue(host, round_no):
+            if host not in rounds:
+                rounds[host] = round_no
+                queue.put_nowait(host)
+
+        async def worker():
+            while True:
+                host = await queue.get()
+                try:
+                    round_no = rounds[host]
+                    neighbours = await self.visit(host, semaphore)
+                    self.metadata[host].setdefault('discovery_round', round_no)
+                    for neighbour in neighbours:
+                        if round_no < MAX_ROUNDS:
+                            enqueue(neighbour, round_no + 1)
+                        elif neighbour not in rounds:
+                            truncated.append(neighbour)
+                finally:
+                    queue.task_done()
+
+        for seed in seeds:
+            enqueue(seed, 1)
+        print(f"=== Discovery: {len(rounds)} seeds ===")
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        await queue.join()
+        for task in workers:
+            task.cancel()
+        if truncated:
+            print(f"  Stopping after {MAX_ROUNDS} rounds to prevent infinite loops")
+        print(f"  Found {len(rounds)} devices in {max(rounds.values(), default=0)} rounds")
+        return list(rounds)
+
+
+# --- Output files ---
+def atomic_write(path, text):
+    """Writes text to a temp file next to path and renames it into place."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def render_config(template, devices, metadata):
+    """Fills ##IOT_DEVICES## and ##DEVICE_RELABELS## like update_prometheus_config."""
+    relabels = [
+        "      # Device metadata relabeling (auto-generated from device discovery)",
+        "      # Map IP addresses to device names and IDs",
+    ]
+    for label, key in (('device_name', 'device_name'), ('device_id', 'deviceid')):
+        if label == 'device_id':
+            relabels += ["", "      # Map IP addresses to device IDs (primary identifier)"]
+        for ip, entry in metadata.items():
+            relabels += [
+                "      - source_labels: [instance]",
+                f"        regex: {ip}",
+                f"        target_label: {label}",
+                f"        replacement: {entry.get(key) or 'unknown'}",
+            ]
+    out = []
+    for line in template.splitlines():
+        if line == '##IOT_DEVICES##':
+            out += [f"        - {device}" for device in devices]
+        elif line == '##DEVICE_RELABELS##':
+            out += relabels
+        else:
+            out.append(line)
+    return '\n'.join(out) + '\n'
+
+
+def render_textfile(metadata):
+    lines = [
+        f'device_name_info{{deviceid="{e["deviceid"]}",device_name="{e["device_name"]}",ip="{ip}"}} 1'
+        for ip, e in metadata.items()
+        if e.get('deviceid', 'unknown') != 'unknown' and e.get('device_name', 'unknown') != 'unknown'
+    ]
+    return ''.join(line + '\n' for line in lines)
+
+
+def write_config(text, validate=True):
+    """Writes prometheus.yml, refusing a config promtool rejects."""
+    if validate and shutil.which('promtool'):
+        fd, tmp = tempfile.mkstemp(suffix='.yml', dir=PROMETHEUS_DIR)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            check = subprocess.run(['promtool', 'check', 'config', tmp], capture_output=True, text=True)
+        finally:
+            os.remove(tmp)
+        if check.returncode != 0:
+            print("ERROR: Configuration validation failed, keeping the current prometheus.yml")
+            print(check.stdout + check.stderr)
+            return False
+    atomic_write(PROMETHEUS_CONFIG, text)
+    return True
+
+
+def load_metadata():
+    try:
+        with open(DEVICE_METADATA) as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def load_devices():
+    try:
+        with open(DEVICES_FILE) as f:
+            return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    except OSError:
+        return []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=('refresh', 'discover'))
+    parser.add_argument('seeds', nargs='*', help='discover: devices to start crawling from')
+    parser.add_argument('--force', action='store_true', help='ignore the metadata cache')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--ttl', type=int, default=REFRESH_TTL)
+    parser.add_argument('--textfile', help='also write device_name_info metrics to this file')
+    parser.add_argument('--no-validate', action='store_true', help='skip promtool check config')
+    args = parser.parse_args(argv)
+
+    metadata = load_metadata()
+    devices = load_devices()
+    collector = Collector(metadata, args.concurrency, args.timeout, 0 if args.force else args.ttl)
+    started = time.time()
+
+    if args.command == 'discover':
+        seeds = args.seeds + devices
+        if not seeds:
+            print("Usage: iot_device_collector.py discover <device_ip> (or add at least one device first)")
+            return 1
+        devices = sorted(set(asyncio.run(collector.discover(seeds))))
+    else:
+        if not devices:
+            print("No devices configured. Run discover first.")
+            return 1
+        asyncio.run(collector.refresh(devices))
+        # Devices removed from the list also leave the metadata
+        for host in list(metadata):
+            if host not in devices:
+                del metadata[host]
+
+    print(f"{len(devices)} devices: {collector.fetched} fetched, {collector.cached} cached, "
+          f"{collector.failed} unreachable in {time.time() - started:.1f}s")
+
+    atomic_write(DEVICE_METADATA, json.dumps(metadata, indent=2) + '\n')
+    atomic_write(DEVICES_FILE, ''.join(d + '\n' for d in devices))
+    if args.textfile:
+        atomic_write(args.textfile, render_textfile(metadata))
+    if not os.path.exists(PROMETHEUS_TEMPLATE):
+        print(f"Template file not found: {PROMETHEUS_TEMPLATE}")
+        return 1
+    with open(PROMETHEUS_TEMPLATE) as f:
+        template = f.read()
+    if not write_config(render_config(template, devices, metadata), validate=not args.no_validate):
+        return 1
+    print(f"Prometheus configuration updated with {len(devices)} IoT devices")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Stub controllers for testing iot_device_collector.py without hardware.
+
+Usage: iot_device_stub.py [count] [base_port] [delay] [offline]
+
+Starts count HTTP servers on 127.0.0.1:base_port... that answer /info,
+/config and /hosts like a controller. Every device lists all others in
+/hosts as 127.0.0.1:<port>. Each response is delayed by delay seconds,
+and the last `offline` devices are listed but never started.
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+BASE_PORT = int(sys.argv[2]) if len(sys.argv) > 2 else 18000
+DELAY = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+OFFLINE = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+
+
+def make_handler(index):
+    port = BASE_PORT + index
+    documents = {
+        '/info': {'deviceid': f'{0x100000 + index}', 'firmware': {'fw_version': 'stub'}},
+        '/config': {'general': {'device_name': f'stub-{index}'},
+                    'network': {'connection': {'ip': f'127.0.0.1:{port}'}}},
+        '/hosts': {'hosts': [{'ip_address': f'127.0.0.1:{BASE_PORT + i}', 'visible': True}
+                             for i in range(COUNT) if i != index]},
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            time.sleep(DELAY)
+            document = documents.get(self.path)
+            body = json.dumps(document).encode()
+            self.send_response(200 if document is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    for index in range(COUNT - OFFLINE):
+        server = ThreadingHTTPServer(('127.0.0.1', BASE_PORT + index), make_handler(index))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{COUNT - OFFLINE} stub devices on 127.0.0.1:{BASE_PORT}-{BASE_PORT + COUNT - OFFLINE - 1}, "
+          f"{OFFLINE} listed but offline")
+    threading.Event().wait()
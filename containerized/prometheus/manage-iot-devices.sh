@@ -7,6 +7,8 @@ PROMETHEUS_CONFIG="/etc/prometheus/prometheus.yml"
 PROMETHEUS_TEMPLATE="/etc/prometheus/prometheus.yml.template"
 DEVICES_FILE="/etc/prometheus/iot-devices.txt"
 DEVICE_METADATA="/etc/prometheus/iot-device-metadata.json"
+# Concurrent collector used for discover/refresh when python3 is available
+COLLECTOR="/etc/prometheus/iot_device_collector.py"
 
 # Function to add a device
 add_device() {
@@ -287,6 +289,12 @@ scan_network() {
 # Function to discover all devices from network topology
 discover_devices() {
     local discovery_ip="$1"
+
+    if [ -f "$COLLECTOR" ] && command -v python3 >/dev/null 2>&1; then
+        python3 "$COLLECTOR" discover $discovery_ip || return 1
+        list_devices
+        return 0
+    fi
     
     # If no IP provided, try to find a suitable seed device from existing devices
     if [ -z "$discovery_ip" ] && [ -f "$DEVICES_FILE" ]; then
@@ -468,6 +476,11 @@ refresh_metadata() {
         echo "No devices configured. Run discover first."
         return 1
     fi
+
+    if [ -f "$COLLECTOR" ] && command -v python3 >/dev/null 2>&1; then
+        python3 "$COLLECTOR" refresh --textfile /etc/prometheus/textfile_collector/device_name_info.prom
+        return $?
+    fi
     
     echo "Refreshing metadata for existing devices..."
     
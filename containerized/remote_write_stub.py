@@ -0,0 +1,57 @@
+"""
+Minimal Prometheus remote-write receiver for testing the importer's
+remote_write sink without a Prometheus server.
+
+Usage: python remote_write_stub.py [port] [status]
+
+Listens on /api/v1/write, decodes every request and prints the series it
+contained. The optional status (default 204) is returned to every request,
+e.g. 503 to watch the sink retry or 400 to watch it drop.
+"""
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rgbww_ingest.remote_write import decode_write_request, snappy_decompress
+
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 9201
+STATUS = int(sys.argv[2]) if len(sys.argv) > 2 else 204
+
+totals = {'requests': 0, 'series': 0, 'samples': 0}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/api/v1/write':
+            self.send_response(404)
+            self.end_headers()
+            return
+        try:
+            if self.headers.get('Content-Encoding') == 'snappy':
+                body = snappy_decompress(body)
+            series = decode_write_request(body)
+        except (ValueError, IndexError) as e:
+            print(f"Undecodable request: {e}")
+            self.send_response(400)
+            self.end_headers()
+            return
+        totals['requests'] += 1
+        totals['series'] += len(series)
+        for labels, samples in series:
+            totals['samples'] += len(samples)
+            name = labels.pop('__name__', '')
+            label_str = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+            for timestamp_ms, value in samples:
+                print(f"{name}{{{label_str}}} {value:g} {timestamp_ms}")
+        print(f"Totals: {totals}")
+        self.send_response(STATUS)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    print(f"Remote-write stub listening on :{PORT}/api/v1/write (answering {STATUS})")
+    ThreadingHTTPServer(('0.0.0.0', PORT), Handler).serve_forever()
@@ -0,0 +1,21 @@
+"""
+Shared ingest core for the rgbww MQTT importer, bridge and archiver.
+
+The InfluxDB sink (rgbww_ingest.influx) and the HTTP endpoints
+(rgbww_ingest.web) live in their own modules so that the optional
+influxdb-client and flask dependencies are only needed where they are used.
+"""
+from .archive import JsonlArchiveSink
+from .core import IngestCore, Message, Sink, parse_message
+from .flatten import flatten_json
+from .state import DeviceStateSink
+
+__all__ = [
+    'DeviceStateSink',
+    'IngestCore',
+    'JsonlArchiveSink',
+    'Message',
+    'Sink',
+    'flatten_json',
+    'parse_message',
+]
@@ -0,0 +1,111 @@
+"""
+At-least-once delivery: QoS 1 messages are acknowledged to the broker only
+after the sink that stores them (the InfluxDB sink) has committed them.
+
+The broker keeps unacknowledged messages in the persistent session and
+redelivers them after a reconnect or a restart of the importer, so nothing
+is lost while the process or InfluxDB is down. The price is possible
+duplicates: a redelivered message is stamped with its new receive time.
+
+The window bounds the unacknowledged messages. When it is half full the
+sink is woken up to commit early instead of waiting for its interval.
+Messages are handed from the MQTT callback to an intake thread, which
+waits while the window is full; the client loop keeps running, so
+keepalive pings are still answered. Withheld acks are what pushes back on
+the broker: it stops sending once its in-flight limit (mosquitto:
+max_inflight_messages) of unacknowledged messages is reached, which also
+bounds the intake backlog. That limit must be at least the window size
+or it becomes the bound instead.
+
+A message is acknowledged only once its lines were committed, dead-lettered
+or are kept for retry. A batch the sink fails to convert frees its window
+slots unacknowledged, so the broker redelivers it after a reconnect.
+"""
+import threading
+import time
+from collections import deque
+
+
+class AckWindow:
+
+    def __init__(self, size, sink):
+        self.size = size
+        self.sink = sink
+        self.inflight = 0
+        self.acked = 0
+        self.released = 0
+        self.full_waits = 0
+        self.waited = 0.0
+        self.cond = threading.Condition()
+        # (handler, args) received but not yet admitted to the window
+        self.backlog = deque()
+        self.intake = None
+        sink.acks = self
+
+    def submit(self, handler, *args):
+        """Called from the MQTT thread; handler(*args) runs in the intake thread. Never blocks."""
+        with self.cond:
+            if self.intake is None:
+                self.intake = threading.Thread(target=self.run, name='ack-intake', daemon=True)
+                self.intake.start()
+            self.backlog.append((handler, args))
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.backlog:
+                    self.cond.wait()
+                handler, args = self.backlog.popleft()
+            self.acquire()
+            handler(*args)
+
+    def acquire(self):
+        """Called from the intake thread before a message is handled; blocks while the window is full."""
+        with self.cond:
+            if self.inflight >= self.size:
+                self.full_waits += 1
+                started = time.time()
+                while self.inflight >= self.size:
+                    self.sink.wake()
+                    self.cond.wait(1)
+                self.waited += time.time() - started
+            self.inflight += 1
+            early = self.inflight >= self.size // 2
+        if early:
+            self.sink.wake()
+
+    def settle(self, tokens):
+        """Acknowledges (client, mid, qos) tokens and frees their window slots."""
+        if not tokens:
+            return
+        for client, mid, qos in tokens:
+            client.ack(mid, qos)
+        with self.cond:
+            self.inflight -= len(tokens)
+            self.acked += len(tokens)
+            self.cond.notify_all()
+
+    def release(self, tokens):
+        """
+        Frees the window slots of messages that were not stored, without
+        acknowledging them; the broker redelivers them after a reconnect.
+        """
+        if not tokens:
+            return
+        with self.cond:
+            self.inflight -= len(tokens)
+            self.released += len(tokens)
+            self.cond.notify_all()
+        print(f"{len(tokens)} messages were not stored and stay unacknowledged for redelivery")
+
+    def stats(self):
+        return {
+            'window': self.size,
+            'inflight': self.inflight,
+            'backlog': len(self.backlog),
+            'acked': self.acked,
+            'released': self.released,
+            'full_waits': self.full_waits,
+            'waited_seconds': round(self.waited, 1),
+        }
@@ -0,0 +1,258 @@
+"""
+Streaming heap-leak and anomaly detection.
+
+Every device keeps, per watched signal (freeHeap and the per-second rates
+of the mDNS counters by default), an EWMA mean and variance and a
+least-squares slope over its last `window` samples. Both are updated in
+O(1) per sample (amortized: the slope's running sums are recomputed once
+per window against rounding drift) from a fixed ring of (time, value)
+pairs, so memory per signal is 16 * window bytes.
+
+A sample more than `z` standard deviations from the EWMA mean opens a
+'spike' or 'dip' event. A full window whose freeHeap slope is below
+-leak_per_hour bytes per hour opens a 'leak' event. Only the opening and
+closing of an event is written, as an 'rgbww_anomaly' point with
+active=true/false, so the measurement stays small. The open events and
+the latest transitions are also served at /anomalies.
+"""
+import math
+import threading
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+
+from influxdb_client import Point
+
+from .influx import Processor
+from .rates import CounterRates
+from .reboot import to_int
+
+LEAK_SIGNALS = ('freeHeap',)
+
+
+class SignalStats:
+    """EWMA mean/variance and a sliding-window regression slope of one signal."""
+
+    __slots__ = ('alpha', 'count', 'mean', 'var', 'times', 'values', 'pos', 'n', 'origin',
+                 'st', 'sx', 'stt', 'stx')
+
+    def __init__(self, alpha, window):
+        self.alpha = alpha
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.times = array('d', bytes(8 * window))
+        self.values = array('d', bytes(8 * window))
+        self.reset_window()
+
+    def reset_window(self):
+        self.pos = self.n = 0
+        self.origin = None
+        self.st = self.sx = self.stt = self.stx = 0.0
+
+    def zscore(self, x, floor=0.01):
+        """
+        Deviation of x from the mean in standard deviations. The deviation is
+        at least floor * |mean|, so a signal that has been nearly constant
+        does not flag every small change.
+        """
+        std = max(math.sqrt(self.var), floor * abs(self.mean))
+        if std <= 0:
+            return 0.0
+        return (x - self.mean) / std
+
+    def update(self, t, x):
+        if self.count == 0:
+            self.mean = x
+        else:
+            diff = x - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.count += 1
+
+        # Times relative to the first sample of the window keep the sums small
+        if self.origin is None:
+            self.origin = t
+        t -= self.origin
+        size = len(self.times)
+        if self.n == size:
+            old_t, old_x = self.times[self.pos], self.values[self.pos]
+            self.st -= old_t
+            self.sx -= old_x
+            self.stt -= old_t * old_t
+            self.stx -= old_t * old_x
+        else:
+            self.n += 1
+        self.times[self.pos] = t
+        self.values[self.pos] = x
+        self.pos = (self.pos + 1) % size
+        if self.pos == 0 and self.n == size:
+            self.rebase()
+        else:
+            self.st += t
+            self.sx += x
+            self.stt += t * t
+            self.stx += t * x
+
+    def rebase(self):
+        """
+        Once per window: moves the origin to the oldest sample and recomputes
+        the sums, so rounding errors of the running updates cannot build up.
+        """
+        shift = self.times[self.pos]
+        self.origin += shift
+        self.st = self.sx = self.stt = self.stx = 0.0
+        for i in range(self.n):
+            t = self.times[i] - shift
+            self.times[i] = t
+            x = self.values[i]
+            self.st += t
+            self.sx += x
+            self.stt += t * t
+            self.stx += t * x
+
+    def full(self):
+        return self.n == len(self.times)
+
+    def slope(self):
+        """Least-squares slope per second over the window, None with fewer than 2 samples."""
+        n = self.n
+        denominator = n * self.stt - self.st * self.st
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self.stx - self.st * self.sx) / denominator
+
+
+class AnomalyProcessor(Processor):
+
+    name = 'anomalies'
+
+    def __init__(self, fields=('freeHeap',), counters=('mDNS_received', 'mDNS_replies'),
+                 alpha=0.05, z=4.0, warmup=30, window=120, leak_per_hour=300, recent=200):
+        self.fields = list(fields)
+        self.counters = list(counters)
+        # The counter rates, computed as CounterRateProcessor does
+        self.rates = CounterRates(self.counters) if self.counters else None
+        self.alpha = alpha
+        self.z = z
+        self.warmup = warmup
+        self.window = window
+        self.leak_per_hour = leak_per_hour
+        # device -> {signal: SignalStats}
+        self.stats_by_device = {}
+        # device -> last uptime, to restart the leak window on a reboot
+        self.uptimes = {}
+        # (device, signal, kind) -> open event
+        self.active = {}
+        self.recent = deque(maxlen=recent)
+        self.events = 0
+        self.lock = threading.Lock()
+
+    def samples(self, message):
+        """(signal, value) pairs of one message: watched fields and counter rates."""
+        flat = message.flat
+        out = []
+        for field in self.fields:
+            value = flat.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                out.append((field, float(value)))
+        if self.rates is None:
+            return out
+        for counter, rate, reset in self.rates.update(message.device_id, flat, message.received):
+            # The rate since boot of a reset counter is no sample of its usual rate
+            if not reset:
+                out.append((f"{counter}_per_s", rate))
+        return out
+
+    def process(self, message, precision):
+        flat = message.flat
+        if not flat or message.device_id is None:
+            return []
+        device = message.device_id
+        rebooted = False
+        uptime = to_int(flat['uptime'], default=None) if 'uptime' in flat else None
+        if uptime is not None:
+            last_uptime = self.uptimes.get(device)
+            rebooted = last_uptime is not None and uptime < last_uptime
+            self.uptimes[device] = uptime
+        samples = self.samples(message)
+        if not samples:
+            return []
+
+        points = []
+        with self.lock:
+            signals = self.stats_by_device.setdefault(device, {})
+            for signal, value in samples:
+                stats = signals.get(signal)
+                if stats is None:
+                    stats = signals[signal] = SignalStats(self.alpha, self.window)
+                if rebooted and signal in LEAK_SIGNALS:
+                    # A reboot frees the heap: start the slope over
+                    stats.reset_window()
+                    points.extend(self.close(device, signal, 'leak', message.received, value, precision))
+
+                z = stats.zscore(value) if stats.count >= self.warmup else 0.0
+                kind = 'spike' if z > self.z else 'dip' if z < -self.z else None
+                for other in ('spike', 'dip'):
+                    if other != kind:
+                        points.extend(self.close(device, signal, other, message.received, value, precision))
+                if kind is not None:
+                    points.extend(self.open(device, signal, kind, message.received, precision,
+                                            value=value, mean=stats.mean, zscore=z))
+                stats.update(message.received, value)
+
+                slope = stats.slope() if signal in LEAK_SIGNALS and stats.full() else None
+                if slope is not None:
+                    per_hour = slope * 3600
+                    if per_hour < -self.leak_per_hour:
+                        points.extend(self.open(device, signal, 'leak', message.received, precision,
+                                                value=value, slope_per_hour=per_hour))
+                    elif per_hour > -self.leak_per_hour / 2:
+                        # Hysteresis, so a slope around the threshold does not flap
+                        points.extend(self.close(device, signal, 'leak', message.received, value, precision))
+        return points
+
+    def open(self, device, signal, kind, received, precision, **fields):
+        key = (device, signal, kind)
+        if key in self.active:
+            return []
+        event = dict(device=device, signal=signal, kind=kind, since=received, **fields)
+        self.active[key] = event
+        return [self.event_point(event, True, received, precision)]
+
+    def close(self, device, signal, kind, received, value, precision):
+        event = self.active.pop((device, signal, kind), None)
+        if event is None:
+            return []
+        closed = {k: event[k] for k in ('device', 'signal', 'kind', 'since')}
+        return [self.event_point(dict(closed, value=value), False, received, precision)]
+
+    def event_point(self, event, active, received, precision):
+        self.events += 1
+        self.recent.append(dict(event, active=active, time=received))
+        point = Point("rgbww_anomaly").tag("device", event['device']) \
+            .tag("signal", event['signal']).tag("kind", event['kind']).field("active", active)
+        for key in ('value', 'mean', 'zscore', 'slope_per_hour'):
+            if key in event:
+                point.field(key, float(event[key]))
+        return point.time(time=datetime.fromtimestamp(received, timezone.utc), write_precision=precision)
+
+    def report(self, device=None):
+        """Open events and the latest transitions, optionally of one device."""
+        with self.lock:
+            active = [dict(e) for e in self.active.values() if device in (None, e['device'])]
+            recent = [dict(e) for e in self.recent if device in (None, e['device'])]
+        active.sort(key=lambda e: e['since'])
+        return {'active': active, 'recent': recent[::-1]}
+
+    def stats(self):
+        kinds = {}
+        for _, _, kind in list(self.active):
+            kinds[kind] = kinds.get(kind, 0) + 1
+        return {
+            'tracked_devices': len(self.stats_by_device),
+            'active': kinds,
+            'events': self.events,
+            'bytes_per_signal': 16 * self.window,
+        }
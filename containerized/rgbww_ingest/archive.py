@@ -0,0 +1,101 @@
+"""
+JSONL archive sink: appends every flattened monitor message to
+<output_dir>/<device id>.jsonl. As in the original mqtt_flatten_to_file.py,
+lists are flattened by position (a_0_b) and a {"devices": [...]} payload
+is written as one line per device, to the file of that device's 'id'.
+
+With raw=True (pass-through) the payload is not decoded at all: each line
+is the payload bytes as received inside a small envelope,
+
+    {"received": 1764930957.123, "topic": "rgbww/1/monitor", "payload": <payload>}
+
+Line breaks in the payload are turned into spaces, which JSON treats as
+whitespace. Whether a payload is spliced is decided by a structural check
+of the bytes (see raw_line), not by parsing it; a payload that fails the
+check, or is not UTF-8, is written as a string under "text" instead. A
+malformed payload that passes the check only spoils its own line.
+"""
+import json
+import os
+
+from .core import Sink
+from .flatten import flatten_json
+
+
+BRACKETS = {b'{': b'}', b'[': b']'}
+
+
+def looks_like_json(body):
+    """
+    Cheap structural check without parsing: an object or array whose
+    brackets balance and whose bytes are valid UTF-8.
+    """
+    if BRACKETS.get(body[:1]) != body[-1:]:
+        return False
+    if body.count(b'{') != body.count(b'}') or body.count(b'[') != body.count(b']'):
+        return False
+    try:
+        body.decode()
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def raw_line(message):
+    """
+    The received bytes spliced in as "payload" when they look like JSON
+    (newlines outside strings are only whitespace); anything else is
+    written escaped as "text". An already decoded message is checked by its
+    payload instead, which costs nothing more.
+    """
+    head = b'{"received": %.3f, "topic": %s, ' % (message.received, json.dumps(message.topic).encode())
+    raw = message.raw if isinstance(message.raw, bytes) else message.raw.encode()
+    body = raw.strip()
+    if message.parsed:
+        splice = message.payload is not None
+    else:
+        splice = looks_like_json(body)
+    if splice:
+        body = body.replace(b'\r', b' ').replace(b'\n', b' ')
+        return head + b'"payload": ' + body + b'}\n'
+    return head + b'"text": ' + json.dumps(message.text).encode() + b'}\n'
+
+
+def flat_rows(payload):
+    """(device id, flattened device) for each device of a payload."""
+    devices = payload['devices'] if isinstance(payload, dict) and 'devices' in payload else [payload]
+    for device in devices:
+        flat = flatten_json(device, index_lists=True)
+        yield str(flat.get('id', 'unknown')), flat
+
+
+class JsonlArchiveSink(Sink):
+
+    name = 'archive'
+
+    def __init__(self, output_dir, queue_size=1000, policy='fifo', per_device=10, raw=False):
+        super().__init__(queue_size=queue_size, policy=policy, per_device=per_device)
+        self.output_dir = output_dir
+        self.raw = raw
+        os.makedirs(output_dir, exist_ok=True)
+
+    def accepts(self, message):
+        if self.raw or not message.parsed:
+            # A lazy payload is checked in write(), off the MQTT thread
+            return message.kind != 'log'
+        return message.kind != 'log' and message.payload is not None
+
+    def write(self, messages):
+        # Group the batch per device so each file is opened once
+        per_device = {}
+        for message in messages:
+            if self.raw:
+                per_device.setdefault(message.device_id or 'unknown', []).append(raw_line(message))
+            elif message.payload is not None:
+                for device_id, flat in flat_rows(message.payload):
+                    per_device.setdefault(device_id, []).append(json.dumps(flat).encode() + b'\n')
+        for device_id, rows in per_device.items():
+            out_path = os.path.join(self.output_dir, f'{device_id}.jsonl')
+            with open(out_path, 'ab') as f:
+                f.write(b''.join(rows))
+            print(f'Wrote {len(rows)} records for device {device_id}')
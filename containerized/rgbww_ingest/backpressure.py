@@ -0,0 +1,241 @@
+"""
+Bounded sink queues with explicit overload policies.
+
+A plain deque(maxlen=...) drops the oldest message of whichever device, so
+one noisy device can push every quiet one out. These queues keep every
+device represented while the total stays bounded:
+
+- fifo:      one global queue, drop oldest (the previous behaviour)
+- device:    per-device queues (one per message kind), drop oldest of that
+             device; log lines only count against the total. When the
+             total is full the longest queue loses its oldest message
+- coalesce:  only the latest snapshot per device and topic survives until
+             the next flush; log lines are kept per device as with 'device'
+- sample:    deterministic 1-in-k sampling per device, k recomputed once
+             per drain from the load of the last window, with separate
+             thresholds for raising and lowering it
+
+All policies count drops (and coalesced or sampled-out messages) per device.
+"""
+import threading
+from collections import OrderedDict, deque
+
+POLICIES = ('fifo', 'device', 'coalesce', 'sample')
+
+
+class FifoQueue:
+    """Global drop-oldest queue."""
+
+    def __init__(self, size, per_device=None):
+        self.size = size
+        self.items = deque()
+        self.dropped = {}
+        self.lock = threading.Lock()
+
+    def count(self, counter, message):
+        device_id = message.device_id or 'unknown'
+        counter[device_id] = counter.get(device_id, 0) + 1
+
+    def put(self, message):
+        """Queues a message, returns the number of messages dropped to make room."""
+        with self.lock:
+            self.items.append(message)
+            if len(self.items) > self.size:
+                self.count(self.dropped, self.items.popleft())
+                return 1
+            return 0
+
+    def drain(self):
+        with self.lock:
+            batch = list(self.items)
+            self.items.clear()
+        return batch
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {'policy': 'fifo', 'dropped_per_device': dict(self.dropped)}
+
+
+class DeviceQueue(FifoQueue):
+    """
+    Per-device drop-oldest queues under a global bound. Each device has one
+    queue per message kind, so a burst of log lines cannot push out its
+    monitor snapshots. Log lines are only bounded by the global size, so
+    the LogCompactor sees every line of a burst; per_device bounds the
+    other kinds.
+    """
+
+    def __init__(self, size, per_device=10):
+        super().__init__(size)
+        self.per_device = per_device
+        # (device id, kind) -> deque
+        self.queues = OrderedDict()
+        self.total = 0
+        # length -> keys of the queues of that length, to find the longest in O(1)
+        self.by_length = {}
+        self.longest = 0
+
+    def resize(self, key, old, new):
+        if old:
+            keys = self.by_length[old]
+            keys.discard(key)
+            if not keys:
+                del self.by_length[old]
+        if new:
+            self.by_length.setdefault(new, set()).add(key)
+            self.longest = max(self.longest, new)
+        # Lengths change by one, so the longest shrinks by at most one
+        if self.longest and self.longest not in self.by_length:
+            self.longest -= 1
+
+    def pop_oldest(self, key):
+        queue = self.queues[key]
+        self.count(self.dropped, queue.popleft())
+        self.total -= 1
+        self.resize(key, len(queue) + 1, len(queue))
+        if not queue:
+            del self.queues[key]
+
+    def put(self, message):
+        with self.lock:
+            key = (message.device_id or 'unknown', message.kind)
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = deque()
+            queue.append(message)
+            self.total += 1
+            self.resize(key, len(queue) - 1, len(queue))
+            dropped = 0
+            if message.kind != 'log' and len(queue) > self.per_device:
+                self.pop_oldest(key)
+                dropped += 1
+            if self.total > self.size:
+                self.pop_oldest(next(iter(self.by_length[self.longest])))
+                dropped += 1
+            return dropped
+
+    def drain(self):
+        with self.lock:
+            queues = self.queues
+            self.queues = OrderedDict()
+            self.total = 0
+            self.by_length = {}
+            self.longest = 0
+        batch = [m for queue in queues.values() for m in queue]
+        # Keep arrival order across devices for the writers
+        batch.sort(key=lambda m: m.received)
+        return batch
+
+    def __len__(self):
+        return self.total
+
+    def stats(self):
+        return {'policy': 'device', 'per_device': self.per_device, 'dropped_per_device': dict(self.dropped)}
+
+
+class CoalesceQueue(DeviceQueue):
+    """Latest snapshot per (device, topic) within a flush window."""
+
+    def __init__(self, size, per_device=10):
+        super().__init__(size, per_device)
+        self.latest = OrderedDict()
+        self.coalesced = {}
+
+    def put(self, message):
+        if message.kind == 'log':
+            return super().put(message)
+        with self.lock:
+            key = (message.device_id, message.topic)
+            if key in self.latest:
+                self.count(self.coalesced, self.latest[key])
+            elif len(self.latest) >= self.size:
+                _, oldest = self.latest.popitem(last=False)
+                self.count(self.dropped, oldest)
+                self.latest[key] = message
+                return 1
+            self.latest[key] = message
+            return 0
+
+    def drain(self):
+        logs = super().drain()
+        with self.lock:
+            latest = self.latest
+            self.latest = OrderedDict()
+        batch = list(latest.values()) + logs
+        batch.sort(key=lambda m: m.received)
+        return batch
+
+    def __len__(self):
+        return len(self.latest) + self.total
+
+    def stats(self):
+        stats = super().stats()
+        stats['policy'] = 'coalesce'
+        stats['coalesced_per_device'] = dict(self.coalesced)
+        return stats
+
+
+class SamplingQueue(FifoQueue):
+    """
+    Deterministic per-device 1-in-k sampling. k is recomputed once per drain
+    from the messages offered since the previous one, and stays constant in
+    between, so every device keeps a steady subset of its readings. k is
+    raised as far as needed to keep the queue below high of its size, and
+    only halved once the queue would stay below low at half the k.
+    """
+
+    def __init__(self, size, per_device=None, high=0.75, low=0.25, max_factor=64):
+        super().__init__(size)
+        self.high = high
+        self.low = low
+        self.max_factor = max_factor
+        self.factor = 1
+        # Messages offered since the last drain, sampled out or not
+        self.offered = 0
+        self.seq = {}
+        self.sampled = {}
+
+    def put(self, message):
+        with self.lock:
+            self.offered += 1
+            device_id = message.device_id or 'unknown'
+            seq = self.seq.get(device_id, 0)
+            self.seq[device_id] = seq + 1
+            # Every device keeps its first message and then every k-th one
+            if seq % self.factor:
+                self.count(self.sampled, message)
+                return 0
+        return super().put(message)
+
+    def drain(self):
+        batch = super().drain()
+        with self.lock:
+            self.adapt(self.offered / self.size)
+            self.offered = 0
+        return batch
+
+    def adapt(self, demand):
+        """demand: the queue fill of one window without sampling."""
+        while demand / self.factor >= self.high and self.factor < self.max_factor:
+            self.factor *= 2
+        if self.factor > 1 and demand / (self.factor // 2) <= self.low:
+            self.factor //= 2
+
+    def stats(self):
+        return {
+            'policy': 'sample',
+            'factor': self.factor,
+            'dropped_per_device': dict(self.dropped),
+            'sampled_out_per_device': dict(self.sampled),
+        }
+
+
+def make_queue(policy, size, per_device=10):
+    """Creates the queue for an overload policy name (see POLICIES)."""
+    queues = {'fifo': FifoQueue, 'device': DeviceQueue, 'coalesce': CoalesceQueue, 'sample': SamplingQueue}
+    if policy not in queues:
+        print(f"Unknown queue policy '{policy}', falling back to 'fifo'.")
+        policy = 'fifo'
+    return queues[policy](size, per_device)
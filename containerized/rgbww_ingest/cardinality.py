@@ -0,0 +1,94 @@
+"""
+Cardinality guard for the device tag and flattened field keys.
+
+flatten_json turns every nested key into a field, so one firmware build
+that reports a map keyed by client or MAC could create an unbounded number
+of field keys. The guard admits keys through an allow/deny list and a
+per-measurement cap; everything beyond that is counted instead of written.
+Memory stays bounded by the caps.
+"""
+import threading
+from collections import deque
+from fnmatch import fnmatchcase
+
+
+def parse_patterns(spec):
+    """Splits a comma separated list of glob patterns."""
+    return [p.strip() for p in (spec or '').split(',') if p.strip()]
+
+
+class CardinalityGuard:
+
+    def __init__(self, max_fields=500, max_devices=10000, allow=None, deny=None):
+        self.max_fields = max_fields
+        self.max_devices = max_devices
+        # Glob patterns; an empty allowlist admits every key that is not denied
+        self.allow = list(allow or [])
+        self.deny = list(deny or [])
+        # measurement -> set of admitted field keys / device tag values
+        self.fields = {}
+        self.devices = {}
+        # measurement -> {'denied': n, 'fields': n, 'devices': n}
+        self.overflow = {}
+        self.recent_overflow = deque(maxlen=20)
+        self.lock = threading.Lock()
+
+    def count(self, measurement, kind, key):
+        counters = self.overflow.setdefault(measurement, {'denied': 0, 'fields': 0, 'devices': 0})
+        counters[kind] += 1
+        self.recent_overflow.append(f"{measurement}:{key}")
+
+    def listed(self, key):
+        if any(fnmatchcase(key, p) for p in self.deny):
+            return False
+        return not self.allow or any(fnmatchcase(key, p) for p in self.allow)
+
+    def admit_field(self, measurement, key):
+        """True if the field key may be written."""
+        known = self.fields.get(measurement)
+        if known is not None and key in known:
+            return True
+        with self.lock:
+            known = self.fields.setdefault(measurement, set())
+            if key in known:
+                return True
+            if not self.listed(key):
+                self.count(measurement, 'denied', key)
+                return False
+            if len(known) >= self.max_fields:
+                self.count(measurement, 'fields', key)
+                return False
+            known.add(key)
+            return True
+
+    def admit_device(self, measurement, device_id):
+        """True if points for this device tag value may be written."""
+        known = self.devices.get(measurement)
+        if known is not None and device_id in known:
+            return True
+        with self.lock:
+            known = self.devices.setdefault(measurement, set())
+            if device_id in known:
+                return True
+            if len(known) >= self.max_devices:
+                self.count(measurement, 'devices', device_id)
+                return False
+            known.add(device_id)
+            return True
+
+    def stats(self):
+        with self.lock:
+            measurements = set(self.fields) | set(self.devices)
+            return {
+                'max_fields': self.max_fields,
+                'max_devices': self.max_devices,
+                'measurements': {
+                    m: {
+                        'fields': len(self.fields.get(m, ())),
+                        'devices': len(self.devices.get(m, ())),
+                        'overflow': dict(self.overflow.get(m, {})),
+                    }
+                    for m in sorted(measurements)
+                },
+                'recent_overflow': list(self.recent_overflow),
+            }
@@ -0,0 +1,212 @@
+"""
+Compact records for the per-device state of large fleets.
+
+A decoded payload costs a dict per object, a fresh str for every key and
+value and an int object per number, although almost every device sends
+the same keys and the same few firmware, soc, ssid, gateway or netmask
+strings. A DeviceRecord instead splits a payload into
+
+  shape    its key structure and leaf types, shared by every payload with
+           the same keys (one Shape object for the whole fleet)
+  numbers  the ints and floats, as one array (8 bytes per value; int64,
+           or double when the payload has floats)
+  objects  the other leaves; strings come from a per-key pool, so repeated
+           values are stored once
+
+A key's pool stops growing after max_cardinality distinct values (ips,
+macs), whose strings are then kept as they are. payload and flat are
+rebuilt from the record on each read.
+"""
+from array import array
+from operator import itemgetter
+
+# Integers beyond this do not round-trip through a double
+EXACT_INT = 2 ** 53
+
+
+class Shape:
+    """
+    Key structure of a payload, struct = ((key, child struct or None for a
+    leaf), ...), and the plan to rebuild it: each level is (keys or None
+    when the leaves come first, leaf keys, [(key, child level)]). Values
+    are taken level by level, so the leaves of a level fill its dict with
+    one zip(). The flat form keeps document order, as flatten_json does.
+    """
+
+    __slots__ = ('struct', 'codes', 'typecode', 'level', 'flat_keys', 'lists', 'take', 'flat_take',
+                 'int_positions')
+
+    def __init__(self, struct, codes):
+        self.struct = struct
+        # One code per leaf in document order: 'i' int and 'f' float (in
+        # numbers), 'o' other (in objects), 'l' list (in objects, not flattened)
+        self.codes = codes
+        # Numbers are stored as int64 unless the payload has floats
+        self.typecode = 'd' if 'f' in codes else 'q'
+        # Document-order leaf -> index in numbers + objects
+        numeric = [i for i, code in enumerate(codes) if code in 'if']
+        other = [i for i, code in enumerate(codes) if code not in 'if']
+        stored = {leaf: position for position, leaf in enumerate(numeric + other)}
+        self.int_positions = [position for position, leaf in enumerate(numeric)
+                              if self.typecode == 'd' and codes[leaf] == 'i']
+        self.level, entries, document = self.plan(struct, '', iter(range(len(codes))), stored)
+        self.flat_keys = [flat_key for _, flat_key, _ in document]
+        # Positions of list leaves, which flatten_json skips
+        self.lists = [i for i, (_, _, code) in enumerate(document) if code == 'l']
+        # numbers + objects -> values in plan order, and in document order
+        self.take = taker([position for position, _, _ in entries])
+        self.flat_take = taker([position for position, _, _ in document])
+
+    def plan(self, struct, prefix, leaves, stored):
+        """
+        Returns (level, entries in plan order, entries in document order),
+        each entry (stored position, flat key, code).
+        """
+        keys, leaf_keys, children = [], [], []
+        own, nested, document = [], [], []
+        for key, child in struct:
+            keys.append(key)
+            if child is None:
+                # Leaves are numbered in document order, as split() stored them
+                leaf = next(leaves)
+                leaf_keys.append(key)
+                own.append((stored[leaf], prefix + key, self.codes[leaf]))
+                document.append(own[-1])
+            else:
+                level, entries, child_document = self.plan(child, prefix + key + '_', leaves, stored)
+                children.append((key, level))
+                nested.extend(entries)
+                document.extend(child_document)
+        # Without nested objects between leaves the leaves can go in first
+        if keys[:len(leaf_keys)] == leaf_keys:
+            keys = None
+        return (keys, leaf_keys, children), own + nested, document
+
+    def values(self, numbers, objects, take):
+        """Leaf values in the order of take."""
+        combined = (numbers.tolist() if numbers is not None else []) + list(objects)
+        for i in self.int_positions:
+            combined[i] = int(combined[i])
+        return take(combined)
+
+    def payload(self, numbers, objects):
+        return build(self.level, iter(self.values(numbers, objects, self.take)))
+
+    def flat(self, numbers, objects):
+        flat = zip(self.flat_keys, self.values(numbers, objects, self.flat_take))
+        if not self.lists:
+            return dict(flat)
+        return {key: value for i, (key, value) in enumerate(flat) if i not in self.lists}
+
+
+def taker(order):
+    """combined -> tuple of combined[i] for i in order."""
+    return itemgetter(*order) if len(order) > 1 else (lambda combined: tuple(combined[i] for i in order))
+
+
+def build(level, values):
+    # zip() takes the keys first, so it stops without consuming a value
+    keys, leaf_keys, children = level
+    if keys is None:
+        out = dict(zip(leaf_keys, values))
+    else:
+        # Fixes the key order, the values are filled in below
+        out = dict.fromkeys(keys)
+        out.update(zip(leaf_keys, values))
+    for key, child in children:
+        out[key] = build(child, values)
+    return out
+
+
+class Codec:
+    """Shared shapes and string pools of one state store."""
+
+    def __init__(self, max_cardinality=256, max_shapes=1000):
+        self.max_cardinality = max_cardinality
+        self.max_shapes = max_shapes
+        # (struct, codes) -> Shape
+        self.shapes = {}
+        # flat key -> {value: value}, None once the key has too many values
+        self.pools = {}
+
+    def pooled(self, key, value):
+        pool = self.pools.get(key)
+        if pool is None:
+            if key in self.pools:
+                return value
+            pool = self.pools[key] = {}
+        shared = pool.get(value)
+        if shared is not None:
+            return shared
+        if len(pool) >= self.max_cardinality:
+            self.pools[key] = None
+            return value
+        pool[value] = value
+        return value
+
+    def split(self, payload, prefix, numbers, objects, codes):
+        struct = []
+        for key, value in payload.items():
+            if isinstance(value, dict):
+                struct.append((key, self.split(value, prefix + key + '_', numbers, objects, codes)))
+                continue
+            struct.append((key, None))
+            if type(value) is int and -EXACT_INT <= value <= EXACT_INT:
+                numbers.append(value)
+                codes.append('i')
+            elif type(value) is float:
+                numbers.append(value)
+                codes.append('f')
+            elif isinstance(value, list):
+                objects.append(value)
+                codes.append('l')
+            else:
+                objects.append(self.pooled(prefix + key, value) if isinstance(value, str) else value)
+                codes.append('o')
+        return tuple(struct)
+
+    def encode(self, payload):
+        """Returns (shape, numbers, objects) of a payload dict."""
+        numbers, objects, codes = [], [], []
+        struct = self.split(payload, '', numbers, objects, codes)
+        key = (struct, ''.join(codes))
+        shape = self.shapes.get(key)
+        if shape is None:
+            shape = Shape(*key)
+            if len(self.shapes) < self.max_shapes:
+                self.shapes[key] = shape
+        return shape, array(shape.typecode, numbers) if numbers else None, tuple(objects)
+
+    def stats(self):
+        pools = dict(self.pools)
+        return {
+            'shapes': len(self.shapes),
+            'pooled_keys': sum(1 for pool in pools.values() if pool is not None),
+            'pooled_values': sum(len(pool) for pool in pools.values() if pool is not None),
+            'unpooled_keys': sorted(key for key, pool in pools.items() if pool is None),
+        }
+
+
+class DeviceRecord:
+    """
+    Latest state of one device. A record restored from a snapshot only
+    holds raw (shape is None) until DeviceStateSink decodes it.
+    """
+
+    __slots__ = ('topic', 'received', 'shape', 'numbers', 'objects', 'raw')
+
+    def __init__(self, topic, received, shape=None, numbers=None, objects=(), raw=None):
+        self.topic = topic
+        self.received = received
+        self.shape = shape
+        self.numbers = numbers
+        self.objects = objects
+        self.raw = raw
+
+    @property
+    def payload(self):
+        return self.shape.payload(self.numbers, self.objects)
+
+    @property
+    def flat(self):
+        return self.shape.flat(self.numbers, self.objects)
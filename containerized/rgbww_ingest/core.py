@@ -0,0 +1,366 @@
+"""
+Shared MQTT ingest core.
+
+One broker subscription, one decode and one flatten per message. Every
+decoded message is offered to the registered sinks, each of which owns a
+bounded queue and a worker thread, so a slow sink only ever drops from its
+own queue and never stalls the MQTT loop or the other sinks.
+"""
+import json
+import os
+import threading
+import time
+from .backpressure import make_queue
+from .flatten import flatten_json
+
+
+def rss_bytes():
+    """Resident memory of this process (peak RSS where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Payload and flat form of a lazy message before its first use
+UNPARSED = object()
+
+
+class Message:
+    """
+    A single MQTT message, decoded once and shared (read-only) by all sinks.
+
+    raw keeps the payload bytes as received; text is decoded from them on
+    first use. A lazy message (parse_message(..., lazy=True)) also parses
+    its JSON payload and flat form only when a sink first reads them, in
+    that sink's worker thread. A lazy payload that is not valid JSON reads
+    as None with an empty flat form.
+    """
+
+    __slots__ = ('topic', 'kind', 'device_id', 'raw', '_text', '_payload', '_flat', 'received', 'ack')
+
+    def __init__(self, topic, kind, device_id, text, payload, flat, received, raw=None):
+        self.topic = topic
+        self.kind = kind
+        self.device_id = device_id
+        self.raw = raw if raw is not None else text
+        self._text = text
+        self._payload = payload
+        self._flat = flat
+        self.received = received
+        # (client, mid, qos) to acknowledge once stored, in at-least-once mode
+        self.ack = None
+
+    @property
+    def text(self):
+        if self._text is None and self.raw is not None:
+            raw = self.raw
+            self._text = raw.decode(errors='replace') if isinstance(raw, bytes) else raw
+        return self._text
+
+    @property
+    def parsed(self):
+        """False for a lazy message whose payload has not been read yet."""
+        return self._payload is not UNPARSED
+
+    @property
+    def payload(self):
+        if self._payload is UNPARSED:
+            self.parse()
+        return self._payload
+
+    @property
+    def flat(self):
+        if self._flat is UNPARSED:
+            self.parse()
+        return self._flat
+
+    def parse(self):
+        try:
+            payload = json.loads(self.raw)
+        except ValueError:
+            payload = None
+        self._flat = flatten_json(payload) if isinstance(payload, dict) else {}
+        self._payload = payload
+
+
+def parse_message(topic, raw, received=None, lazy=False):
+    """
+    Decodes an MQTT payload into a Message.
+
+    Topics look like 'rgbww/<id>/<kind>'. 'log' payloads are kept as text,
+    everything else is parsed as JSON and flattened. Raises ValueError for
+    payloads that are not valid JSON. With lazy=True nothing is decoded
+    here, and the device id is the one in the topic.
+    """
+    if received is None:
+        received = time.time()
+    parts = topic.split('/')
+    kind = parts[-1] if len(parts) >= 3 else ''
+    device_id = parts[1] if len(parts) >= 3 else None
+
+    if kind == 'log':
+        return Message(topic, kind, device_id, None, None, None, received, raw=raw)
+    if lazy:
+        return Message(topic, kind, device_id, None, UNPARSED, UNPARSED, received, raw=raw)
+
+    text = raw.decode(errors='replace') if isinstance(raw, bytes) else raw
+    payload = json.loads(text)
+    flat = flatten_json(payload) if isinstance(payload, dict) else {}
+    if 'id' in flat:
+        device_id = str(flat['id'])
+    elif 'deviceid' in flat:
+        device_id = str(flat['deviceid'])
+    return Message(topic, kind, device_id, None, payload, flat, received, raw=raw)
+
+
+class Sink:
+    """
+    Base class for ingest sinks.
+
+    Messages are offered from the MQTT thread into a bounded queue whose
+    overload policy (see backpressure.py) decides what is dropped when it is
+    full. A worker thread drains the queue either as soon as data arrives
+    (flush_interval == 0) or once every flush_interval seconds, and hands the
+    batch to flush().
+    """
+
+    name = 'sink'
+
+    def __init__(self, queue_size=1000, flush_interval=0, policy='fifo', per_device=10):
+        self.queue_size = queue_size
+        self.queue = make_queue(policy, queue_size, per_device)
+        self.flush_interval = flush_interval
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        # Seconds the oldest message of the last batch waited in the queue
+        self.lag = 0.0
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def accepts(self, message):
+        """Returns True if this sink wants the message. Override to filter."""
+        return True
+
+    def wake(self):
+        """Makes the worker flush now instead of at the end of its interval."""
+        self._wakeup.set()
+
+    def offer(self, message):
+        """Called from the MQTT thread. Never blocks."""
+        self.received += 1
+        self.dropped += self.queue.put(message)
+        if not self.flush_interval:
+            self._wakeup.set()
+
+    def drain(self):
+        return self.queue.drain()
+
+    def flush(self, batch):
+        """Processes one drained batch. Called on every cycle for interval sinks."""
+        if batch:
+            self.write(batch)
+
+    def write(self, messages):
+        raise NotImplementedError
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval or None)
+            self._wakeup.clear()
+            batch = self.drain()
+            if batch:
+                self.lag = time.time() - min(m.received for m in batch)
+            try:
+                self.flush(batch)
+                self.processed += len(batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"[{self.name}] Unexpected error while flushing {len(batch)} messages: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name=f"sink-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'errors': self.errors,
+            'lag': round(self.lag, 3),
+            'queue': self.queue.stats(),
+        }
+
+
+class IngestCore:
+    """Owns the MQTT subscription and fans decoded messages out to the sinks."""
+
+    def __init__(self, broker, port, user, password, topics, client_id,
+                 ignore_prefixes=(), status_topic='bridge/status', status_interval=10,
+                 acks=None, lazy=False):
+        self.broker = broker
+        self.port = port
+        self.user = user
+        self.password = password
+        self.topics = list(topics)
+        self.client_id = client_id
+        # The broker above plus any added with add_broker(); each one gets
+        # its own MQTT connection feeding the same sinks
+        self.brokers = [{'host': broker, 'port': port, 'user': user, 'password': password,
+                         'topics': self.topics, 'client_id': client_id, 'messages': 0}]
+        self.ignore_prefixes = tuple(ignore_prefixes)
+        self.status_topic = status_topic
+        self.status_interval = status_interval
+        self.sinks = []
+        self.client = None
+        self.message_count = 0
+        self.error_count = 0
+        self.device_ids = set()
+        # AckWindow for at-least-once mode: QoS 1, persistent session and
+        # acks sent only once the window's sink has stored the message
+        self.acks = acks
+        # Pass-through: hand undecoded messages to the sinks (see Message)
+        self.lazy = lazy
+
+    def add_broker(self, host, port, user, password, topics=None, client_id=None):
+        """Subscribes to another broker (by default to the same topics)."""
+        self.brokers.append({
+            'host': host, 'port': port, 'user': user, 'password': password,
+            'topics': list(topics) if topics else self.topics,
+            'client_id': client_id or f"{self.client_id}_{len(self.brokers)}",
+            'messages': 0,
+        })
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def sink(self, name):
+        for sink in self.sinks:
+            if sink.name == name:
+                return sink
+        return None
+
+    # --- Message handling ---
+    def handle(self, topic, raw, received=None, ack=None):
+        """
+        Decodes one message and offers it to every interested sink. An ack
+        token is settled right away unless the acknowledging sink took the
+        message, which then settles it once stored.
+        """
+        if self.ignore_prefixes and topic.startswith(self.ignore_prefixes):
+            self.settle(ack)
+            return None
+        self.message_count += 1
+        try:
+            message = parse_message(topic, raw, received, lazy=self.lazy)
+        except ValueError as e:
+            self.error_count += 1
+            print(f'Error processing message on {topic}: {e}')
+            self.settle(ack)
+            return None
+        if message.device_id is not None:
+            self.device_ids.add(message.device_id)
+        stored = False
+        for sink in self.sinks:
+            if sink.accepts(message):
+                if ack is not None and sink is self.acks.sink:
+                    message.ack = ack
+                    stored = True
+                sink.offer(message)
+        if not stored:
+            self.settle(ack)
+        return message
+
+    def settle(self, ack):
+        if ack is not None:
+            self.acks.settle([ack])
+
+    # --- MQTT Functions ---
+    def on_connect(self, client, userdata, flags, rc):
+        """Callback for when the client connects to the MQTT broker."""
+        broker = userdata
+        print(f"Connected to MQTT broker {broker['host']}:{broker['port']}")
+        if self.acks is not None:
+            print(f"Session present: {bool(flags.get('session present'))}")
+        for topic in broker['topics']:
+            result, mid = client.subscribe(topic, qos=1 if self.acks is not None else 0)
+            print(f'Subscribing to topic pattern: {topic}')
+            print(f'Subscribe result: {result}, message id: {mid}')
+
+    def on_message(self, client, userdata, msg):
+        """Callback for when a message is received from the MQTT broker."""
+        userdata['messages'] += 1
+        if self.acks is not None and msg.qos > 0:
+            # Waiting for a full window here would stall the client loop and its pings
+            self.acks.submit(self.handle, msg.topic, msg.payload, time.time(), (client, msg.mid, msg.qos))
+            return
+        self.handle(msg.topic, msg.payload)
+
+    def status(self):
+        return {
+            'messages_received': self.message_count,
+            'errors': self.error_count,
+            'devices': len(self.device_ids),
+            'messages_queued': {sink.name: len(sink.queue) for sink in self.sinks},
+            'rss_bytes': rss_bytes(),
+            'acks': self.acks.stats() if self.acks is not None else None,
+            'brokers': {f"{b['host']}:{b['port']}": b['messages'] for b in self.brokers},
+        }
+
+    def publish_status(self):
+        while True:
+            # Publish to a neutral topic to avoid loops
+            self.client.publish(self.status_topic, json.dumps(self.status()), qos=0, retain=False)
+            time.sleep(self.status_interval)
+
+    def mqtt_thread(self, broker=None):
+        """
+        Runs the MQTT client loop of one broker (the first by default), which
+        also publishes the periodic status.
+        """
+        import paho.mqtt.client as mqtt
+
+        primary = broker is None
+        if primary:
+            broker = self.brokers[0]
+        if self.acks is not None:
+            # Persistent session with manual acks (paho-mqtt >= 2.0)
+            client = mqtt.Client(client_id=broker['client_id'], clean_session=False, manual_ack=True)
+        else:
+            client = mqtt.Client(client_id=broker['client_id'])
+        client.user_data_set(broker)
+        client.username_pw_set(broker['user'], broker['password'])
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.connect(broker['host'], broker['port'])
+
+        if primary:
+            self.client = client
+            if self.status_topic:
+                threading.Thread(target=self.publish_status, daemon=True).start()
+        client.loop_forever()
+
+    def start_workers(self):
+        """Starts all sink workers and the MQTT threads of additional brokers."""
+        for sink in self.sinks:
+            sink.start()
+        for broker in self.brokers[1:]:
+            threading.Thread(target=self.mqtt_thread, args=(broker,), name=f"mqtt-{broker['host']}", daemon=True).start()
+
+    def start(self):
+        """Starts all sink workers and the MQTT threads."""
+        self.start_workers()
+        threading.Thread(target=self.mqtt_thread, name='mqtt', daemon=True).start()
+
+    def run(self):
+        """Starts all sink workers and runs the first broker's MQTT loop in the calling thread."""
+        self.start_workers()
+        self.mqtt_thread()
@@ -0,0 +1,52 @@
+"""
+Size-rotated JSONL file for points InfluxDB refused to store.
+"""
+import json
+import os
+import threading
+import time
+
+
+class DeadLetterFile:
+    """
+    Appends one JSON object per rejected line. When the file grows past
+    max_bytes it is rotated to <path>.1 ... <path>.<backups>, like
+    logging.handlers.RotatingFileHandler.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.count = 0
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, line, status, error):
+        record = json.dumps({
+            'time': time.time(),
+            'status': status,
+            'error': error,
+            'line': line,
+        })
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    self.rotate()
+                with open(self.path, 'a') as f:
+                    f.write(record + '\n')
+            except OSError as e:
+                print(f"[ERROR] Could not write dead-letter file {self.path}: {e}")
+            self.count += 1
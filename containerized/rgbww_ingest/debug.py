@@ -0,0 +1,183 @@
+"""
+Opt-in profiling endpoints for a live importer or bridge.
+
+/debug/profile samples the stacks of all threads for a number of seconds
+(cProfile only sees the thread it runs in) and returns them as collapsed
+stacks, the input format of flamegraph.pl and speedscope, or as a table of
+the functions with the most samples. /debug/heap/* wraps tracemalloc:
+snapshots list the top allocating sites, diffs compare against the
+previous snapshot.
+"""
+import math
+import sys
+import threading
+import time
+import tracemalloc
+
+from flask import Response, jsonify, request
+
+MAX_SECONDS = 60
+MAX_LIMIT = 1000
+MAX_FRAMES = 64
+GROUPS = ('lineno', 'filename', 'traceback')
+
+profile_lock = threading.Lock()
+heap = {'baseline': None}
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds, interval=0.005):
+    """
+    Samples every thread except the calling one; returns
+    {(thread name, frame, ..., innermost frame): samples}.
+    """
+    me = threading.get_ident()
+    stacks = {}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            key = (names.get(ident, str(ident)),) + tuple(reversed(stack))
+            stacks[key] = stacks.get(key, 0) + 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    """One 'thread;outer;...;inner count' line per distinct stack."""
+    lines = [';'.join(stack) + f' {count}' for stack, count in stacks.items()]
+    return '\n'.join(sorted(lines)) + '\n'
+
+
+def top_functions(stacks, limit=40):
+    """Functions by samples on top of the stack (self) and anywhere on it (total)."""
+    own, total = {}, {}
+    samples = sum(stacks.values()) or 1
+    for stack, count in stacks.items():
+        frames = stack[1:]
+        if not frames:
+            continue
+        own[frames[-1]] = own.get(frames[-1], 0) + count
+        for name in set(frames):
+            total[name] = total.get(name, 0) + count
+    rows = sorted(total, key=lambda n: (own.get(n, 0), total[n]), reverse=True)[:limit]
+    out = [f"{samples} samples", f"{'self%':>7} {'total%':>7}  function"]
+    for name in rows:
+        out.append(f"{100 * own.get(name, 0) / samples:7.1f} {100 * total[name] / samples:7.1f}  {name}")
+    return '\n'.join(out) + '\n'
+
+
+def heap_stats(stats, limit):
+    return [{
+        'site': str(stat.traceback[0]) if stat.traceback else '?',
+        'size_kb': round(stat.size / 1024, 1),
+        'size_diff_kb': round(getattr(stat, 'size_diff', 0) / 1024, 1),
+        'count': stat.count,
+        'count_diff': getattr(stat, 'count_diff', 0),
+    } for stat in stats[:limit]]
+
+
+def number(name, default, cast, low, high):
+    """Query parameter name as cast, clamped to [low, high]; ValueError when malformed."""
+    raw = request.args.get(name)
+    if raw is None:
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be a number") from None
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    return min(max(value, low), high)
+
+
+def group():
+    value = request.args.get('group', 'lineno')
+    if value not in GROUPS:
+        raise ValueError(f"group must be one of {', '.join(GROUPS)}")
+    return value
+
+
+def register(app):
+    """Adds the /debug endpoints to a Flask app."""
+
+    @app.route('/debug/profile')
+    def debug_profile():
+        """?seconds=10&interval=0.005&format=collapsed|top&limit=40, clamped to sane bounds"""
+        try:
+            seconds = number('seconds', 10, float, 0, MAX_SECONDS)
+            interval = number('interval', 0.005, float, 0.001, 1)
+            limit = number('limit', 40, int, 1, MAX_LIMIT)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not profile_lock.acquire(blocking=False):
+            return jsonify({'error': 'a profile is already running'}), 409
+        try:
+            stacks = sample_stacks(seconds, interval)
+        finally:
+            profile_lock.release()
+        if request.args.get('format') == 'top':
+            return Response(top_functions(stacks, limit), mimetype='text/plain')
+        return Response(collapsed(stacks), mimetype='text/plain')
+
+    @app.route('/debug/heap/start', methods=['POST'])
+    def debug_heap_start():
+        """Starts tracing allocations (?frames=1 traceback depth)."""
+        try:
+            frames = number('frames', 1, int, 1, MAX_FRAMES)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        heap['baseline'] = tracemalloc.take_snapshot()
+        return jsonify({'tracing': True})
+
+    @app.route('/debug/heap/stop', methods=['POST'])
+    def debug_heap_stop():
+        tracemalloc.stop()
+        heap['baseline'] = None
+        return jsonify({'tracing': False})
+
+    @app.route('/debug/heap/snapshot')
+    def debug_heap_snapshot():
+        """Top allocating sites now (?limit=25&group=lineno|filename|traceback)."""
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'tracing is off, POST /debug/heap/start first'}), 409
+        try:
+            limit, by = number('limit', 25, int, 1, MAX_LIMIT), group()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        return jsonify({
+            'traced_kb': round(current / 1024, 1),
+            'peak_kb': round(peak / 1024, 1),
+            'top': heap_stats(snapshot.statistics(by), limit),
+        })
+
+    @app.route('/debug/heap/diff')
+    def debug_heap_diff():
+        """Growth per site since the previous diff (or since start)."""
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'tracing is off, POST /debug/heap/start first'}), 409
+        try:
+            limit, by = number('limit', 25, int, 1, MAX_LIMIT), group()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if heap['baseline'] is None:
+            # Tracing was started elsewhere (e.g. PYTHONTRACEMALLOC)
+            return jsonify({'error': 'no baseline snapshot, POST /debug/heap/start to take one first'}), 409
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(heap['baseline'], by)
+        heap['baseline'] = snapshot
+        return jsonify({'top': heap_stats(stats, limit)})
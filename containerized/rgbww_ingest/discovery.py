@@ -0,0 +1,106 @@
+"""
+Prometheus HTTP service discovery from the live MQTT fleet.
+
+Every JSON message refreshes its device; info payloads also carry the
+device's address (connection.ip) and ssid, monitor payloads its firmware
+and soc. targets() renders the devices seen within the TTL in the
+http_sd_configs format, so Prometheus picks up new and vanished devices on
+its next SD refresh without a config rewrite or reload.
+"""
+import threading
+import time
+
+from .core import Sink
+
+# label -> flattened keys to take it from, first present wins
+LABEL_FIELDS = {
+    'soc': ('soc',),
+    'firmware': ('firmware', 'git_version'),
+    'ssid': ('connection_ssid',),
+}
+ADDRESS_FIELDS = ('connection_ip', 'ip')
+
+
+class DiscoverySink(Sink):
+
+    name = 'discovery'
+
+    def __init__(self, ttl=300, port=None, queue_size=1000, policy='fifo', per_device=10):
+        super().__init__(queue_size=queue_size, policy=policy, per_device=per_device)
+        self.ttl = ttl
+        # Appended to the device ip when set (e.g. 80 for the device's web server)
+        self.port = port
+        # device id -> {'address': ..., 'labels': {...}, 'last_seen': ...}
+        self.devices = {}
+        self.expired = 0
+        self.lock = threading.Lock()
+
+    def accepts(self, message):
+        if not message.parsed:
+            # Checked again in write(), off the MQTT thread
+            return message.kind != 'log' and message.device_id is not None
+        return bool(message.flat) and message.device_id is not None
+
+    def write(self, messages):
+        with self.lock:
+            for message in messages:
+                if not message.flat:
+                    continue
+                device = self.devices.setdefault(message.device_id, {'address': None, 'labels': {}})
+                device['last_seen'] = message.received
+                flat = message.flat
+                for key in ADDRESS_FIELDS:
+                    if flat.get(key):
+                        device['address'] = str(flat[key])
+                        break
+                for label, keys in LABEL_FIELDS.items():
+                    for key in keys:
+                        if flat.get(key) not in (None, ''):
+                            device['labels'][label] = str(flat[key])
+                            break
+
+    def targets(self, now=None):
+        """
+        Returns one target group per live device with a known address, as
+        [{"targets": ["<ip>"], "labels": {"deviceid": ..., ...}}]. Devices
+        not seen for ttl seconds are forgotten.
+        """
+        if now is None:
+            now = time.time()
+        groups = []
+        with self.lock:
+            for device_id in list(self.devices):
+                device = self.devices[device_id]
+                if now - device['last_seen'] > self.ttl:
+                    del self.devices[device_id]
+                    self.expired += 1
+                    continue
+                if not device['address']:
+                    continue
+                address = device['address']
+                if self.port and ':' not in address:
+                    address = f"{address}:{self.port}"
+                labels = dict(device['labels'], deviceid=device_id)
+                groups.append({'targets': [address], 'labels': labels})
+        groups.sort(key=lambda g: g['labels']['deviceid'])
+        return groups
+
+    def export(self):
+        """Copy of the device table for a snapshot."""
+        with self.lock:
+            return {device_id: dict(device, labels=dict(device['labels']))
+                    for device_id, device in self.devices.items()}
+
+    def restore(self, devices):
+        """Loads export() output; devices that already reported are kept."""
+        with self.lock:
+            for device_id, device in devices.items():
+                self.devices.setdefault(device_id, device)
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats['devices'] = len(self.devices)
+            stats['without_address'] = sum(1 for d in self.devices.values() if not d['address'])
+        stats['expired'] = self.expired
+        return stats
@@ -0,0 +1,29 @@
+"""
+JSON flattening shared by all sinks.
+"""
+
+
+def flatten_json(y, index_lists=False):
+    """
+    Recursively flattens a nested dictionary.
+    Keys are joined by an underscore (e.g., 'parent_child'). Lists are
+    skipped, or with index_lists flattened by position (e.g., 'parent_0_child').
+    """
+    out = {}
+
+    def flatten(x, name=''):
+        if isinstance(x, dict):
+            for a in x:
+                flatten(x[a], name + a + '_')
+        elif isinstance(x, list):
+            if index_lists:
+                for i, a in enumerate(x):
+                    flatten(a, f'{name}{i}_')
+                return
+            # Skip lists as they are not easily mapped to InfluxDB fields
+            print(f"Warning: Skipping list field at key: {name.strip('_')}")
+        else:
+            out[name[:-1]] = x
+
+    flatten(y)
+    return out
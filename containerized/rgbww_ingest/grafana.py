@@ -0,0 +1,84 @@
+"""
+Grafana query API served from the in-memory device state.
+
+Speaks the Grafana JSON datasource protocol (/search and /query returning
+'table' results) and also offers plain JSON arrays for the Infinity
+datasource, so current-state panels never have to query InfluxDB.
+"""
+import math
+import time
+
+# Columns of the 'devices' table, matching the "Controllers overview" panel
+DEVICE_COLUMNS = ['uptime', 'freeHeap', 'reboot_reason', 'firmware', 'soc', 'build']
+
+TARGETS = ['devices', 'fleet']
+
+
+def column_type(name):
+    # reboot_reason holds reason strings or codes, depending on the firmware
+    if name in ('firmware', 'soc', 'build', 'device', 'reboot_reason'):
+        return 'string'
+    if name in ('last_seen', 'time'):
+        return 'time'
+    return 'number'
+
+
+def to_number(value):
+    """A number or numeric string ('7', '1.5') as int or float, None for anything else."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number):
+        return None
+    return int(number) if number.is_integer() and not isinstance(value, float) else number
+
+
+def to_string(value):
+    return None if value is None else str(value)
+
+
+def device_rows(state):
+    """Current state of every device as a list of dicts, sorted by uptime."""
+    names = ['device'] + DEVICE_COLUMNS + ['last_seen']
+    rows = [dict(zip(names, row)) for row in state.table(DEVICE_COLUMNS)]
+    for row in rows:
+        # Values as the column types announce them, whatever the payload sent
+        for name in DEVICE_COLUMNS:
+            row[name] = to_string(row[name]) if column_type(name) == 'string' else to_number(row[name])
+        # Grafana expects epoch milliseconds for time columns
+        row['last_seen'] = int(row['last_seen'] * 1000)
+    rows.sort(key=lambda r: (r['uptime'] is None, r['uptime'] or 0))
+    return rows
+
+
+def fleet_rows(state, online_ttl):
+    counts = state.fleet(online_ttl)
+    return [{'online': counts['online'], 'known': counts['known'], 'time': int(time.time() * 1000)}]
+
+
+def as_table(rows, names):
+    """Converts a list of dicts to a Grafana JSON datasource table result."""
+    return {
+        'type': 'table',
+        'columns': [{'text': name, 'type': column_type(name)} for name in names],
+        'rows': [[row.get(name) for name in names] for row in rows],
+    }
+
+
+def query(state, targets, online_ttl):
+    """Answers a JSON datasource /query request body's 'targets'."""
+    results = []
+    for target in targets:
+        name = target.get('target') if isinstance(target, dict) else target
+        if name == 'devices':
+            names = ['device'] + DEVICE_COLUMNS + ['last_seen']
+            results.append(as_table(device_rows(state), names))
+        elif name == 'fleet':
+            counts = state.fleet(online_ttl)
+            results.append(as_table([counts], ['online', 'known']))
+    return results
@@ -0,0 +1,195 @@
+"""
+Short-term per-device history kept in memory.
+
+Every device gets a fixed-size ring: one array('I') of epoch seconds and
+one array('d') per tracked field, all filled by the same monitor message
+(NaN where a field was missing). Memory is allocated when a device is
+first seen and never grows afterwards:
+
+    bytes per device ~= size * (4 + 8 * len(fields))
+
+e.g. 360 samples of 4 fields = 12.9 KB, so 10 000 devices take ~130 MB.
+Devices beyond max_devices are counted but not tracked.
+"""
+import math
+import threading
+import time
+from array import array
+
+from .core import Sink
+
+NAN = float('nan')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+AGGREGATES = {
+    'mean': lambda values: sum(values) / len(values),
+    'min': min,
+    'max': max,
+    'last': lambda values: values[-1],
+}
+
+
+def parse_seconds(value, default=None):
+    """
+    Accepts plain seconds ('90', '-1800') or a duration ('30m'); raises
+    ValueError for anything else.
+    """
+    if value in (None, ''):
+        return default
+    try:
+        if value[-1:] in UNITS:
+            seconds = float(int(value[:-1]) * UNITS[value[-1]])
+        else:
+            seconds = float(value)
+    except ValueError:
+        raise ValueError(f"'{value}' is neither seconds nor a duration like 30m") from None
+    if not math.isfinite(seconds):
+        raise ValueError(f"'{value}' is not a finite number of seconds")
+    return seconds
+
+
+def numeric(value):
+    """float of a number or numeric string, None for anything else."""
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Ring:
+    """Fixed-capacity ring of (time, field values) for one device."""
+
+    __slots__ = ('times', 'values', 'pos', 'count')
+
+    def __init__(self, size, fields):
+        self.times = array('I', bytes(4 * size))
+        self.values = {f: array('d', [NAN]) * size for f in fields}
+        self.pos = 0
+        self.count = 0
+
+    def append(self, timestamp, sample):
+        pos = self.pos
+        self.times[pos] = int(timestamp)
+        for field, values in self.values.items():
+            values[pos] = sample.get(field, NAN)
+        self.pos = (pos + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def series(self, field, since=0):
+        """(timestamp, value) pairs in time order, NaN samples skipped."""
+        values = self.values[field]
+        size = len(self.times)
+        start = (self.pos - self.count) % size
+        out = []
+        for i in range(self.count):
+            index = (start + i) % size
+            t = self.times[index]
+            if t >= since and not math.isnan(values[index]):
+                out.append((t, values[index]))
+        return out
+
+
+def downsample(points, step, aggregate='mean'):
+    """Buckets points into step-second windows aligned to the epoch."""
+    reduce = AGGREGATES[aggregate]
+    out = []
+    bucket, values = None, []
+    for t, v in points:
+        b = int(t // step * step)
+        if b != bucket and values:
+            out.append((bucket, reduce(values)))
+            values = []
+        bucket = b
+        values.append(v)
+    if values:
+        out.append((bucket, reduce(values)))
+    return out
+
+
+class HistorySink(Sink):
+
+    name = 'history'
+
+    def __init__(self, fields, size=360, max_devices=10000, queue_size=1000,
+                 policy='fifo', per_device=10):
+        super().__init__(queue_size=queue_size, policy=policy, per_device=per_device)
+        self.fields = list(fields)
+        self.size = size
+        self.max_devices = max_devices
+        self.rings = {}
+        self.untracked = 0
+        self.lock = threading.Lock()
+
+    def accepts(self, message):
+        if not message.parsed:
+            # write() skips messages without numeric fields, off the MQTT thread
+            return message.kind != 'log' and message.device_id is not None
+        return message.kind != 'log' and bool(message.flat) and message.device_id is not None
+
+    def write(self, messages):
+        with self.lock:
+            for message in messages:
+                flat = message.flat
+                sample = {}
+                for field in self.fields:
+                    value = numeric(flat.get(field))
+                    if value is not None:
+                        sample[field] = value
+                if not sample:
+                    continue
+                ring = self.rings.get(message.device_id)
+                if ring is None:
+                    if len(self.rings) >= self.max_devices:
+                        self.untracked += 1
+                        continue
+                    ring = self.rings[message.device_id] = Ring(self.size, self.fields)
+                ring.append(message.received, sample)
+
+    def query(self, device_id, field, since=0, step=None, aggregate='mean'):
+        """Points of one device and field since the given epoch second, or None if unknown."""
+        if field not in self.fields:
+            return None
+        with self.lock:
+            ring = self.rings.get(device_id)
+            points = ring.series(field, since) if ring is not None else None
+        if points is None:
+            return None
+        if step:
+            points = downsample(points, step, aggregate)
+        return points
+
+    def stats(self):
+        stats = super().stats()
+        stats['devices'] = len(self.rings)
+        stats['untracked'] = self.untracked
+        stats['bytes_per_device'] = self.size * (4 + 8 * len(self.fields))
+        return stats
+
+
+def history_response(history, args, now=None):
+    """Builds the /history reply from request args; returns (body, status)."""
+    if now is None:
+        now = time.time()
+    device = args.get('device')
+    field = args.get('field')
+    if not device or not field:
+        return {'error': 'device and field are required'}, 400
+    raw_since = args.get('since', '')
+    try:
+        since = parse_seconds(raw_since, default=0)
+        step = parse_seconds(args.get('step'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    # Negative seconds and durations ('30m') are relative to now
+    if since < 0 or raw_since[-1:].isalpha():
+        since = now - abs(since)
+    if step is not None and step <= 0:
+        return {'error': 'step must be positive'}, 400
+    aggregate = args.get('agg', 'mean')
+    if aggregate not in AGGREGATES:
+        return {'error': f"agg must be one of {', '.join(AGGREGATES)}"}, 400
+    points = history.query(device, field, since, step, aggregate)
+    if points is None:
+        return {'error': f'no history for device {device} field {field}'}, 404
+    return {'device': device, 'field': field, 'points': [[t, v] for t, v in points]}, 200
@@ -0,0 +1,475 @@
+"""
+InfluxDB sink: converts monitor messages to 'rgbww_debug_data' points and log
+lines to 'rgbww_log' points and writes them in batches.
+"""
+import atexit
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+import influxdb_client
+from influxdb_client import Point, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from .core import Sink
+
+WRITE_PRECISIONS = {
+    's': WritePrecision.S,
+    'ms': WritePrecision.MS,
+    'us': WritePrecision.US,
+    'ns': WritePrecision.NS,
+}
+
+# List of field keys that MUST be stored as integers in InfluxDB
+INTEGER_ONLY_FIELDS = ['uptime', 'freeHeap', 'id', 'time', 'mdns_received', 'mdns_replies']
+
+# Write errors caused by the data itself; retrying the same lines cannot succeed
+NON_RETRYABLE_STATUS = (400, 413, 422)
+
+# Common base metadata keys that are not written as fields
+SKIPPED_KEYS = ['id', 'deviceid', 'time', 'mac', 'timestamp_ms']
+
+
+def convert_value(key, value):
+    """
+    Robust type casting for a flattened field value.
+
+    Numbers and numeric strings ("123", "123.45" but not "1.2.3") become floats,
+    or ints for INTEGER_ONLY_FIELDS; anything else is returned unchanged.
+    Raises ValueError if a numeric-looking value cannot be converted.
+    """
+    if isinstance(value, (int, float)):
+        float_val = float(value)
+    elif isinstance(value, str) and (value.replace('.', '', 1).isdigit() and value.count('.') < 2):
+        float_val = float(value)
+    else:
+        # Not numerical, use original value (e.g., string, boolean)
+        return value
+
+    if key in INTEGER_ONLY_FIELDS:
+        # Cast to int for fields like uptime
+        return int(float_val)
+    return float_val
+
+
+def build_point(message, precision=WritePrecision.S, registry=None, guard=None, log_precision=WritePrecision.NS):
+    """
+    Converts a Message to a Point, or returns None if there is nothing to write.
+    With a FieldTypeRegistry every field is coerced to its registered type;
+    with a CardinalityGuard only admitted devices and field keys are written.
+    Log lines are stamped with log_precision: several lines of a device often
+    arrive within one second, and at second precision they would overwrite
+    each other.
+    """
+    timestamp = datetime.fromtimestamp(message.received, timezone.utc)
+
+    if message.kind == 'log':
+        if message.device_id is None:
+            print(f"[ERROR] Could not parse device id from topic: {message.topic}")
+            return None
+        return Point("rgbww_log").tag("id", message.device_id).field("message", message.text) \
+            .time(time=timestamp, write_precision=log_precision)
+
+    flat = message.flat
+    if not flat:
+        return None
+    try:
+        device_id = int(flat.get('id', flat.get('deviceid')))
+    except (ValueError, TypeError):
+        return None
+    if guard is not None and not guard.admit_device("rgbww_debug_data", device_id):
+        return None
+
+    point = Point("rgbww_debug_data").tag("device", device_id)
+    for key, value in flat.items():
+        if key in SKIPPED_KEYS:
+            continue
+        if guard is not None and not guard.admit_field("rgbww_debug_data", key):
+            continue
+        try:
+            converted = convert_value(key, value)
+        except ValueError:
+            # If any part of the conversion failed, skip the field
+            continue
+        if registry is not None:
+            converted = registry.coerce("rgbww_debug_data", key, converted, raw=value)
+            if converted is None:
+                continue
+        point.field(key, converted)
+
+    if not point._fields:
+        return None
+    return point.time(time=timestamp, write_precision=precision)
+
+
+def legacy_int(value):
+    try:
+        return int(float(value))
+    except (ValueError, TypeError):
+        return 0
+
+
+def build_legacy_points(message, precision=WritePrecision.S):
+    """
+    Points in the schema of the original root-level importer: 'rgbww_metrics'
+    with a 'deviceid' tag and integer id, time, uptime, freeHeap and mdns_*
+    fields, one per device of a {"devices": [...]} payload.
+    """
+    payload = message.payload
+    devices = payload['devices'] if isinstance(payload, dict) and 'devices' in payload else [payload]
+    timestamp = datetime.fromtimestamp(message.received, timezone.utc)
+    points = []
+    for device in devices:
+        if not isinstance(device, dict):
+            continue
+        point = Point("rgbww_metrics") \
+            .tag("deviceid", str(legacy_int(device.get('id')))) \
+            .field("id", legacy_int(device.get('id'))) \
+            .field("time", legacy_int(device.get('time', 0))) \
+            .field("uptime", legacy_int(device.get('uptime', 0))) \
+            .field("freeHeap", legacy_int(device.get('freeHeap', 0)))
+        if isinstance(device.get('mDNS'), dict):
+            for k, v in device['mDNS'].items():
+                point.field(f"mdns_{k}", v)
+        points.append(point.time(time=timestamp, write_precision=precision))
+    return points
+
+
+class Processor:
+    """
+    Derives extra points from the ingest stream inside the InfluxDB writer.
+
+    process() sees every message (in arrival order) and returns the points it
+    wants written alongside the raw data; tick() is called once per flush and
+    may return points for state that closed without a new message.
+    """
+
+    name = 'processor'
+
+    def process(self, message, precision):
+        return []
+
+    def tick(self, now, precision):
+        return []
+
+    def stats(self):
+        return {}
+
+
+class InfluxSink(Sink):
+    """
+    Batches points and writes them every write_interval seconds. Points are
+    written at the sink's precision, except log points (log_precision, ns by
+    default); every flush sends one write per precision. With legacy=True
+    monitor messages are written in the root importer's 'rgbww_metrics'
+    schema (build_legacy_points) instead of 'rgbww_debug_data'.
+    """
+
+    name = 'influx'
+
+    def __init__(self, url, org, bucket, token, precision='s', gzip=True,
+                 write_interval=5, queue_size=1000, registry=None,
+                 dead_letters=None, max_backoff=300, guard=None, policy='fifo', per_device=10,
+                 log_compactor=None, routes=None, pool_size=None, name=None, log_precision='ns',
+                 legacy=False):
+        super().__init__(queue_size=queue_size, flush_interval=write_interval, policy=policy, per_device=per_device)
+        if name:
+            self.name = name
+        self.org = org
+        self.bucket = bucket
+        if precision not in WRITE_PRECISIONS:
+            print(f"Unknown InfluxDB precision '{precision}', falling back to 's'.")
+            precision = 's'
+        self.precision = WRITE_PRECISIONS[precision]
+        if log_precision not in WRITE_PRECISIONS:
+            print(f"Unknown InfluxDB log precision '{log_precision}', falling back to 'ns'.")
+            log_precision = 'ns'
+        self.log_precision = WRITE_PRECISIONS[log_precision]
+        self.legacy = legacy
+        # precision -> serialized lines of the last failed write, retried on the next flush
+        self.pending = {}
+        self.points_written = 0
+        self.processors = []
+        self.registry = registry
+        self.guard = guard
+        # LogCompactor replacing the one-point-per-line rgbww_log output
+        self.log_compactor = log_compactor
+        if log_compactor is not None:
+            log_compactor.guard = guard
+        # RoutingTable selecting the topics and measurements of this destination
+        self.routes = routes
+        self.unrouted = 0
+        # Points refused by the server (after bisection) end up here
+        self.dead_letters = dead_letters
+        self.rejected = 0
+        # Exponential backoff state for retryable errors
+        self.max_backoff = max_backoff
+        self.attempts = 0
+        self.retry_at = 0
+        # AckWindow in at-least-once mode, and the ack tokens of messages
+        # whose points are not committed yet
+        self.acks = None
+        self.unacked = []
+
+        self.write_api = None
+        try:
+            # Each sink has its own client and so its own connection pool
+            pool = {'connection_pool_maxsize': pool_size} if pool_size else {}
+            self.client = influxdb_client.InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip, **pool)
+            # Use SYNCHRONOUS mode for simpler error handling
+            self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+            print(f"InfluxDB client for {url} bucket {bucket} initialized successfully (precision={precision}, gzip={gzip}).")
+        except Exception as e:
+            print(f"Error initializing InfluxDB client: {e}. Please check your URL, Token, and Org. Write functionality disabled.")
+
+        # An empty registry takes the field types already stored in the
+        # bucket. That happens in the writer thread, before the first batch
+        # pins any type, and is retried while InfluxDB is unreachable.
+        self.seed_pending = self.write_api is not None and registry is not None and registry.is_empty()
+        # Messages waiting for the seed
+        self.held = []
+        # The worker and the exit handler (shutdown) must not flush at once
+        self.lock = threading.Lock()
+
+    def add_processor(self, processor):
+        self.processors.append(processor)
+        return processor
+
+    def accepts(self, message):
+        if self.routes is not None and not self.routes.accepts_topic(message.topic):
+            return False
+        return self.write_api is not None
+
+    def to_lines(self, messages):
+        """
+        Serializes a batch in series order, as {precision: lines}. Grouping
+        lines by series (stable, so each series stays in time order) lets
+        InfluxDB append to one series at a time instead of jumping between
+        them.
+        """
+        # (point, topic of the message it came from or None)
+        points = []
+        compactor = self.log_compactor
+        for message in messages:
+            topic = message.topic
+            if compactor is not None and message.kind == 'log':
+                points.extend((p, topic) for p in compactor.process(message, self.log_precision))
+                continue
+            if self.legacy and message.kind != 'log':
+                points.extend((p, topic) for p in build_legacy_points(message, self.precision))
+            else:
+                point = build_point(message, self.precision, self.registry, self.guard, self.log_precision)
+                if point is not None:
+                    points.append((point, topic))
+            for processor in self.processors:
+                points.extend((p, topic) for p in processor.process(message, self.precision))
+        now = time.time()
+        if compactor is not None:
+            points.extend((p, None) for p in compactor.tick(now, self.log_precision))
+        for processor in self.processors:
+            points.extend((p, None) for p in processor.tick(now, self.precision))
+        return self.serialize(points)
+
+    def serialize(self, points):
+        """(point, topic or None) pairs -> {precision: lines} of the routed points."""
+        routed = [p for p, topic in points if self.routes is None or self.routes.accepts(topic, p._name)]
+        self.unrouted += len(points) - len(routed)
+        by_precision = {}
+        for point in routed:
+            by_precision.setdefault(point._write_precision, []).append(point.to_line_protocol())
+        for lines in by_precision.values():
+            lines.sort(key=lambda line: line.split(' ', 1)[0])
+        return by_precision
+
+    def seed(self):
+        """
+        Seeds the registry from the bucket; returns False while InfluxDB
+        cannot be reached. A refused query (e.g. a write-only token) is not
+        retried.
+        """
+        try:
+            self.registry.seed_from_bucket(self.client.query_api(), self.bucket, self.org, "rgbww_debug_data")
+        except influxdb_client.rest.ApiException as api_e:
+            if api_e.status is None or api_e.status >= 500:
+                print(f"Could not seed field types from bucket '{self.bucket}' (status {api_e.status}), retrying.")
+                return False
+            print(f"Could not seed field types from bucket '{self.bucket}' (status {api_e.status}), "
+                  f"types are pinned as they arrive: {api_e.reason}")
+        except Exception as e:
+            print(f"Could not seed field types from bucket '{self.bucket}', retrying: {e}")
+            return False
+        self.seed_pending = False
+        return True
+
+    def hold(self, batch):
+        """Keeps a batch until the seed succeeds, bounded like the queue outside at-least-once mode."""
+        self.held.extend(batch)
+        if self.acks is None and len(self.held) > self.queue_size:
+            self.dropped += len(self.held) - self.queue_size
+            self.held = self.held[-self.queue_size:]
+
+    def start(self):
+        super().start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self, timeout=10):
+        """
+        Writes the queued messages and the open log runs on exit; without
+        it the runs a restart interrupts are lost.
+        """
+        if self.write_api is None or not self.lock.acquire(timeout=timeout):
+            return
+        try:
+            self.flush_locked(self.drain())
+            if self.log_compactor is not None:
+                points = self.log_compactor.flush(self.log_precision)
+                for precision, lines in self.serialize([(p, None) for p in points]).items():
+                    self.commit(lines, precision)
+        except Exception as e:
+            print(f"[{self.name}] Could not flush on shutdown: {e}")
+        finally:
+            self.lock.release()
+
+    def flush(self, batch):
+        with self.lock:
+            self.flush_locked(batch)
+
+    def flush_locked(self, batch):
+        if self.seed_pending and not self.seed():
+            self.hold(batch)
+            return
+        if self.held:
+            batch = self.held + batch
+            self.held = []
+        try:
+            by_precision = self.to_lines(batch)
+        except Exception:
+            # The batch is lost: its messages must not be acked with a later
+            # batch, the broker redelivers them after a reconnect
+            if self.acks is not None:
+                self.acks.release([m.ack for m in batch if m.ack is not None])
+            raise
+        for precision, lines in self.pending.items():
+            by_precision[precision] = lines + by_precision.get(precision, [])
+        self.pending = {}
+        if self.registry is not None:
+            self.registry.save()
+        for precision, lines in by_precision.items():
+            if not lines:
+                continue
+            if time.time() < self.retry_at:
+                # Still backing off after a retryable error
+                self.retry_later(lines, precision)
+            else:
+                print(f"Attempting to write {len(lines)} points to InfluxDB...")
+                self.commit(lines, precision)
+        if self.acks is not None:
+            # The batch's lines are committed, dead-lettered or pending now
+            self.unacked.extend(m.ack for m in batch if m.ack is not None)
+        if self.unacked and not self.pending:
+            # Every message so far is committed (or dead-lettered)
+            self.acks.settle(self.unacked)
+            self.unacked = []
+
+    def commit(self, lines, precision):
+        """
+        Writes lines, isolating points the server refuses.
+
+        A non-retryable rejection (400/413/422) of a chunk splits it in
+        halves until the offending lines are alone; those go to the
+        dead-letter file and everything else is committed, at O(log n)
+        extra writes per bad point. Re-sending points that a partial write
+        already stored is harmless, as they overwrite themselves. A
+        retryable error keeps everything not yet committed for a later
+        attempt with exponential backoff.
+        """
+        chunks = [lines]
+        written = 0
+        while chunks:
+            chunk = chunks.pop()
+            try:
+                self.write_api.write(bucket=self.bucket, org=self.org, record=chunk, write_precision=precision)
+                written += len(chunk)
+                continue
+            except influxdb_client.rest.ApiException as api_e:
+                status, error = api_e.status, f"{api_e.reason}: {api_e.body}"
+            except Exception as e:
+                status, error = None, str(e)
+
+            self.errors += 1
+            if status in NON_RETRYABLE_STATUS:
+                if len(chunk) == 1:
+                    print(f"InfluxDB rejected a point (status {status}), moving it to the dead-letter file: {error}")
+                    self.dead_letter(chunk[0], status, error)
+                else:
+                    half = len(chunk) // 2
+                    chunks.append(chunk[half:])
+                    chunks.append(chunk[:half])
+                continue
+
+            if status is None:
+                print(f"Unexpected error in InfluxDB writer: {error}")
+            else:
+                print(f"InfluxDB API Error: Status {status}. {error}")
+                if status == 401:
+                    print("!!! AUTHENTICATION ERROR (401). Check INFLUX_TOKEN, ORG, and URL in configuration. !!!")
+            remaining = chunk + [line for rest in reversed(chunks) for line in rest]
+            self.backoff()
+            self.retry_later(remaining, precision)
+            break
+        else:
+            self.attempts = 0
+            self.retry_at = 0
+
+        if written:
+            self.points_written += written
+            print(f"Successfully wrote {written} points to InfluxDB.")
+
+    def backoff(self):
+        """Schedules the next attempt with exponential backoff and random jitter."""
+        delay = min(self.max_backoff, self.flush_interval * (2 ** self.attempts))
+        self.attempts += 1
+        delay = random.uniform(self.flush_interval, max(self.flush_interval, delay))
+        self.retry_at = time.time() + delay
+        print(f"Retrying InfluxDB write in {delay:.1f}s (attempt {self.attempts}).")
+
+    def dead_letter(self, line, status, error):
+        self.rejected += 1
+        if self.dead_letters is not None:
+            self.dead_letters.write(line, status, error)
+
+    def retry_later(self, lines, precision):
+        """
+        Keeps failed lines for the next flush, bounded like the queue itself.
+        In at-least-once mode nothing is dropped; the ack window is the bound.
+        """
+        if self.acks is not None:
+            self.pending[precision] = lines
+            return
+        self.pending[precision] = lines[-self.queue_size:]
+        dropped = len(lines) - len(self.pending[precision])
+        if dropped:
+            self.dropped += dropped
+
+    def stats(self):
+        stats = super().stats()
+        stats['pending'] = sum(len(lines) for lines in self.pending.values())
+        if self.seed_pending:
+            stats['held_for_seed'] = len(self.held)
+        stats['points_written'] = self.points_written
+        stats['rejected'] = self.rejected
+        stats['retry_in'] = max(0.0, round(self.retry_at - time.time(), 1))
+        if self.routes is not None:
+            stats['unrouted'] = self.unrouted
+        if self.acks is not None:
+            stats['unacked'] = len(self.unacked)
+        if self.log_compactor is not None:
+            stats['logs'] = self.log_compactor.stats()
+        for processor in self.processors:
+            stats[processor.name] = processor.stats()
+        if self.registry is not None:
+            stats['field_types'] = self.registry.stats()
+        if self.guard is not None:
+            stats['cardinality'] = self.guard.stats()
+        return stats
@@ -0,0 +1,216 @@
+"""
+Log-stream compaction for rgbww/<id>/log lines.
+
+Lines look like '<uptime ms> <I|W|E> [component] text'. Each line is split
+into level and component (written as tags), its numeric codes
+('rssi=-67', 'error=5', 'status 404') as fields, and a template: the text
+with every number replaced by '#'. Where the codes sit in a template goes
+through a bounded cache keyed by the template, since a device mostly
+repeats a small set of lines that only differ in their numbers.
+
+Identical consecutive lines of a device (ignoring the uptime prefix) within
+window seconds become a single 'rgbww_log' point: the time and uptime of
+the first line, plus 'repeat', 'last' (epoch seconds) and 'last_uptime_ms'
+of the last one. A crash-looping device that prints the same line hundreds
+of times a minute costs one point per window instead of hundreds. Runs
+still open on shutdown are written by flush().
+
+Code fields go through the InfluxDB sink's CardinalityGuard like monitor
+fields, so devices printing arbitrary 'key=value' text cannot grow the
+rgbww_log schema without bound.
+"""
+import re
+from functools import lru_cache
+
+from influxdb_client import Point, WritePrecision
+
+LINE = re.compile(r'^\s*(?:(\d+)\s+)?(?:([DIWE])\s+)?(?:\[([^\]]*)\]\s*)?(.*?)\s*$', re.S)
+# Also numbers with a unit ('250ms'), so timings do not make new templates
+NUMBER = re.compile(r'-?\b\d+(?:\.\d+)?')
+# 'key=12', 'key: 12' and 'status 404'-style codes
+CODE = re.compile(r'\b([A-Za-z_]\w*)(?:\s*[=:]\s*|\s+)(-?\d+(?:\.\d+)?)')
+# The same codes in a template, where the numbers are '#'
+CODE_SLOT = re.compile(r'\b([A-Za-z_]\w*)(?:\s*[=:]\s*|\s+)(#)')
+CODE_WORDS = {'status', 'code', 'error', 'err', 'reason', 'errno'}
+LEVELS = {'D': 'debug', 'I': 'info', 'W': 'warning', 'E': 'error'}
+# Tag and field keys of the point itself that a code must not reuse
+RESERVED = {'message', 'template', 'repeat', 'last', 'uptime_ms', 'last_uptime_ms',
+            'id', 'level', 'component'}
+
+# Nanoseconds per unit of each precision
+PRECISION_NS = {
+    WritePrecision.S: 10 ** 9,
+    WritePrecision.MS: 10 ** 6,
+    WritePrecision.US: 10 ** 3,
+    WritePrecision.NS: 1,
+}
+
+
+def code_key(key, text, separator_start, separator_end):
+    """The field key of a code, None when it is no code."""
+    # 'status 404' needs a known word, 'key=404' any key
+    separated = text[separator_start:separator_end].strip()
+    if not separated and key.lower() not in CODE_WORDS:
+        return None
+    key = key.lower()
+    return 'code_' + key if key in RESERVED else key
+
+
+@lru_cache(maxsize=4096)
+def template_codes(template):
+    """((code key, index of its number in the line), ...) of a template."""
+    codes = []
+    for match in CODE_SLOT.finditer(template):
+        key = code_key(match.group(1), template, match.end(1), match.start(2))
+        if key is not None:
+            codes.append((key, template.count('#', 0, match.start(2))))
+    return tuple(codes)
+
+
+def parse_text(text):
+    """Returns (template, ((code, value), ...)) for the text part of a line."""
+    template = NUMBER.sub('#', text)
+    if '#' in text:
+        # A literal '#' would shift the number slots, parse the text itself
+        codes = []
+        for match in CODE.finditer(text):
+            key = code_key(match.group(1), text, match.end(1), match.start(2))
+            if key is not None:
+                codes.append((key, float(match.group(2))))
+        return template, tuple(codes)
+    codes = template_codes(template)
+    if not codes:
+        return template, ()
+    numbers = NUMBER.findall(text)
+    return template, tuple((key, float(numbers[i])) for key, i in codes)
+
+
+def parse_line(line):
+    """
+    Splits a log line into a dict with 'uptime_ms' (int or None), 'level',
+    'component' (None when absent), 'text', 'template' and 'codes'.
+    """
+    uptime, level, component, text = LINE.match(line).groups()
+    template, codes = parse_text(text)
+    return {
+        'uptime_ms': int(uptime) if uptime is not None else None,
+        'level': LEVELS.get(level),
+        'component': component or None,
+        'text': text,
+        'template': template,
+        'codes': codes,
+    }
+
+
+class Run:
+    """Consecutive identical lines of one device."""
+
+    __slots__ = ('key', 'line', 'parsed', 'first', 'last', 'count', 'last_uptime')
+
+    def __init__(self, key, line, parsed, received):
+        self.key = key
+        self.line = line
+        self.parsed = parsed
+        self.first = received
+        self.last = received
+        self.count = 1
+        self.last_uptime = parsed['uptime_ms']
+
+
+class LogCompactor:
+    """
+    Turns log messages into collapsed 'rgbww_log' points inside the InfluxDB
+    sink. process() closes a device's open run when a different line
+    arrives; tick() closes runs that are older than the window, so window=0
+    only collapses repeats within one write batch. The InfluxDB sink sets
+    guard to its CardinalityGuard.
+    """
+
+    name = 'logs'
+
+    def __init__(self, window=60):
+        self.window = window
+        # device -> open Run
+        self.runs = {}
+        # device -> time of the last written point, to keep points distinct
+        self.last_written = {}
+        self.guard = None
+        self.lines = 0
+        self.points = 0
+
+    def process(self, message, precision):
+        if message.device_id is None:
+            print(f"[ERROR] Could not parse device id from topic: {message.topic}")
+            return []
+        self.lines += 1
+        line = message.text
+        parsed = parse_line(line)
+        key = (parsed['level'], parsed['component'], parsed['text'])
+        run = self.runs.get(message.device_id)
+        if run is not None and run.key == key:
+            run.count += 1
+            run.last = message.received
+            run.last_uptime = parsed['uptime_ms']
+            return []
+        self.runs[message.device_id] = Run(key, line, parsed, message.received)
+        if run is None:
+            return []
+        return [self.close(message.device_id, run, precision)]
+
+    def tick(self, now, precision):
+        points = []
+        for device_id, run in list(self.runs.items()):
+            if now - run.first >= self.window:
+                del self.runs[device_id]
+                points.append(self.close(device_id, run, precision))
+        return points
+
+    def flush(self, precision):
+        """Closes every open run, e.g. on shutdown."""
+        runs, self.runs = self.runs, {}
+        return [self.close(device_id, run, precision) for device_id, run in runs.items()]
+
+    def close(self, device_id, run, precision):
+        """
+        Builds the point of a finished run. Two runs of a device starting
+        within the same precision unit would overwrite each other, so the
+        later one is moved one unit forward.
+        """
+        # Integer time in units of precision; receive times are float seconds
+        # and are converted once, the rest is exact
+        unit = PRECISION_NS.get(precision, 10 ** 9)
+        timestamp = round(run.first * 10 ** 9) // unit
+        previous = self.last_written.get(device_id)
+        if previous is not None and timestamp <= previous:
+            timestamp = previous + 1
+        self.last_written[device_id] = timestamp
+        self.points += 1
+
+        parsed = run.parsed
+        point = Point("rgbww_log").tag("id", device_id)
+        if parsed['level']:
+            point.tag("level", parsed['level'])
+        if parsed['component']:
+            point.tag("component", parsed['component'])
+        point.field("message", run.line).field("template", parsed['template']).field("repeat", run.count)
+        if run.count > 1:
+            point.field("last", float(run.last))
+            if run.last_uptime is not None:
+                point.field("last_uptime_ms", run.last_uptime)
+        if parsed['uptime_ms'] is not None:
+            point.field("uptime_ms", parsed['uptime_ms'])
+        for key, value in parsed['codes']:
+            if self.guard is None or self.guard.admit_field("rgbww_log", key):
+                point.field(key, value)
+        return point.time(time=timestamp, write_precision=precision)
+
+    def stats(self):
+        cache = template_codes.cache_info()
+        return {
+            'lines': self.lines,
+            'points': self.points,
+            'open_runs': len(self.runs),
+            'compaction': round(self.lines / self.points, 1) if self.points else None,
+            'template_cache_hits': cache.hits,
+            'template_cache_size': cache.currsize,
+        }
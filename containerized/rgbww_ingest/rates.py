@@ -0,0 +1,96 @@
+"""
+Ingest-time rates for monotonic counters.
+
+Keeps the last value of each counter per device and writes per-second rates
+to 'rgbww_rates' as '<counter>_per_s', so dashboards do not need
+derivative() over the raw stream.
+"""
+from datetime import datetime, timezone
+
+from influxdb_client import Point
+
+from .influx import Processor
+from .reboot import to_int
+
+DEFAULT_COUNTERS = ['mDNS_received', 'mDNS_replies']
+
+
+class CounterRates:
+    """
+    Per-second rates of monotonic counters between consecutive samples of a
+    device. The interval is taken from the device's own uptime when it
+    advanced (immune to network and queueing jitter), otherwise from the
+    receive times. A counter that went backwards was reset by a reboot: it
+    restarted from zero, so its rate is value / uptime since boot.
+    """
+
+    def __init__(self, counters=None):
+        self.counters = list(counters or DEFAULT_COUNTERS)
+        # device -> (uptime or None, received, {counter: value})
+        self.last = {}
+        self.resets = 0
+
+    def update(self, device_id, flat, received):
+        """
+        Stores the counters of a sample and returns [(counter, rate, reset)]
+        against the previous one. The rate of a reset counter is None when
+        the sample has no uptime.
+        """
+        values = {}
+        for counter in self.counters:
+            if counter in flat:
+                value = to_int(flat[counter], default=None)
+                if value is not None:
+                    values[counter] = value
+        if not values:
+            return []
+        uptime = to_int(flat['uptime'], default=None) if 'uptime' in flat else None
+
+        previous = self.last.get(device_id)
+        self.last[device_id] = (uptime, received, values)
+        if previous is None:
+            return []
+        last_uptime, last_received, last_values = previous
+
+        rebooted = uptime is not None and last_uptime is not None and uptime < last_uptime
+        if uptime is not None and last_uptime is not None and uptime > last_uptime:
+            elapsed = uptime - last_uptime
+        else:
+            elapsed = received - last_received
+
+        rates = []
+        for counter, value in values.items():
+            last_value = last_values.get(counter)
+            if last_value is None:
+                continue
+            if rebooted or value < last_value:
+                self.resets += 1
+                # Counter restarted from zero at boot
+                rates.append((counter, float(value) / uptime if uptime else None, True))
+            elif elapsed > 0:
+                rates.append((counter, float(value - last_value) / elapsed, False))
+        return rates
+
+
+class CounterRateProcessor(Processor):
+    """Writes the CounterRates of every monitor message."""
+
+    name = 'rates'
+
+    def __init__(self, counters=None):
+        self.rates = CounterRates(counters)
+
+    def process(self, message, precision):
+        flat = message.flat
+        if not flat or message.device_id is None:
+            return []
+        point = Point("rgbww_rates").tag("device", message.device_id)
+        for counter, rate, _ in self.rates.update(message.device_id, flat, message.received):
+            if rate is not None:
+                point.field(f"{counter}_per_s", rate)
+        if not point._fields:
+            return []
+        return [point.time(time=datetime.fromtimestamp(message.received, timezone.utc), write_precision=precision)]
+
+    def stats(self):
+        return {'tracked_devices': len(self.rates.last), 'resets': self.rates.resets}
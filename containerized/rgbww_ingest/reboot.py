@@ -0,0 +1,87 @@
+"""
+Ingest-time reboot detection.
+
+Remembers the last uptime of every device and emits one 'rgbww_reboot'
+event point when a device has restarted since its previous report, so the
+reboot panels can read a handful of events instead of pivoting the raw
+stream.
+"""
+from datetime import datetime, timezone
+
+from influxdb_client import Point
+
+from .influx import Processor
+
+# Exception details reported alongside reboot_reason, written without the prefix
+EXCEPTION_FIELDS = ['reboot_exccause', 'reboot_epc1', 'reboot_epc2', 'reboot_epc3',
+                    'reboot_excvaddr', 'reboot_depc']
+
+
+def to_int(value, default=0):
+    """
+    Normalizes firmware values that arrive as int, float, "" or a numeric
+    string ("4", "4.0", "0x40100000") to an int; anything else becomes default.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(float(value))
+        except ValueError:
+            pass
+        try:
+            return int(value, 0)
+        except ValueError:
+            return default
+    return default
+
+
+class RebootProcessor(Processor):
+
+    name = 'reboots'
+
+    def __init__(self, tolerance=60):
+        # Seconds of clock slack before a too-small uptime after a reporting
+        # gap counts as a reboot
+        self.tolerance = tolerance
+        # device -> (uptime, received)
+        self.last = {}
+        self.detected = 0
+
+    def process(self, message, precision):
+        flat = message.flat
+        if not flat or message.device_id is None or 'uptime' not in flat:
+            return []
+        uptime = to_int(flat['uptime'], default=None)
+        if uptime is None:
+            return []
+
+        previous = self.last.get(message.device_id)
+        self.last[message.device_id] = (uptime, message.received)
+        if previous is None:
+            return []
+
+        last_uptime, last_seen = previous
+        elapsed = message.received - last_seen
+        # Uptime went backwards, or the device has been up for less time than
+        # has passed since its previous report (rebooted during a gap)
+        if uptime >= last_uptime and uptime + self.tolerance >= elapsed:
+            return []
+
+        self.detected += 1
+        point = Point("rgbww_reboot").tag("device", message.device_id) \
+            .field("reason", to_int(flat.get('reboot_reason'))) \
+            .field("uptime", uptime) \
+            .field("previous_uptime", last_uptime)
+        for key in EXCEPTION_FIELDS:
+            if key in flat:
+                point.field(key[len('reboot_'):], to_int(flat[key]))
+        print(f"[REBOOT] Device {message.device_id} rebooted (uptime {last_uptime} -> {uptime})")
+        return [point.time(time=datetime.fromtimestamp(message.received, timezone.utc), write_precision=precision)]
+
+    def stats(self):
+        return {'tracked_devices': len(self.last), 'detected': self.detected}
@@ -0,0 +1,269 @@
+"""
+Prometheus remote-write sink.
+
+Pushes samples to a remote-write endpoint as they arrive instead of having
+Prometheus poll /metrics.json through json_exporter. The default metric
+mapping mirrors the mqtt_bridge module of json-exporter/json_exporter.yml.
+
+The WriteRequest protobuf is encoded by hand (it is four tiny messages) and
+compressed with python-snappy (installed in the importer image). Without it
+a valid but uncompressed snappy block is sent; the sink logs which one is
+in use at startup.
+"""
+import struct
+import time
+import urllib.error
+import urllib.request
+
+from .core import Sink
+from .reboot import to_int
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# (metric name, flattened field) as in json_exporter.yml, labelled with deviceid
+DEFAULT_METRICS = [
+    ('rgbww_heap_free_bytes', 'freeHeap'),
+    ('rgbww_uptime_seconds', 'uptime'),
+]
+
+
+# --- Protobuf encoding (prometheus/prompb WriteRequest) ---
+def _varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _length_delimited(field, data):
+    return _varint((field << 3) | 2) + _varint(len(data)) + data
+
+
+def encode_write_request(series):
+    """
+    Encodes [(labels dict, [(timestamp_ms, value), ...]), ...] as a
+    prompb.WriteRequest. Labels are sorted by name as Prometheus requires.
+    """
+    out = bytearray()
+    for labels, samples in series:
+        ts = bytearray()
+        for name in sorted(labels):
+            label = _length_delimited(1, name.encode()) + _length_delimited(2, str(labels[name]).encode())
+            ts += _length_delimited(1, label)
+        for timestamp_ms, value in samples:
+            sample = b'\x09' + struct.pack('<d', float(value)) + b'\x10' + _varint(int(timestamp_ms))
+            ts += _length_delimited(2, sample)
+        out += _length_delimited(1, bytes(ts))
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(data):
+    """Yields (field number, wire type, value) of a protobuf message."""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire == 2:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire}")
+        yield field, wire, value
+
+
+def decode_write_request(data):
+    """Inverse of encode_write_request, for stub receivers and tests."""
+    series = []
+    for field, _, ts in _fields(data):
+        if field != 1:
+            continue
+        labels, samples = {}, []
+        for sub, _, value in _fields(ts):
+            if sub == 1:
+                label = {f: v.decode() for f, _, v in _fields(value)}
+                labels[label.get(1, '')] = label.get(2, '')
+            elif sub == 2:
+                sample = {f: v for f, _, v in _fields(value)}
+                samples.append((sample.get(2, 0), struct.unpack('<d', sample.get(1, b'\0' * 8))[0]))
+        series.append((labels, samples))
+    return series
+
+
+# --- Snappy block format ---
+def snappy_compress(data):
+    if snappy is not None:
+        return snappy.compress(data)
+    # Literal-only block: valid snappy, just not smaller
+    out = bytearray(_varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        else:
+            out.append(61 << 2)
+            out += struct.pack('<H', n)
+        out += chunk
+    return bytes(out)
+
+
+def snappy_decompress(data):
+    if snappy is not None:
+        return snappy.decompress(data)
+    length, pos = _read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            n = tag >> 2
+            if n >= 60:
+                extra = n - 59
+                n = int.from_bytes(data[pos:pos + extra], 'little')
+                pos += extra
+            n += 1
+            out += data[pos:pos + n]
+            pos += n
+            continue
+        if kind == 1:
+            n = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], 'little')
+            pos += 2
+        else:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+        for _ in range(n):
+            out.append(out[-offset])
+    if len(out) != length:
+        raise ValueError("Corrupt snappy block")
+    return bytes(out)
+
+
+class RemoteWriteSink(Sink):
+    """
+    Collects samples for every flush_interval and pushes them in requests of
+    at most batch_size samples. Server errors and network failures are
+    retried up to max_retries times with doubling delays; 4xx responses mean
+    the data itself was refused and the request is dropped.
+    """
+
+    name = 'remote_write'
+
+    def __init__(self, url, job='iot-mqtt-bridge', metrics=None, batch_size=500,
+                 flush_interval=5, max_retries=3, timeout=10, queue_size=1000,
+                 policy='fifo', per_device=10):
+        super().__init__(queue_size=queue_size, flush_interval=flush_interval,
+                         policy=policy, per_device=per_device)
+        self.url = url
+        self.job = job
+        self.metrics = list(metrics or DEFAULT_METRICS)
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.samples_sent = 0
+        self.requests_failed = 0
+        if snappy is None:
+            print("[remote_write] python-snappy is not installed, bodies are sent as "
+                  "uncompressed snappy blocks")
+        else:
+            print("[remote_write] Bodies are compressed with python-snappy")
+
+    def accepts(self, message):
+        return bool(message.flat) and 'id' in message.flat
+
+    def to_series(self, messages):
+        """
+        Groups samples per series, each in time order. Prometheus rejects two
+        samples of one series with the same timestamp, so the later one wins.
+        """
+        series = {}
+        for message in messages:
+            flat = message.flat
+            timestamp_ms = int(message.received * 1000)
+            for metric, field in self.metrics:
+                value = to_int(flat[field], default=None) if field in flat else None
+                if value is None:
+                    continue
+                key = (metric, str(flat['id']))
+                series.setdefault(key, {})[timestamp_ms] = value
+        result = []
+        for (metric, device_id), samples in series.items():
+            labels = {'__name__': metric, 'deviceid': device_id, 'job': self.job}
+            result.append((labels, sorted(samples.items())))
+        return result
+
+    def write(self, messages):
+        request, size = [], 0
+        for labels, samples in self.to_series(messages):
+            request.append((labels, samples))
+            size += len(samples)
+            if size >= self.batch_size:
+                self.send(request, size)
+                request, size = [], 0
+        if request:
+            self.send(request, size)
+
+    def send(self, series, size):
+        body = snappy_compress(encode_write_request(series))
+        req = urllib.request.Request(self.url, data=body, method='POST', headers={
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'User-Agent': 'rgbww-ingest',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        })
+        delay = 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout):
+                    pass
+                self.samples_sent += size
+                return True
+            except urllib.error.HTTPError as e:
+                if e.code < 500 and e.code != 429:
+                    print(f"[remote_write] Endpoint refused {size} samples: {e.code} {e.reason}")
+                    break
+                error = f"{e.code} {e.reason}"
+            except (urllib.error.URLError, OSError) as e:
+                error = str(e)
+            if attempt < self.max_retries:
+                print(f"[remote_write] Push failed ({error}), retrying in {delay}s")
+                time.sleep(delay)
+                delay *= 2
+        self.requests_failed += 1
+        self.dropped += size
+        return False
+
+    def stats(self):
+        stats = super().stats()
+        stats['samples_sent'] = self.samples_sent
+        stats['requests_failed'] = self.requests_failed
+        return stats
@@ -0,0 +1,128 @@
+"""
+Streaming per-device rollups.
+
+Keeps min, max, mean, last and count of a few numeric fields per device in
+epoch-aligned windows (1m and 1h by default) and emits one point per device
+and window to 'rgbww_rollup_<window>' when the window closes. Long-range
+dashboard panels can read these instead of every raw point.
+"""
+from datetime import datetime, timezone
+
+from influxdb_client import Point
+
+from .influx import Processor
+
+DEFAULT_FIELDS = ['freeHeap', 'uptime', 'mDNS_received', 'mDNS_replies']
+DEFAULT_WINDOWS = {'1m': 60, '1h': 3600}
+
+
+def parse_windows(spec):
+    """Parses '1m,1h,30s' into {'1m': 60, '1h': 3600, '30s': 30}."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    windows = {}
+    for name in spec.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            windows[name] = int(name[:-1]) * units[name[-1]]
+        except (KeyError, ValueError):
+            print(f"Ignoring invalid rollup window '{name}'")
+    return windows
+
+
+class Window:
+    """Aggregates of one device over one window."""
+
+    __slots__ = ('start', 'aggregates')
+
+    def __init__(self, start):
+        self.start = start
+        # field -> [min, max, sum, count, last]
+        self.aggregates = {}
+
+    def add(self, field, value):
+        agg = self.aggregates.get(field)
+        if agg is None:
+            self.aggregates[field] = [value, value, value, 1, value]
+        else:
+            if value < agg[0]:
+                agg[0] = value
+            if value > agg[1]:
+                agg[1] = value
+            agg[2] += value
+            agg[3] += 1
+            agg[4] = value
+
+
+class RollupProcessor(Processor):
+
+    name = 'rollups'
+
+    def __init__(self, fields=None, windows=None, grace=5):
+        self.fields = list(fields or DEFAULT_FIELDS)
+        self.windows = dict(windows or DEFAULT_WINDOWS)
+        # Extra time after a window ends before tick() closes it without a new sample
+        self.grace = grace
+        # (window name, device) -> Window
+        self.open = {}
+        self.emitted = 0
+
+    def process(self, message, precision):
+        flat = message.flat
+        if not flat or message.device_id is None:
+            return []
+        values = {}
+        for field in self.fields:
+            value = flat.get(field)
+            if isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                values[field] = value
+            elif isinstance(value, str):
+                try:
+                    values[field] = float(value)
+                except ValueError:
+                    continue
+        if not values:
+            return []
+
+        points = []
+        ts = message.received
+        for name, seconds in self.windows.items():
+            start = ts - ts % seconds
+            key = (name, message.device_id)
+            window = self.open.get(key)
+            if window is not None and window.start != start:
+                points.append(self.close(name, message.device_id, window, precision))
+                window = None
+            if window is None:
+                window = self.open[key] = Window(start)
+            for field, value in values.items():
+                window.add(field, value)
+        return points
+
+    def tick(self, now, precision):
+        """Closes windows of devices that went quiet."""
+        points = []
+        for key, window in list(self.open.items()):
+            name, device_id = key
+            if now >= window.start + self.windows[name] + self.grace:
+                points.append(self.close(name, device_id, window, precision))
+                del self.open[key]
+        return points
+
+    def close(self, name, device_id, window, precision):
+        point = Point(f"rgbww_rollup_{name}").tag("device", device_id)
+        # Always floats (and an int count) so the field types never conflict
+        for field, (lo, hi, total, count, last) in window.aggregates.items():
+            point.field(f"{field}_min", float(lo))
+            point.field(f"{field}_max", float(hi))
+            point.field(f"{field}_mean", float(total) / count)
+            point.field(f"{field}_last", float(last))
+            point.field(f"{field}_count", count)
+        self.emitted += 1
+        return point.time(time=datetime.fromtimestamp(window.start, timezone.utc), write_precision=precision)
+
+    def stats(self):
+        return {'open_windows': len(self.open), 'emitted': self.emitted}
@@ -0,0 +1,110 @@
+"""
+Routing of InfluxDB points to several destinations.
+
+A routes file (JSON) lists the brokers to subscribe to, the destinations
+(InfluxDB url, org, bucket, token, precision) and the rules that map topic
+patterns and measurements to them:
+
+    {
+      "brokers": [
+        {"host": "site-a.example", "port": 1883, "user": "rgbww", "password": "...",
+         "topics": ["rgbww/+/monitor", "rgbww/+/log"]}
+      ],
+      "destinations": {
+        "short": {"url": "http://influxdb:8086", "org": "default", "bucket": "rgbww_short",
+                  "token": "...", "precision": "s"},
+        "long": {"url": "http://influxdb:8086", "org": "default", "bucket": "rgbww"}
+      },
+      "routes": [
+        {"topics": ["rgbww/+/log"], "measurements": ["rgbww_log"], "destination": "short"},
+        {"measurements": ["rgbww_*"], "destination": "long"}
+      ]
+    }
+
+Topics use MQTT wildcards (+, #), measurements glob patterns; a missing
+list matches everything. A point goes to every destination with a
+matching rule. Every destination is its own InfluxSink with its own
+client connection pool, queue, batches and retry state, so a slow or
+broken destination only ever backs up itself. Missing destination keys
+and broker keys fall back to the INFLUX_* and MQTT_* settings.
+"""
+import json
+from fnmatch import fnmatchcase
+
+
+def topic_matches(pattern, topic):
+    """MQTT subscription matching: '+' is one level, a trailing '#' any number."""
+    pattern_parts = pattern.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(pattern_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class Route:
+
+    __slots__ = ('topics', 'measurements')
+
+    def __init__(self, topics=None, measurements=None):
+        self.topics = list(topics) if topics else None
+        self.measurements = list(measurements) if measurements else None
+
+    def matches_topic(self, topic):
+        """A topic of None (points not derived from one message) matches any rule."""
+        return self.topics is None or topic is None or any(topic_matches(p, topic) for p in self.topics)
+
+    def matches(self, topic, measurement):
+        return self.matches_topic(topic) and (
+            self.measurements is None or any(fnmatchcase(measurement, p) for p in self.measurements))
+
+
+class RoutingTable:
+    """The rules of one destination."""
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        # (rules whose topics match, measurement) -> bool. Topics carry the
+        # device id, so they are matched on every call (cheap) and only the
+        # measurement globs are cached, per combination of matching rules.
+        self.cache = {}
+
+    def matching(self, topic):
+        """Indexes of the rules whose topic patterns match topic."""
+        return tuple(i for i, route in enumerate(self.routes) if route.matches_topic(topic))
+
+    def accepts_topic(self, topic):
+        return any(route.matches_topic(topic) for route in self.routes)
+
+    def accepts(self, topic, measurement):
+        key = (self.matching(topic), measurement)
+        matched = self.cache.get(key)
+        if matched is None:
+            if len(self.cache) > 10000:
+                self.cache.clear()
+            routes = self.routes
+            matched = self.cache[key] = any(
+                routes[i].measurements is None or any(fnmatchcase(measurement, p) for p in routes[i].measurements)
+                for i in key[0])
+        return matched
+
+
+def load_routes(path):
+    """
+    Reads a routes file; returns (brokers, {destination: settings},
+    {destination: RoutingTable}). Raises ValueError for rules pointing at
+    an unknown destination.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    destinations = config.get('destinations', {})
+    tables = {}
+    for rule in config.get('routes', []):
+        name = rule.get('destination')
+        if name not in destinations:
+            raise ValueError(f"Route {rule} points to unknown destination '{name}'")
+        route = Route(rule.get('topics'), rule.get('measurements'))
+        tables.setdefault(name, RoutingTable([])).routes.append(route)
+    return config.get('brokers', []), destinations, tables
@@ -0,0 +1,173 @@
+"""
+Persistent field-type registry.
+
+InfluxDB rejects a whole write when one field arrives with a different type
+than the one already stored (e.g. reboot_reason as float, "" and "4.0"
+across firmware versions). The registry pins every field of a measurement
+to the first type it was seen with (or the type already in the bucket),
+coerces later values to that type and counts every coercion.
+"""
+import json
+import os
+import threading
+
+TYPE_NAMES = {bool: 'boolean', int: 'integer', float: 'float', str: 'string'}
+
+
+def type_name(value):
+    return TYPE_NAMES.get(type(value))
+
+
+def coerce_value(value, target):
+    """
+    Converts value to the target type name. Returns None if it cannot be
+    represented (e.g. "abc" for a numeric field). Empty strings become 0
+    for numeric fields, which is what the firmware means by "".
+    """
+    if target == 'string':
+        return value if isinstance(value, str) else str(value)
+    if target == 'boolean':
+        if isinstance(value, str):
+            lowered = value.strip().lower()
+            if lowered in ('true', '1', 'yes', 'on'):
+                return True
+            if lowered in ('false', '0', 'no', 'off', ''):
+                return False
+            return None
+        return bool(value)
+
+    if isinstance(value, str):
+        value = value.strip()
+        if value == '':
+            value = 0
+        else:
+            try:
+                value = float(value)
+            except ValueError:
+                return None
+    try:
+        if target == 'integer':
+            return int(value)
+        if target == 'float':
+            return float(value)
+    except (ValueError, OverflowError):
+        pass
+    return None
+
+
+class FieldTypeRegistry:
+
+    def __init__(self, path):
+        self.path = path
+        # measurement -> {field: type name}
+        self.types = {}
+        self.coercions = {}
+        self.rejected = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.types = json.load(f)
+            print(f"Loaded field types for {sum(len(v) for v in self.types.values())} fields from {self.path}")
+        except (OSError, ValueError) as e:
+            print(f"Could not read field type registry {self.path}: {e}")
+
+    def save(self):
+        """
+        Writes the registry atomically if it changed. A failed write (disk
+        full, read-only volume) is reported and retried on the next call.
+        """
+        if not self.dirty or not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.types, indent=2, sort_keys=True)
+            self.dirty = False
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[ERROR] Could not write field type registry {self.path}: {e}")
+            self.dirty = True
+
+    def is_empty(self):
+        return not self.types
+
+    def seed_from_bucket(self, query_api, bucket, org, measurement, lookback='30d'):
+        """
+        Takes the stored type of every field of a measurement from the last
+        value in the bucket, without overriding types already registered.
+        """
+        query = (
+            f'from(bucket: "{bucket}")\n'
+            f'  |> range(start: -{lookback})\n'
+            f'  |> filter(fn: (r) => r._measurement == "{measurement}")\n'
+            f'  |> last()'
+        )
+        seeded = 0
+        with self.lock:
+            fields = self.types.setdefault(measurement, {})
+            for table in query_api.query(query, org=org):
+                for record in table.records:
+                    name = type_name(record.get_value())
+                    if name and record.get_field() not in fields:
+                        fields[record.get_field()] = name
+                        seeded += 1
+            if seeded:
+                self.dirty = True
+        print(f"Seeded {seeded} field types of '{measurement}' from bucket '{bucket}'")
+        return seeded
+
+    def coerce(self, measurement, field, value, raw=None):
+        """
+        Returns value converted to the registered type of the field, registering
+        the type on first sight. Returns None if the value has to be dropped.
+        raw is the value as received, used for string fields so that 5 stays
+        "5" rather than the "5.0" of its numeric conversion.
+        """
+        name = type_name(value)
+        if name is None:
+            return None
+        fields = self.types.get(measurement)
+        if fields is None:
+            with self.lock:
+                fields = self.types.setdefault(measurement, {})
+        target = fields.get(field)
+        if target is None:
+            if value == '':
+                # "" says nothing about the type; wait for a real value to pin it
+                key = f"{measurement}.{field}:unpinned-empty"
+                self.rejected[key] = self.rejected.get(key, 0) + 1
+                return None
+            with self.lock:
+                fields[field] = name
+                self.dirty = True
+            return value
+        if target == name:
+            return value
+
+        if target == 'string' and raw is not None:
+            value = raw
+        converted = coerce_value(value, target)
+        key = f"{measurement}.{field}:{name}->{target}"
+        if converted is None:
+            self.rejected[key] = self.rejected.get(key, 0) + 1
+        else:
+            self.coercions[key] = self.coercions.get(key, 0) + 1
+        return converted
+
+    def stats(self):
+        return {
+            'fields': sum(len(v) for v in self.types.values()),
+            'coercions': dict(self.coercions),
+            'rejected': dict(self.rejected),
+        }
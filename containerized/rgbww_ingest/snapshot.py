@@ -0,0 +1,108 @@
+"""
+Warm-start snapshots of the bridge's device state.
+
+The latest payload of every device (DeviceStateSink) and the service
+discovery table (DiscoverySink) are written to one JSON file every
+`interval` seconds and on shutdown:
+
+    {"version": 1, "saved": 1764930957.1,
+     "state": [[device id, received, topic, payload text], ...],
+     "discovery": {device id: {"address": ..., "labels": {...}, "last_seen": ...}}}
+
+Payloads are stored as the text received, so saving does not re-encode
+them and restoring does not parse them: each payload is decoded when
+first read, so a restore takes milliseconds for thousands of devices. The file is
+written to a temporary file in the same directory, fsynced and renamed
+over the previous one, so a crash mid-write leaves the last complete
+snapshot in place. Entries older than max_age are not restored.
+"""
+import atexit
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+def write_atomic(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class StateSnapshot:
+
+    def __init__(self, path, state, discovery=None, interval=60, max_age=3600):
+        self.path = path
+        self.state = state
+        self.discovery = discovery
+        self.interval = interval
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def dump(self):
+        snapshot = {'version': SNAPSHOT_VERSION, 'saved': time.time(), 'state': self.state.export()}
+        if self.discovery is not None:
+            snapshot['discovery'] = self.discovery.export()
+        return json.dumps(snapshot, separators=(',', ':')).encode()
+
+    def save(self):
+        """Writes the snapshot; returns its size in bytes, None on failure."""
+        # The periodic thread and the shutdown handler may overlap
+        with self.lock:
+            try:
+                data = self.dump()
+                write_atomic(self.path, data)
+            except (OSError, ValueError) as e:
+                print(f"Could not write state snapshot {self.path}: {e}")
+                return
+        return len(data)
+
+    def restore(self, now=None):
+        """Loads the snapshot, if any; returns the number of devices restored."""
+        if not os.path.exists(self.path):
+            return 0
+        if now is None:
+            now = time.time()
+        started = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            print(f"Could not read state snapshot {self.path}: {e}")
+            return 0
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            print(f"Ignoring state snapshot {self.path}: version {snapshot.get('version')}")
+            return 0
+        entries = [e for e in snapshot.get('state', []) if now - e[1] <= self.max_age]
+        count = self.state.restore(entries)
+        if self.discovery is not None:
+            self.discovery.restore({device_id: device for device_id, device in snapshot.get('discovery', {}).items()
+                                    if now - device.get('last_seen', 0) <= self.max_age})
+        print(f"Restored {count} devices from {self.path} (saved {now - snapshot.get('saved', now):.0f}s ago) "
+              f"in {1000 * (time.perf_counter() - started):.1f} ms")
+        return count
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def start(self):
+        """Saves every interval seconds and on exit (including SIGTERM)."""
+        if self.interval > 0:
+            threading.Thread(target=self.run, name='snapshot', daemon=True).start()
+        atexit.register(self.save)
+        # docker stop sends SIGTERM, which skips atexit unless turned into an exit
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
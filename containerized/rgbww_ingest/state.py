@@ -0,0 +1,169 @@
+"""
+Device-state sink: keeps the latest monitor payload of every device for the
+bridge's /metrics.json endpoint and the Grafana query API.
+"""
+import json
+import threading
+import time
+
+from .compact import Codec, DeviceRecord
+from .core import Sink
+
+
+class DeviceStateSink(Sink):
+    """
+    Latest payload per device id, stored as a compact DeviceRecord: the
+    payload's numbers in an array, its strings pooled and its keys in a
+    Shape shared by the fleet. The payload of a lazy (pass-through) message
+    is parsed here, in the worker thread, to check that it is a JSON object
+    with an 'id'. With keep_raw the payload bytes as received are kept as
+    well, for raw_snapshot().
+
+    Devices loaded by restore() (from a warm-start snapshot) are served with
+    a 'restored_age' key, the seconds since their payload was received,
+    until they report again. Their payloads are only decoded when first
+    read.
+    """
+
+    name = 'state'
+
+    def __init__(self, queue_size=1000, policy='fifo', per_device=10, keep_raw=False, max_cardinality=256):
+        super().__init__(queue_size=queue_size, policy=policy, per_device=per_device)
+        self.keep_raw = keep_raw
+        self.codec = Codec(max_cardinality=max_cardinality)
+        # device id -> DeviceRecord
+        self.devices = {}
+        # Device ids whose latest record came from a snapshot
+        self.restored = set()
+        self.lock = threading.Lock()
+
+    def accepts(self, message):
+        if not message.parsed:
+            return message.kind != 'log' and message.device_id is not None
+        return isinstance(message.payload, dict) and 'id' in message.payload
+
+    def write(self, messages):
+        for message in messages:
+            # No-op for messages accepts() already checked
+            if not (isinstance(message.payload, dict) and 'id' in message.payload):
+                continue
+            device_id = str(message.payload['id'])
+            shape, numbers, objects = self.codec.encode(message.payload)
+            record = DeviceRecord(message.topic, message.received, shape, numbers, objects,
+                                  raw=message.raw if self.keep_raw else None)
+            with self.lock:
+                self.devices[device_id] = record
+                self.restored.discard(device_id)
+
+    def decoded(self, record):
+        """Decodes a restored record on first use."""
+        if record.shape is None:
+            try:
+                payload = json.loads(record.raw)
+            except ValueError:
+                payload = None
+            shape, record.numbers, record.objects = self.codec.encode(payload if isinstance(payload, dict) else {})
+            # Set last: readers in other threads check shape
+            record.shape = shape
+            if not self.keep_raw:
+                record.raw = None
+        return record
+
+    def raw(self, record):
+        if record.raw is None:
+            return json.dumps(self.decoded(record).payload).encode()
+        return record.raw if isinstance(record.raw, bytes) else record.raw.encode()
+
+    def snapshot(self, now=None):
+        """Returns the latest payload of every device."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entries = list(self.devices.items())
+            restored = set(self.restored)
+        if not restored:
+            return [self.decoded(record).payload for _, record in entries]
+        return [dict(self.decoded(record).payload, restored_age=round(now - record.received, 1))
+                if device_id in restored else self.decoded(record).payload
+                for device_id, record in entries]
+
+    def raw_snapshot(self, now=None):
+        """
+        Returns the latest payload of every device as the bytes received
+        (re-encoded without keep_raw).
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entries = list(self.devices.items())
+            restored = set(self.restored)
+        out = []
+        for device_id, record in entries:
+            raw = self.raw(record)
+            if device_id in restored:
+                # Spliced in as the object's first key
+                raw = raw.strip()
+                head = b'{"restored_age": %.1f' % (now - record.received)
+                raw = head + (b'}' if raw[1:].lstrip() == b'}' else b', ' + raw[1:])
+            out.append(raw)
+        return out
+
+    def export(self):
+        """[[device id, received, topic, payload text], ...] for a snapshot."""
+        with self.lock:
+            entries = list(self.devices.items())
+        return [[device_id, record.received, record.topic, self.raw(record).decode(errors='replace')]
+                for device_id, record in entries]
+
+    def restore(self, entries):
+        """
+        Loads export() entries undecoded, so only the payloads that are read
+        before the device reports again get parsed. Devices that already
+        reported are kept. Returns the number restored.
+        """
+        count = 0
+        with self.lock:
+            for device_id, received, topic, text in entries:
+                if device_id in self.devices:
+                    continue
+                self.devices[device_id] = DeviceRecord(topic, received, raw=text.encode())
+                self.restored.add(device_id)
+                count += 1
+        return count
+
+    def table(self, columns):
+        """
+        Returns one row per device: [device, <columns from the flattened
+        payload>..., last_seen]. Missing values are None.
+        """
+        with self.lock:
+            entries = list(self.devices.items())
+        rows = []
+        for device_id, record in entries:
+            flat = self.decoded(record).flat
+            rows.append([device_id] + [flat.get(c) for c in columns] + [record.received])
+        return rows
+
+    def fleet(self, online_ttl, now=None):
+        """Counts known devices and those seen within online_ttl seconds."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            seen = [record.received for record in self.devices.values()]
+        return {
+            'known': len(seen),
+            'online': sum(1 for received in seen if now - received <= online_ttl),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.devices.clear()
+            self.restored.clear()
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats['devices'] = len(self.devices)
+            stats['restored'] = len(self.restored)
+        stats['codec'] = self.codec.stats()
+        return stats
@@ -0,0 +1,92 @@
+"""
+Flask endpoints shared by the importer and the bridge.
+"""
+from flask import Flask, Response, jsonify, request
+
+from . import debug as debug_endpoints
+from . import grafana
+from .history import history_response
+
+
+def create_app(core, state=None, online_ttl=3600, discovery=None, debug=False, history=None, anomalies=None,
+               passthrough=False):
+    """
+    Creates the Flask app. /metrics.json and the /grafana query API need a
+    DeviceStateSink; devices seen within online_ttl seconds count as online.
+    /sd needs a DiscoverySink, /history a HistorySink and /anomalies an
+    AnomalyProcessor. debug=True adds the /debug profiling endpoints.
+    passthrough=True splices the stored payload bytes into /metrics.json
+    instead of re-serializing them.
+    """
+    app = Flask(__name__)
+
+    @app.route('/metrics.json')
+    def metrics():
+        """Latest payload of every device that has reported an 'id'."""
+        if passthrough:
+            raws = state.raw_snapshot() if state is not None else []
+            return Response(b'{"devices": [' + b', '.join(raws) + b']}\n', mimetype='application/json')
+        devices = state.snapshot() if state is not None else []
+        return jsonify({"devices": devices})
+
+    @app.route('/sd')
+    def service_discovery():
+        """Live devices as Prometheus http_sd_configs target groups."""
+        return jsonify(discovery.targets() if discovery is not None else [])
+
+    @app.route('/history')
+    def device_history():
+        """?device=&field=&since=-1800|30m|<epoch>&step=60|1m&agg=mean|min|max|last"""
+        if history is None:
+            return jsonify({'error': 'history is disabled'}), 404
+        body, status = history_response(history, request.args)
+        return jsonify(body), status
+
+    @app.route('/anomalies')
+    def device_anomalies():
+        """Open leak/spike/dip events and the latest transitions (?device=)."""
+        if anomalies is None:
+            return jsonify({'error': 'anomaly detection is disabled'}), 404
+        return jsonify(anomalies.report(request.args.get('device')))
+
+    @app.route('/status')
+    def status():
+        """Ingest counters and per-sink queue statistics."""
+        status = core.status()
+        status['sinks'] = {sink.name: sink.stats() for sink in core.sinks}
+        return jsonify(status)
+
+    # --- Grafana JSON / Infinity datasource API ---
+    @app.route('/grafana/', methods=['GET'])
+    def grafana_health():
+        """Connection test of the JSON datasource."""
+        return 'OK'
+
+    @app.route('/grafana/search', methods=['POST'])
+    @app.route('/grafana/metrics', methods=['POST'])
+    def grafana_search():
+        """Lists the queryable targets."""
+        return jsonify(grafana.TARGETS)
+
+    @app.route('/grafana/query', methods=['POST'])
+    def grafana_query():
+        """Answers table queries for 'devices' and 'fleet' from memory."""
+        if state is None:
+            return jsonify([])
+        body = request.get_json(silent=True) or {}
+        return jsonify(grafana.query(state, body.get('targets', []), online_ttl))
+
+    @app.route('/grafana/devices')
+    def grafana_devices():
+        """Current uptime, freeHeap, firmware, soc and reboot_reason per device."""
+        return jsonify(grafana.device_rows(state) if state is not None else [])
+
+    @app.route('/grafana/fleet')
+    def grafana_fleet():
+        """Online and known device counts."""
+        return jsonify(grafana.fleet_rows(state, online_ttl) if state is not None else [])
+
+    if debug:
+        debug_endpoints.register(app)
+
+    return app
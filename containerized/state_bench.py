@@ -0,0 +1,139 @@
+"""
+Measures the memory the bridge's device state takes per device.
+
+Fills a DeviceStateSink with the latest payload of --devices simulated
+controllers (fleet_simulator monitor payloads, and info payloads with
+connection details for --info-share of them) and reports the bytes per
+device held after the fill, traced with tracemalloc. The payload bytes as
+received are allocated while tracing, so they count in the keep_raw
+column (the bridge's PASS_THROUGH mode, which keeps them for /metrics.json). For comparison the same messages are
+also held as decoded Message objects, the state's previous layout.
+
+The exit code is 1 when a compact store exceeds its target in TARGETS.
+
+Usage:
+  python state_bench.py                       # 10000 and 100000 devices
+  python state_bench.py --devices 5000 --info-share 1
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from fleet_simulator import Device, parse_mix
+from rgbww_ingest.core import parse_message
+from rgbww_ingest.state import DeviceStateSink
+
+# Bytes per device: (keep_raw False, keep_raw True)
+TARGETS = {10000: (500, 800), 100000: (500, 800)}
+SSIDS = ['rgbww-net', 'iot', 'lights-2g', 'workshop']
+
+
+def info(device, now, rng):
+    """An info payload shaped like the controller's /info (json_exporter.yml paths)."""
+    return {
+        'deviceid': device.id,
+        'id': device.id,
+        'current_rom': rng.choice(['rom0', 'rom1']),
+        'git_version': device.firmware,
+        'git_date': '2025-11-02',
+        'build_type': 'release',
+        'sming': '5.2.0',
+        'webapp_version': '0.4.1',
+        'soc': device.soc,
+        'uptime': int(now - device.booted),
+        'heap_free': device.heap,
+        'event_num_clients': rng.randint(0, 3),
+        'rgbww': {'version': '0.8.0', 'queuesize': rng.randint(0, 50)},
+        'connection': {
+            'connected': True,
+            'dhcp': True,
+            'ssid': SSIDS[device.id % len(SSIDS)],
+            'ip': f"10.{(device.id >> 16) & 255}.{(device.id >> 8) & 255}.{device.id & 255}",
+            'netmask': '255.255.0.0',
+            'gateway': '10.0.0.1',
+            'mac': ':'.join(f"{b:02x}" for b in device.id.to_bytes(6, 'big')),
+        },
+    }
+
+
+def fleet(devices, info_share, seed, soc_mix, firmware_mix):
+    rng = random.Random(seed)
+    socs, soc_weights = parse_mix(soc_mix)
+    firmwares, firmware_weights = parse_mix(firmware_mix)
+    now = time.time()
+    for i in range(devices):
+        device = Device(0x100000 + i, rng.choices(firmwares, firmware_weights)[0],
+                        rng.choices(socs, soc_weights)[0], now, rng)
+        if rng.random() < info_share:
+            yield f'rgbww/{device.id}/info', info(device, now, rng), now
+        else:
+            yield f'rgbww/{device.id}/monitor', device.monitor(now, rng), now
+
+
+def traced_bytes(fill):
+    """Bytes still allocated after fill() returns, and what it returned."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = fill()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, kept
+
+
+def measure(payloads, keep_raw):
+    def fill():
+        state = DeviceStateSink(queue_size=10, keep_raw=keep_raw)
+        for topic, payload, received in payloads:
+            state.write([parse_message(topic, json.dumps(payload).encode(), received=received)])
+        return state
+    used, state = traced_bytes(fill)
+    return used / len(payloads), state
+
+
+def measure_messages(payloads):
+    def fill():
+        devices = {}
+        for topic, payload, received in payloads:
+            message = parse_message(topic, json.dumps(payload).encode(), received=received)
+            devices[str(message.payload['id'])] = message
+        return devices
+    return traced_bytes(fill)[0] / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per device of the bridge's device state.")
+    parser.add_argument('--devices', default='10000,100000', help='comma separated fleet sizes')
+    parser.add_argument('--info-share', type=float, default=0.3, help='share of devices whose latest payload is info')
+    parser.add_argument('--soc', default='esp8266:0.8,esp32:0.1,esp32c3:0.1')
+    parser.add_argument('--firmware', default='V5.0-476-develop:0.8,V5.0-470-develop:0.15,V4.9-300-stable:0.05')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    failed = []
+    print(f"{'devices':>8} {'messages B':>11} {'compact B':>10} {'keep_raw B':>10}  targets")
+    for devices in [int(s) for s in args.devices.split(',') if s.strip()]:
+        payloads = list(fleet(devices, args.info_share, args.seed, args.soc, args.firmware))
+        messages = measure_messages(payloads)
+        compact, state = measure(payloads, keep_raw=False)
+        raw, _ = measure(payloads, keep_raw=True)
+        targets = TARGETS.get(devices)
+        flag = ''
+        if targets and (compact > targets[0] or raw > targets[1]):
+            flag = '  OVER TARGET'
+            failed.append(devices)
+        print(f"{devices:>8} {messages:>11.0f} {compact:>10.0f} {raw:>10.0f}  {targets or '-'}{flag}")
+        codec = state.codec.stats()
+        print(f"{'':>8} {codec['shapes']} shapes, {codec['pooled_values']} pooled strings, "
+              f"not pooled: {', '.join(codec['unpooled_keys']) or '-'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""
+Micro-benchmarks for the per-message transform hot path.
+
+Measures throughput (items/s, median of --repeat rounds) and allocations
+(peak traced bytes per item under tracemalloc, in a separate run) of:
+
+  flatten       flatten_json on the corpus payloads
+  convert       numeric-string detection and INTEGER_ONLY_FIELDS casting
+                (convert_value) on every flattened field
+  point         build_point + to_line_protocol per monitor message
+  parse         parse_message (decode + JSON + flatten) of the raw bytes
+  metrics_json  the bridge's /metrics.json response for --devices devices
+  metrics_json_raw  the same with PASS_THROUGH (stored bytes spliced)
+
+The corpus is the monitor payloads in log.txt ('Raw JSON from MQTT' lines),
+info payloads shaped after the paths in json_exporter.yml and synthetic
+deep (nested) and wide (many keys) payloads.
+
+Usage:
+  python transform_bench.py                  # run and compare with the baseline
+  python transform_bench.py --save-baseline  # run and store the baseline
+  python transform_bench.py --only flatten,point --threshold 0.2
+
+Baselines are JSON ({benchmark: {"items_per_s": ..., "peak_bytes_per_item":
+..., "reference_per_s": ..., "relative": ..., "noise": ...}}). Each round
+times the benchmark right after a fixed reference workload, and throughput
+is compared as the median of benchmark/reference over the rounds, which
+takes out most of the difference between a busy and an idle machine. The
+noise is how far that median itself may be off: the spread of the ratios
+(interquartile range / median) over the square root of the rounds. A
+throughput loss only counts when it exceeds both --threshold and three
+times the noise of the run or the baseline, so a noisy machine widens the
+bar rather than failing the run. The exit code is 1 when a benchmark regressed, or
+grew its allocations (which are deterministic) by more than
+--alloc-threshold.
+
+bench_baseline.json is committed, so a first run has something to compare
+against. Throughput is relative to the reference workload and carries over
+between machines reasonably well; after an intended change, or when the
+baseline is too far off for a machine, record a new one with
+--save-baseline (and commit it if the change is intended).
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+
+from rgbww_ingest.core import parse_message
+from rgbww_ingest.flatten import flatten_json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAW_MARKER = 'Raw JSON from MQTT: '
+EXPORTER_CONFIGS = [
+    os.path.join(HERE, '..', 'native-install', 'config', 'json_exporter.yml'),
+    os.path.join(HERE, 'json-exporter', 'json_exporter.yml'),
+]
+# '{ .connection.ip }' and '{.freeHeap}' style JSONPath references
+EXPORTER_PATH = re.compile(r"\{\s*\.([A-Za-z_][\w.]*)\s*\}")
+
+
+def monitor_payloads(path):
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            if RAW_MARKER in line:
+                try:
+                    payloads.append(json.loads(line.split(RAW_MARKER, 1)[1]))
+                except ValueError:
+                    continue
+    return payloads
+
+
+def info_payload(paths, index):
+    """A payload holding every exporter path, with numbers for value-like leaves."""
+    payload = {}
+    for path in paths:
+        node = payload
+        keys = path.split('.')
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        leaf = keys[-1]
+        if leaf in ('uptime', 'heap_free', 'freeHeap', 'queuesize', 'event_num_clients', 'id', 'deviceid'):
+            node[leaf] = 1000 + index
+        elif leaf in ('connected', 'dhcp'):
+            node[leaf] = True
+        else:
+            node[leaf] = f"{leaf}-{index % 7}"
+    return payload
+
+
+def exporter_paths():
+    paths = set()
+    for config in EXPORTER_CONFIGS:
+        if os.path.exists(config):
+            with open(config) as f:
+                paths.update(EXPORTER_PATH.findall(f.read()))
+    return sorted(paths)
+
+
+def deep_payload(index, depth=8, breadth=3):
+    def node(level):
+        if level == depth:
+            return {'value': index + level, 'text': str(index)}
+        return {f"n{i}": node(level + 1) for i in range(breadth if level < 3 else 1)}
+    return dict(node(0), id=index)
+
+
+def wide_payload(index, width=200):
+    payload = {'id': index, 'uptime': index * 10, 'freeHeap': 20000 + index}
+    for i in range(width):
+        payload[f"k{i}"] = str(i * 1.5) if i % 3 == 0 else (i if i % 3 == 1 else f"s{i}")
+    return payload
+
+
+def load_corpus(log_path, synthetic=50):
+    corpus = {'monitor': monitor_payloads(log_path) if os.path.exists(log_path) else []}
+    paths = exporter_paths()
+    corpus['info'] = [info_payload(paths, i) for i in range(synthetic)] if paths else []
+    corpus['deep'] = [deep_payload(i) for i in range(synthetic)]
+    corpus['wide'] = [wide_payload(i) for i in range(synthetic)]
+    return corpus
+
+
+# --- Benchmarks: setup(corpus, args) returns (run, items); run() does one pass ---
+
+def bench_flatten(corpus, args):
+    payloads = [p for kind in corpus.values() for p in kind]
+    return (lambda: [flatten_json(p) for p in payloads]), len(payloads)
+
+
+def bench_convert(corpus, args):
+    from rgbww_ingest.influx import convert_value
+    items = [(k, v) for kind in corpus.values() for p in kind for k, v in flatten_json(p).items()]
+
+    def run():
+        for key, value in items:
+            try:
+                convert_value(key, value)
+            except ValueError:
+                pass
+    return run, len(items)
+
+
+def bench_point(corpus, args):
+    from rgbww_ingest.influx import build_point
+    messages = [parse_message('rgbww/1/monitor', json.dumps(p).encode(), received=1764930957.0)
+                for kind in ('monitor', 'wide') for p in corpus[kind]]
+
+    def run():
+        for message in messages:
+            point = build_point(message)
+            if point is not None:
+                point.to_line_protocol()
+    return run, len(messages)
+
+
+def bench_parse(corpus, args):
+    raws = [json.dumps(p).encode() for kind in corpus.values() for p in kind]
+    return (lambda: [parse_message('rgbww/1/monitor', raw, received=0.0) for raw in raws]), len(raws)
+
+
+def bench_metrics_json(corpus, args, passthrough=False):
+    from rgbww_ingest.core import IngestCore
+    from rgbww_ingest.state import DeviceStateSink
+    from rgbww_ingest.web import create_app
+
+    template = corpus['monitor'][0] if corpus['monitor'] else wide_payload(0, 10)
+    core = IngestCore('localhost', 1883, '', '', topics=[], client_id='bench')
+    state = core.add_sink(DeviceStateSink(queue_size=args.devices, keep_raw=passthrough))
+    for i in range(args.devices):
+        payload = dict(template, id=i)
+        state.write([parse_message(f'rgbww/{i}/monitor', json.dumps(payload).encode(), received=0.0)])
+    client = create_app(core, state, passthrough=passthrough).test_client()
+    # Items are devices rendered
+    return (lambda: client.get('/metrics.json').data), args.devices
+
+
+def bench_metrics_json_raw(corpus, args):
+    return bench_metrics_json(corpus, args, passthrough=True)
+
+
+BENCHMARKS = {
+    'flatten': bench_flatten,
+    'convert': bench_convert,
+    'point': bench_point,
+    'parse': bench_parse,
+    'metrics_json': bench_metrics_json,
+    'metrics_json_raw': bench_metrics_json_raw,
+}
+
+
+def reference_work():
+    """Fixed pure-Python workload (dicts, strings, floats) used to calibrate machine speed."""
+    out = {}
+    for i in range(2000):
+        key = 'k' + str(i)
+        out[key] = float(str(i * 1.5))
+    return out
+
+
+def rate(run, items, min_time):
+    passes, started = 0, time.perf_counter()
+    while True:
+        run()
+        passes += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return passes * items / elapsed
+
+
+def noise(values):
+    """Interquartile range relative to the median, over sqrt(len) (0 with fewer than 4 values)."""
+    if len(values) < 4:
+        return 0.0
+    q1, _, q3 = statistics.quantiles(values, n=4)
+    return (q3 - q1) / statistics.median(values) / len(values) ** 0.5
+
+
+def measure(run, items, repeat, min_time):
+    """
+    Median items/s and items per reference unit over repeat rounds of at
+    least min_time seconds, each preceded by a round of the reference
+    workload, then peak bytes/item of one pass.
+    """
+    rates, references, ratios = [], [], []
+    for _ in range(repeat):
+        reference = rate(reference_work, 2000, min_time / 2)
+        measured = rate(run, items, min_time)
+        rates.append(measured)
+        references.append(reference)
+        ratios.append(measured / reference)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    run()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return {
+        'items_per_s': round(statistics.median(rates), 1),
+        'reference_per_s': round(statistics.median(references), 1),
+        'relative': round(statistics.median(ratios), 6),
+        'noise': round(noise(ratios), 3),
+        'peak_bytes_per_item': round(peak / items, 1),
+    }
+
+
+def compare(results, baseline, threshold, alloc_threshold):
+    """
+    Prints the change against the baseline; returns the names of regressed
+    benchmarks. Throughput is compared relative to the reference workload
+    measured alongside it, so a machine that is busier or slower than when
+    the baseline was taken does not count as a regression, and the allowed
+    loss is at least three times the measured noise.
+    """
+    regressed = []
+    print(f"{'benchmark':<18} {'items/s':>12} {'vs base':>8} {'allowed':>8} {'peak B/item':>12} {'vs base':>8}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        speed = allowed = alloc = ''
+        failed = False
+        if base:
+            # Baselines from before the median rounds only have the rates
+            relative = base.get('relative') or base['items_per_s'] / base['reference_per_s']
+            ratio = result['relative'] / relative
+            limit = max(threshold, 3 * max(result['noise'], base.get('noise', 0)))
+            speed = f"{100 * (ratio - 1):+.1f}%"
+            allowed = f"-{100 * limit:.0f}%"
+            failed |= ratio < 1 - limit
+            if base['peak_bytes_per_item']:
+                growth = result['peak_bytes_per_item'] / base['peak_bytes_per_item']
+                alloc = f"{100 * (growth - 1):+.1f}%"
+                failed |= growth > 1 + alloc_threshold
+        print(f"{name:<18} {result['items_per_s']:>12.1f} {speed:>8} {allowed:>8} "
+              f"{result['peak_bytes_per_item']:>12.1f} {alloc:>8}"
+              + ('  REGRESSED' if failed else ''))
+        if failed:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the per-message transform hot path.")
+    parser.add_argument('--log', default=os.path.join(HERE, 'log.txt'), help='log.txt with Raw JSON lines')
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'bench_baseline.json'))
+    parser.add_argument('--save-baseline', '--save', dest='save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--only', help='comma separated benchmarks (default: all)')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed fractional throughput loss (at least 3x the noise)')
+    parser.add_argument('--alloc-threshold', type=float, default=0.1, help='allowed fractional allocation growth')
+    parser.add_argument('--repeat', type=int, default=9, help='rounds per benchmark (the median counts)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per round')
+    parser.add_argument('--devices', type=int, default=1000, help='devices in the /metrics.json benchmark')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.only.split(',')] if args.only else list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)} (known: {', '.join(BENCHMARKS)})")
+
+    corpus = load_corpus(args.log)
+    print('corpus: ' + ', '.join(f"{len(v)} {k}" for k, v in corpus.items()))
+    results = {}
+    for name in names:
+        try:
+            run, items = BENCHMARKS[name](corpus, args)
+        except ImportError as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        results[name] = measure(run, items, args.repeat, args.min_time)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressed = compare(results, baseline, args.threshold, args.alloc_threshold)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+    elif not baseline:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one")
+    if regressed:
+        print(f"Regressed: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
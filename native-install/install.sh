@@ -76,6 +76,7 @@ install_dependencies() {
     local packages=(
         "curl"
         "jq"
+        "python3"
         "wget"
         "prometheus"
         "logrotate"
@@ -157,6 +158,8 @@ install_scripts() {
     # Install scripts
     cp "$SCRIPT_DIR/scripts/manage-iot-devices.sh" /etc/prometheus/
     cp "$SCRIPT_DIR/scripts/iot-status.sh" /etc/prometheus/
+    # One collector for both installs, kept with the container image sources
+    cp "$SCRIPT_DIR/../containerized/prometheus/iot_device_collector.py" /etc/prometheus/
     
     # Make executable
     chmod +x /etc/prometheus/manage-iot-devices.sh